@@ -0,0 +1,86 @@
+"""
+اجرای تحلیل دسته‌ای از خط فرمان
+
+    python -m app.batch postmortems.jsonl -o results.jsonl -c 4
+
+هر سطر ورودی یک JSON با problem و answers اختیاری است. اگر اجرا قطع شود،
+اجرای دوباره با همان فایل خروجی فقط موارد ناتمام را اجرا می‌کند.
+"""
+import sys
+import json
+import asyncio
+import argparse
+from typing import List, Optional
+from dotenv import load_dotenv
+
+# Load environment variables (پیش از import سرویس‌ها)
+load_dotenv()
+
+from app.services.http_client import create_http_client, close_http_client
+from app.services.provider_registry import provider_registry
+from app.services.response_cache import close_response_caches
+from app.services.batch import BATCH_CONCURRENCY, parse_batch_lines, run_batch
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="python -m app.batch",
+        description="تحلیل دسته‌ای 5 Whys از فایل JSONL"
+    )
+    parser.add_argument("input", help="فایل JSONL ورودی (- برای stdin)")
+    parser.add_argument("-o", "--output", help="فایل JSONL خروجی (بدون آن نتایج در stdout چاپ می‌شوند)")
+    parser.add_argument("-c", "--concurrency", type=int, default=BATCH_CONCURRENCY, help="تعداد تحلیل هم‌زمان")
+    parser.add_argument("--no-resume", action="store_true", help="نادیده گرفتن نتایج قبلی فایل خروجی")
+    parser.add_argument("-q", "--quiet", action="store_true", help="بدون گزارش پیشرفت در stderr")
+    return parser.parse_args(argv)
+
+
+async def run(args: argparse.Namespace) -> int:
+    if args.input == "-":
+        items = parse_batch_lines(sys.stdin)
+    else:
+        with open(args.input, encoding="utf-8") as f:
+            items = parse_batch_lines(f)
+
+    ai_service = provider_registry.service()
+
+    create_http_client()
+    failed = 0
+    try:
+        async for record, progress in run_batch(
+            ai_service,
+            items,
+            args.concurrency,
+            output_path=args.output,
+            resume=not args.no_resume
+        ):
+            failed = progress["failed"]
+            if not args.output:
+                print(json.dumps(record, ensure_ascii=False), flush=True)
+            if not args.quiet:
+                state = "resumed" if record.get("resumed") else record["status"]
+                print(
+                    f"[{progress['completed']}/{progress['total']}] {record['id']} {state}",
+                    file=sys.stderr,
+                    flush=True
+                )
+    finally:
+        await close_response_caches()
+        await close_http_client()
+    return 1 if failed else 0
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    args = parse_args(argv)
+    try:
+        sys.exit(asyncio.run(run(args)))
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(2)
+    except KeyboardInterrupt:
+        # نتایج تکمیل‌شده در فایل خروجی باقی می‌مانند
+        sys.exit(130)
+
+
+if __name__ == "__main__":
+    main()
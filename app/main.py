@@ -1,34 +1,66 @@
-from fastapi import FastAPI, HTTPException, Request
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi import FastAPI, HTTPException, Request, Header, WebSocket, Depends
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
-import uuid
-from typing import Dict
-from dotenv import load_dotenv
-import os
+from contextlib import asynccontextmanager
+from pydantic import ValidationError
+from typing import Optional
+import json
+import asyncio
+import hashlib
 import logging
+from dotenv import load_dotenv
+
+# Load environment variables (یک بار، پیش از import سرویس‌ها که تنظیمات را هنگام import می‌خوانند)
+load_dotenv()
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Configure logging (JSONL از طریق صف غیرمسدودکننده، با شناسه trace و context درخواست جاری)
+from app.services.log_pipeline import configure_logging, update_log_context, LogContextMiddleware, get_logging_stats
+configure_logging()
 logger = logging.getLogger(__name__)
 
 from app.models.schemas import (
-    StartAnalysisRequest, AnswerRequest,
-    AnalysisSession, WhyStep, AnalysisStatus,
-    NextQuestionResponse, FinalResultResponse, AIConfig
+    StartAnalysisRequest, AnswerRequest, SimilarRequest, ArchivePage,
+    AnalysisSession, AnalysisStatus,
+    NextQuestionResponse
 )
-from app.services.ai_service import AIService, test_openrouter_connection
-
-# Load environment variables
-load_dotenv()
-
-# Default AI configuration from .env
-DEFAULT_AI_CONFIG = {
-    "base_url": os.getenv("AI_BASE_URL", "https://api.openai.com/v1"),
-    "api_key": os.getenv("AI_API_KEY", ""),
-    "model_id": os.getenv("AI_MODEL_ID", "gpt-3.5-turbo")
-}
+from app.services.ai_service import AIService
+from app.services.analysis import (
+    create_session, run_step, answer_step
+)
+from app.services.http_client import create_http_client, close_http_client, get_pool_stats
+from app.services.provider_health import (
+    stop_health_monitors,
+    is_provider_available, get_health_snapshot
+)
+from app.services.session_store import create_session_store
+from app.services.streaming import sse_event
+from app.services.call_stats import track_calls, get_call_stats
+from app.services.response_cache import close_response_caches, get_cache_stats
+from app.services.admission import AdmissionRejected, get_admission_stats
+from app.services.retry import get_retry_stats
+from app.services.provider_router import get_router_stats
+from app.services.provider_registry import provider_registry, ProviderConfigError, get_registry_stats
+from app.services.idempotency import session_locks, answer_cache, IdempotencyConflict, get_idempotency_stats
+from app.services.response_parser import get_parse_stats
+from app.services.token_budget import TokenBudgetExceeded, get_budget_stats
+from app.services.ws_channel import SessionChannel, get_websocket_stats
+from app.services.static_assets import StaticAssets, static_pipeline, get_static_stats
+from app.services.speculation import get_speculation_stats
+from app.services.archive import (
+    ARCHIVE_MAX_PAGE, get_archive, open_archive, find_similar, check_admin_token,
+    close_archive, get_archive_stats
+)
+from app.services.screening import get_screening_stats
+from app.services.metrics import (
+    METRICS_ENABLED, MetricsMiddleware, render_metrics, record_error,
+    start_metrics_writer, stop_metrics_writer
+)
+from app.services.tracing import span, TracingMiddleware, TraceIdFilter, get_tracing_stats
+from app.services.batch import BATCH_CONCURRENCY, parse_batch_lines, batch_output_path, run_batch
 
+# شناسه trace در همه handlerهای ریشه (از جمله handlerهای از پیش نصب‌شده gunicorn)
+for handler in logging.getLogger().handlers:
+    handler.addFilter(TraceIdFilter())
 
 # لیست مدل‌های پشتیبانی شده
 SUPPORTED_MODELS = [
@@ -39,10 +71,32 @@ SUPPORTED_MODELS = [
     "xiaomi/mimo-v2-flash:free"
 ]
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """راه‌اندازی و آزادسازی منابع مشترک هر worker"""
+    static_pipeline.build()
+    create_http_client()
+    # خطای باز کردن بایگانی فقط لاگ و بایگانی غیرفعال می‌شود
+    await open_archive()
+    # تنظیمات سرویس‌دهنده‌ها یک بار بررسی و با سیگنال/تغییر فایل دوباره خوانده می‌شوند
+    provider_registry.start()
+    session_store.start_sweeper()
+    start_metrics_writer()
+    yield
+    await stop_metrics_writer()
+    await provider_registry.stop()
+    await stop_health_monitors()
+    await session_store.close()
+    await close_response_caches()
+    await close_archive()
+    await close_http_client()
+
+
 app = FastAPI(
     title="5 Whys Root Cause Analyzer",
     description="سیستم ریشه‌یابی مشکلات با تکنیک 5 چرا",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # Add CORS middleware for better frontend integration
@@ -54,247 +108,511 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# زمان کل هر درخواست برای /metrics
+app.add_middleware(MetricsMiddleware)
+# span ریشه هر درخواست و هدر X-Trace-Id
+app.add_middleware(TracingMiddleware)
+# context لاگ هر درخواست (session_id، step، تاخیر سرویس‌دهنده)
+app.add_middleware(LogContextMiddleware)
+
 # Global exception handler
 @app.exception_handler(Exception)
 async def global_exception_handler(request: Request, exc: Exception):
     logger.error(f"Global exception: {exc}")
+    record_error("app", type(exc).__name__)
     return JSONResponse(
         status_code=500,
         content={"detail": "خطای سرور. لطفاً دوباره تلاش کنید."}
     )
 
-# مسیر فایل‌های استاتیک
-app.mount("/static", StaticFiles(directory="static"), name="static")
+# مسیر فایل‌های استاتیک (با اثرانگشت، فشرده‌سازی از پیش و ETag)
+app.mount("/static", StaticAssets(static_pipeline), name="static")
+
+# ذخیره جلسات (پیش‌فرض در حافظه؛ با SESSION_BACKEND قابل تغییر به sqlite یا redis)
+session_store = create_session_store()
 
-# ذخیره موقت جلسات (در حافظه)
-sessions: Dict[str, AnalysisSession] = {}
+PROVIDER_UNAVAILABLE_MESSAGE = (
+    "اتصال به سرویس AI در حال حاضر برقرار نیست. لطفاً چند لحظه دیگر دوباره تلاش کنید. "
+    f"در صورت تکرار، از مدل‌های پشتیبانی شده استفاده کنید: {', '.join(SUPPORTED_MODELS)}"
+)
 
-MAX_STEPS = 7  # حداکثر تعداد سوالات
+# هدرهای لازم برای جلوگیری از بافر شدن SSE در پراکسی‌ها
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
 
 
 @app.get("/")
-async def root():
-    """صفحه اصلی"""
-    return FileResponse("static/index.html")
+async def root(request: Request):
+    """صفحه اصلی (از حافظه، با ارجاع به فایل‌های دارای اثرانگشت)"""
+    return static_pipeline.index_response(request)
+
+
+def get_ai_service() -> AIService:
+    """سرویس AI آماده از رجیستری تنظیمات پس از بررسی وضعیت سرویس‌دهنده"""
+    # تنظیمات پیش‌فرض (و سرویس‌دهنده‌های جایگزین AI_PROVIDERS) در شروع برنامه بررسی شده‌اند
+    try:
+        ai_service = provider_registry.service()
+    except ProviderConfigError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    # وضعیت سرویس‌دهنده‌ها از پایشگر پس‌زمینه خوانده می‌شود (بدون فراخوانی اضافه)
+    with span("provider_probe") as current:
+        available = [peer.base_url for peer in ai_service.peers if is_provider_available(peer.base_url)]
+        current.set(available=len(available))
+    if not available:
+        raise HTTPException(
+            status_code=503,
+            detail=PROVIDER_UNAVAILABLE_MESSAGE
+        )
+    
+    return ai_service
+
+
+async def get_open_session(session_id: str) -> AnalysisSession:
+    """دریافت جلسه‌ای که هنوز کامل نشده است"""
+    session = await session_store.get(session_id)
+    if not session:
+        raise HTTPException(status_code=404, detail="جلسه یافت نشد")
+    
+    if session.status == AnalysisStatus.ROOT_FOUND:
+        raise HTTPException(status_code=400, detail="تحلیل قبلاً تکمیل شده")
+    
+    update_log_context(session_id=session_id, step=session.current_step)
+    return session
 
 
 @app.post("/api/start", response_model=NextQuestionResponse)
 async def start_analysis(request: StartAnalysisRequest):
     """شروع تحلیل جدید"""
+    ai_service = get_ai_service()
+    # جستجوی تحلیل‌های مشابه هم‌زمان با تولید اولین سوال
+    similar = asyncio.create_task(find_similar(request.problem))
+    
     try:
-        # ایجاد سرویس AI با استفاده از تنظیمات پیش‌فرض
-        config = get_default_ai_config()
-        
-        # بررسی صحت تنظیمات OpenRouter
-        if "openrouter" in config.base_url.lower():
-            if not validate_openrouter_config(config):
-                raise HTTPException(
-                    status_code=400,
-                    detail="تنظیمات OpenRouter نامعتبر است. لطفاً کلید API و مدل را بررسی کنید."
-                )
-            
-            # تست اتصال به OpenRouter
-            try:
-                if not await test_openrouter_connection(config.api_key, config.base_url, config.model_id):
-                    raise HTTPException(
-                        status_code=400,
-                        detail=f"اتصال به OpenRouter برقرار نیست. مدل '{config.model_id}' ممکن است موجود نباشد یا کلید API نامعتبر باشد. لطفاً از مدل‌های پشتیبانی شده استفاده کنید: {', '.join(SUPPORTED_MODELS)}"
-                    )
-            except Exception as e:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"خطا در اتصال به OpenRouter: {str(e)}"
-                )
-        
-        ai_service = AIService(config)
-        
         # تولید اولین سوال
-        first_question = await ai_service.generate_first_why(request.problem)
-        
-        # ایجاد جلسه جدید
-        session_id = str(uuid.uuid4())[:8]
-        session = AnalysisSession(
-            session_id=session_id,
-            original_problem=request.problem,
-            steps=[WhyStep(step_number=1, question=first_question)],
-            current_step=1
-        )
-        
-        sessions[session_id] = session
-        
-        return NextQuestionResponse(
-            session_id=session_id,
-            current_step=1,
-            question=first_question,
-            status=AnalysisStatus.IN_PROGRESS
-        )
-        
+        with track_calls() as calls:
+            first_question = await ai_service.generate_first_why(request.problem)
+    except AdmissionRejected as e:
+        similar.cancel()
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
-        print(f"Error in start_analysis: {str(e)}")
-        print(f"Config: {config}")
+        similar.cancel()
+        logger.exception("Error in start_analysis: %s", e)
         raise HTTPException(status_code=500, detail=f"خطا در اتصال به AI: {str(e)}")
-
-
-def get_default_ai_config():
-    """دریافت تنظیمات پیش‌فرض AI از .env"""
-    return AIConfig(
-        base_url=DEFAULT_AI_CONFIG["base_url"],
-        api_key=DEFAULT_AI_CONFIG["api_key"],
-        model_id=DEFAULT_AI_CONFIG["model_id"]
+    
+    # ایجاد جلسه جدید
+    session = create_session(ai_service, request.problem, first_question, calls)
+    update_log_context(session_id=session.session_id, step=1)
+    await session_store.save(session)
+    
+    return NextQuestionResponse(
+        session_id=session.session_id,
+        current_step=1,
+        question=first_question,
+        status=AnalysisStatus.IN_PROGRESS,
+        similar=await similar
     )
 
 
-def validate_openrouter_config(config: AIConfig) -> bool:
-    """بررسی صحت تنظیمات OpenRouter"""
-    if "openrouter" not in config.base_url.lower():
-        return True
+@app.post("/api/start/stream")
+async def start_analysis_stream(request: StartAnalysisRequest):
+    """شروع تحلیل جدید با ارسال تدریجی متن سوال (SSE)"""
+    ai_service = get_ai_service()
     
-    # بررسی کلید API
-    if not config.api_key or len(config.api_key) < 10:
-        return False
+    async def events():
+        try:
+            # موارد مشابه پیش از شروع stream سوال ارسال می‌شوند
+            similar = await find_similar(request.problem)
+            if similar:
+                yield sse_event("similar", {"items": [item.model_dump(mode="json") for item in similar]})
+            
+            first_question = ""
+            with track_calls() as calls:
+                async for kind, value in ai_service.stream_first_why(request.problem):
+                    if kind == "delta":
+                        yield sse_event("delta", {"field": "question", "text": value})
+                    else:
+                        first_question = value
+            
+            session = create_session(ai_service, request.problem, first_question, calls)
+            update_log_context(session_id=session.session_id, step=1)
+            await session_store.save(session)
+            
+            response = NextQuestionResponse(
+                session_id=session.session_id,
+                current_step=1,
+                question=first_question,
+                status=AnalysisStatus.IN_PROGRESS,
+                similar=similar
+            )
+            yield sse_event("result", response.model_dump(mode="json"))
+        except Exception as e:
+            logger.exception("Error in start_analysis_stream: %s", e)
+            yield sse_event("error", {"detail": f"خطا در اتصال به AI: {str(e)}"})
     
-    # بررسی مدل
-    if not config.model_id:
-        return False
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+def answer_fingerprint(request: AnswerRequest) -> str:
+    """اثر انگشت بدنه ارسال پاسخ؛ کلید صریح تکراری با بدنه دیگر رد می‌شود"""
+    return hashlib.sha256(request.answer.encode("utf-8")).hexdigest()
+
+
+async def answer_idempotency_key(
+    request: AnswerRequest,
+    header_key: Optional[str],
+    session: Optional[AnalysisSession] = None
+) -> str:
+    """
+    کلید یکی‌سازی ارسال پاسخ
     
-    return True
+    با کلید صریح (فیلد idempotency_key یا هدر Idempotency-Key) نتیجه تکمیل‌شده هم
+    دوباره برگردانده می‌شود؛ بدون آن فقط ارسال‌های هم‌زمانِ یک پاسخ برای یک مرحله یکی می‌شوند.
+    """
+    explicit = header_key or request.idempotency_key
+    if explicit:
+        return f"{request.session_id}:{explicit}"
+    if session is None:
+        session = await get_open_session(request.session_id)
+    return f"{request.session_id}:step-{session.current_step}:{answer_fingerprint(request)[:16]}"
+
+
+async def process_answer(request: AnswerRequest):
+    """اعمال یک پاسخ روی جلسه (با قفل جلسه تا درخواست‌های هم‌زمان وضعیت را خراب نکنند)"""
+    async with session_locks.hold(request.session_id):
+        with span("session.load"):
+            session = await get_open_session(request.session_id)
+        ai_service = get_ai_service()
+        
+        try:
+            response = await answer_step(ai_service, session, request.answer)
+        except TokenBudgetExceeded as e:
+            raise HTTPException(status_code=429, detail=str(e))
+        except AdmissionRejected as e:
+            raise HTTPException(status_code=503, detail=str(e))
+        except Exception as e:
+            logger.exception("Error in submit_answer: %s", e)
+            raise HTTPException(status_code=500, detail=f"خطا: {str(e)}")
+        
+        with span("session.save"):
+            await session_store.save(session)
+        return response
 
 
 @app.post("/api/answer")
-async def submit_answer(request: AnswerRequest):
+async def submit_answer(
+    request: AnswerRequest,
+    idempotency_key: Optional[str] = Header(default=None, max_length=128)
+):
     """ارسال پاسخ و دریافت سوال بعدی"""
+    key = await answer_idempotency_key(request, idempotency_key)
+    try:
+        return await answer_cache.run(key, lambda: process_answer(request), answer_fingerprint(request))
+    except IdempotencyConflict as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+@app.post("/api/answer/stream")
+async def submit_answer_stream(
+    request: AnswerRequest,
+    idempotency_key: Optional[str] = Header(default=None, max_length=128)
+):
+    """ارسال پاسخ و دریافت تدریجی سوال بعدی یا نتیجه نهایی (SSE)"""
+    key = await answer_idempotency_key(request, idempotency_key)
+    try:
+        existing = answer_cache.begin(key, answer_fingerprint(request))
+    except IdempotencyConflict as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if existing is not None:
+        # ارسال تکراری: منتظر نتیجه همان درخواست می‌مانیم و فقط نتیجه نهایی را می‌فرستیم
+        async def replay():
+            try:
+                response = await asyncio.shield(existing)
+                yield sse_event("result", response.model_dump(mode="json"))
+            except HTTPException as e:
+                yield sse_event("error", {"detail": e.detail})
+            except Exception as e:
+                yield sse_event("error", {"detail": f"خطا: {str(e)}"})
+        
+        return StreamingResponse(replay(), media_type="text/event-stream", headers=SSE_HEADERS)
     
-    session = sessions.get(request.session_id)
-    if not session:
-        raise HTTPException(status_code=404, detail="جلسه یافت نشد")
+    try:
+        await get_open_session(request.session_id)
+        get_ai_service()
+    except BaseException as e:
+        answer_cache.fail(key, e)
+        raise
     
-    if session.status == AnalysisStatus.ROOT_FOUND:
-        raise HTTPException(status_code=400, detail="تحلیل قبلاً تکمیل شده")
+    async def events():
+        try:
+            async with session_locks.hold(request.session_id):
+                session = await get_open_session(request.session_id)
+                ai_service = get_ai_service()
+                
+                async for kind, value in run_step(ai_service, session, request.answer, stream=True):
+                    if kind == "delta":
+                        yield sse_event("delta", value)
+                    else:
+                        response = value
+                
+                await session_store.save(session)
+            answer_cache.complete(key, response)
+            yield sse_event("result", response.model_dump(mode="json"))
+        except HTTPException as e:
+            answer_cache.fail(key, e)
+            yield sse_event("error", {"detail": e.detail})
+        except (TokenBudgetExceeded, AdmissionRejected) as e:
+            answer_cache.fail(key, e)
+            yield sse_event("error", {"detail": str(e)})
+        except Exception as e:
+            answer_cache.fail(key, e)
+            logger.exception("Error in submit_answer_stream: %s", e)
+            yield sse_event("error", {"detail": f"خطا: {str(e)}"})
+        except BaseException as e:
+            answer_cache.fail(key, e)
+            raise
+    
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+@app.websocket("/ws/session/{session_id}")
+async def session_channel(websocket: WebSocket, session_id: str):
+    """
+    کانال WebSocket یک جلسه: جایگزین POSTهای جداگانه هر مرحله
     
+    جلسه و سرویس AI یک بار در شروع اتصال آماده می‌شوند و تا پایان اتصال
+    می‌مانند. کلاینت پیام {"type": "answer", "answer": ..., "idempotency_key": ...}
+    می‌فرستد و رویدادهای delta، result و error (مشابه SSE) دریافت می‌کند.
+    """
+    await websocket.accept()
+    channel = SessionChannel(websocket)
     try:
-        # استفاده از تنظیمات پیش‌فرض به جای تنظیمات ارسال شده توسط کاربر
-        config = get_default_ai_config()
-        
-        # بررسی صحت تنظیمات OpenRouter
-        if "openrouter" in config.base_url.lower():
-            if not validate_openrouter_config(config):
-                raise HTTPException(
-                    status_code=400,
-                    detail="تنظیمات OpenRouter نامعتبر است. لطفاً کلید API و مدل را بررسی کنید."
-                )
-            
-            # تست اتصال به OpenRouter
-            if not await test_openrouter_connection(config.api_key, config.base_url, config.model_id):
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"اتصال به OpenRouter برقرار نیست. مدل '{config.model_id}' ممکن است موجود نباشد. لطفاً از مدل‌های پشتیبانی شده استفاده کنید: {', '.join(SUPPORTED_MODELS)}"
-                )
-        
-        ai_service = AIService(config)
-        
-        # ذخیره پاسخ فعلی
-        current_step_idx = session.current_step - 1
-        session.steps[current_step_idx].answer = request.answer
-        
-        # بررسی و تولید سوال بعدی
-        (
-            is_valid,
-            next_question,
-            clarification,
-            is_root_found,
-            root_cause,
-            recommendations
-        ) = await ai_service.validate_and_generate_next(
-            session.original_problem,
-            session.steps,
-            request.answer
-        )
-        
-        # اگر پاسخ نامعتبر است
-        if not is_valid or clarification:
-            session.steps[current_step_idx].is_valid = False
-            session.steps[current_step_idx].clarification_note = clarification
-            session.status = AnalysisStatus.NEEDS_CLARIFICATION
-            
-            return NextQuestionResponse(
-                session_id=session.session_id,
-                current_step=session.current_step,
-                question=session.steps[current_step_idx].question,
-                status=AnalysisStatus.NEEDS_CLARIFICATION,
-                needs_clarification=True,
-                clarification_message=clarification or "لطفاً پاسخ واضح‌تری بدهید"
+        session = await get_open_session(session_id)
+        ai_service = get_ai_service()
+    except HTTPException as e:
+        await channel.reject(4000 + e.status_code, e.detail)
+        return
+    
+    async def handle(message: dict) -> None:
+        nonlocal session
+        try:
+            request = AnswerRequest(
+                session_id=session_id,
+                answer=message.get("answer") or "",
+                idempotency_key=message.get("idempotency_key")
             )
+        except ValidationError as e:
+            await channel.send({"type": "error", "detail": e.errors()[0]["msg"]})
+            return
         
-        # اگر به ریشه رسیدیم
-        if is_root_found or session.current_step >= MAX_STEPS:
-            if not root_cause:
-                root_cause, recommendations = await ai_service.generate_summary(
-                    session.original_problem,
-                    session.steps
-                )
-            
-            session.status = AnalysisStatus.ROOT_FOUND
-            session.root_cause = root_cause
-            session.recommendations = recommendations
-            
-            return FinalResultResponse(
-                session_id=session.session_id,
-                original_problem=session.original_problem,
-                steps=session.steps,
-                root_cause=root_cause,
-                recommendations=recommendations,
-                total_steps=session.current_step
-            )
+        key = await answer_idempotency_key(request, None, session)
+        try:
+            existing = answer_cache.begin(key, answer_fingerprint(request))
+        except IdempotencyConflict as e:
+            await channel.send({"type": "error", "detail": str(e)})
+            return
+        if existing is not None:
+            try:
+                response = await asyncio.shield(existing)
+            except HTTPException as e:
+                await channel.send({"type": "error", "detail": e.detail})
+                return
+            await channel.send({"type": "result", "data": response.model_dump(mode="json")})
+            return
         
-        # ادامه با سوال بعدی
-        session.current_step += 1
-        session.steps.append(WhyStep(
-            step_number=session.current_step,
-            question=next_question
-        ))
+        try:
+            update_log_context(step=session.current_step)
+            with span("ws.answer", session_id=session_id, step=session.current_step):
+                async with session_locks.hold(session_id):
+                    if session.status == AnalysisStatus.ROOT_FOUND:
+                        raise HTTPException(status_code=400, detail="تحلیل قبلاً تکمیل شده")
+                    # در حافظه، جلسه ذخیره‌شده همین شیء است؛ با خطا نسخه پیش از مرحله برگردانده می‌شود
+                    snapshot = session.model_copy(deep=True)
+                    try:
+                        async for kind, value in run_step(ai_service, session, request.answer, stream=True):
+                            if kind == "delta":
+                                await channel.send({"type": "delta", **value})
+                            else:
+                                response = value
+                        await session_store.save(session)
+                    except BaseException:
+                        session = snapshot
+                        await session_store.save(session)
+                        raise
+        except BaseException as e:
+            answer_cache.fail(key, e)
+            if isinstance(e, HTTPException):
+                await channel.send({"type": "error", "detail": e.detail})
+            elif isinstance(e, (TokenBudgetExceeded, AdmissionRejected)):
+                await channel.send({"type": "error", "detail": str(e)})
+            elif isinstance(e, Exception):
+                logger.error("Error in session_channel: %s", e, exc_info=e)
+                await channel.send({"type": "error", "detail": f"خطا: {str(e)}"})
+            else:
+                raise
+            return
         
-        return NextQuestionResponse(
+        answer_cache.complete(key, response)
+        await channel.send({"type": "result", "data": response.model_dump(mode="json")})
+        if session.status == AnalysisStatus.ROOT_FOUND:
+            await channel.close()
+    
+    step = session.steps[session.current_step - 1]
+    await channel.serve(handle, hello={
+        "type": "session",
+        "data": NextQuestionResponse(
             session_id=session.session_id,
             current_step=session.current_step,
-            question=next_question,
-            status=AnalysisStatus.IN_PROGRESS
-        )
-        
-    except Exception as e:
-        print(f"Error in submit_answer: {str(e)}")
-        print(f"Config: {config}")
-        raise HTTPException(status_code=500, detail=f"خطا: {str(e)}")
+            question=step.question,
+            status=session.status,
+            needs_clarification=session.status == AnalysisStatus.NEEDS_CLARIFICATION,
+            clarification_message=step.clarification_note
+        ).model_dump(mode="json")
+    })
+
+
+@app.post("/api/batch")
+async def batch_analysis(
+    request: Request,
+    concurrency: int = BATCH_CONCURRENCY,
+    batch_id: Optional[str] = None
+):
+    """
+    تحلیل دسته‌ای بدون تعامل
+    
+    بدنه درخواست JSONL است (هر سطر: problem و answers اختیاری) و نتایج به ترتیب
+    اتمام به صورت JSONL برگردانده می‌شوند. با batch_id نتایج روی سرور هم ذخیره
+    می‌شوند و ارسال دوباره همان دسته فقط موارد ناتمام را اجرا می‌کند.
+    """
+    body = (await request.body()).decode("utf-8")
+    try:
+        items = parse_batch_lines(body.splitlines())
+        output_path = batch_output_path(batch_id) if batch_id else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not items:
+        raise HTTPException(status_code=400, detail="دسته خالی است")
+    
+    ai_service = get_ai_service()
+    
+    async def lines():
+        async for record, progress in run_batch(ai_service, items, concurrency, output_path):
+            yield json.dumps({**record, "progress": progress}, ensure_ascii=False) + "\n"
+    
+    return StreamingResponse(lines(), media_type="application/x-ndjson", headers=SSE_HEADERS)
 
 
 @app.get("/api/session/{session_id}")
 async def get_session(session_id: str):
     """دریافت وضعیت جلسه"""
-    session = sessions.get(session_id)
+    session = await session_store.get(session_id)
     if not session:
         raise HTTPException(status_code=404, detail="جلسه یافت نشد")
-    return session
+    return session.model_dump(exclude={"messages"})
 
 
 @app.delete("/api/session/{session_id}")
 async def delete_session(session_id: str):
     """حذف جلسه"""
-    if session_id in sessions:
-        del sessions[session_id]
+    if await session_store.delete(session_id):
         return {"message": "جلسه حذف شد"}
     raise HTTPException(status_code=404, detail="جلسه یافت نشد")
 
 
+def require_archive():
+    archive = get_archive()
+    if archive is None:
+        raise HTTPException(status_code=404, detail="بایگانی تحلیل‌ها غیرفعال است")
+    return archive
+
+
+def require_archive_admin(x_admin_token: Optional[str] = Header(default=None)):
+    """مسیرهای مرور بایگانی فقط با ARCHIVE_ADMIN_TOKEN (هدر X-Admin-Token)"""
+    allowed = check_admin_token(x_admin_token)
+    if allowed is None:
+        raise HTTPException(status_code=404, detail="مرور بایگانی غیرفعال است")
+    if not allowed:
+        raise HTTPException(status_code=401, detail="توکن مدیریت نامعتبر است")
+    return require_archive()
+
+
+@app.get("/api/archive", response_model=ArchivePage)
+async def list_archive(
+    limit: int = 20,
+    before: Optional[int] = None,
+    archive=Depends(require_archive_admin)
+):
+    """فهرست تحلیل‌های کامل‌شده (جدیدترین اول، صفحه بعد با cursor)"""
+    items, next_cursor = await archive.recent(limit, before)
+    return ArchivePage(items=items, next_cursor=next_cursor)
+
+
+@app.get("/api/archive/search", response_model=ArchivePage)
+async def search_archive(
+    q: str,
+    limit: int = 20,
+    offset: int = 0,
+    archive=Depends(require_archive_admin)
+):
+    """جستجوی متن کامل در مشکل، علت ریشه‌ای و پیشنهادهای تحلیل‌های قبلی"""
+    limit = max(1, min(limit, ARCHIVE_MAX_PAGE))
+    items = await archive.search(q, limit, offset)
+    return ArchivePage(items=items, next_offset=offset + limit if len(items) == limit else None)
+
+
+@app.get("/api/archive/{session_id}")
+async def get_archived_analysis(session_id: str, archive=Depends(require_archive_admin)):
+    """جزئیات یک تحلیل بایگانی‌شده"""
+    session = await archive.get(session_id)
+    if not session:
+        raise HTTPException(status_code=404, detail="تحلیل در بایگانی یافت نشد")
+    return session.model_dump(exclude={"messages"})
+
+
+@app.post("/api/similar")
+async def similar_analyses(request: SimilarRequest):
+    """تحلیل‌های قبلی مشابه یک مشکل (بدون فراخوانی AI و بدون session_id)"""
+    items = await require_archive().similar(request.problem, request.limit)
+    return {"items": [item.summary() for item in items]}
+
+
 # Health check برای Docker و Render
 @app.get("/health")
 async def health_check():
     """Health check endpoint for Docker and deployment platforms"""
     return {
         "status": "healthy",
-        "sessions_count": len(sessions),
+        "sessions_count": await session_store.count(),
+        "session_store": session_store.stats(),
         "version": "1.0.0",
-        "ai_configured": bool(os.getenv("AI_API_KEY", ""))
+        "ai_configured": provider_registry.configured(),
+        "provider_config": get_registry_stats(),
+        "http_pool": get_pool_stats(),
+        "providers": get_health_snapshot(),
+        "ai_calls": get_call_stats(),
+        "response_cache": get_cache_stats(),
+        "admission": get_admission_stats(),
+        "retries": get_retry_stats(),
+        "routing": get_router_stats(),
+        "idempotency": get_idempotency_stats(),
+        "parsing": get_parse_stats(),
+        "token_budget": get_budget_stats(),
+        "websocket": get_websocket_stats(),
+        "static": get_static_stats(),
+        "speculation": get_speculation_stats(),
+        "archive": get_archive_stats(),
+        "screening": get_screening_stats(),
+        "tracing": get_tracing_stats(),
+        "logging": get_logging_stats()
     }
 
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """متریک‌ها در قالب Prometheus (با METRICS_DIR، جمع همه workerها)"""
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Metrics are disabled")
+    return PlainTextResponse(await render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 # Root endpoint for API documentation
 @app.get("/api")
 async def api_info():
@@ -304,10 +622,19 @@ async def api_info():
         "version": "1.0.0",
         "endpoints": {
             "start": "POST /api/start",
+            "start_stream": "POST /api/start/stream",
             "answer": "POST /api/answer",
+            "answer_stream": "POST /api/answer/stream",
+            "batch": "POST /api/batch",
             "session": "GET /api/session/{session_id}",
             "delete": "DELETE /api/session/{session_id}",
-            "health": "GET /health"
+            "session_channel": "WS /ws/session/{session_id}",
+            "archive": "GET /api/archive",
+            "archive_search": "GET /api/archive/search?q=",
+            "archived": "GET /api/archive/{session_id}",
+            "similar": "POST /api/similar",
+            "health": "GET /health",
+            "metrics": "GET /metrics"
         },
         "documentation": "https://github.com/your-repo/5whys-analyzer"
     }
\ No newline at end of file
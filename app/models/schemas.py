@@ -1,5 +1,5 @@
-from pydantic import BaseModel, Field
-from typing import Optional, List
+from pydantic import BaseModel, Field, computed_field, field_validator
+from typing import Optional, List, Dict, Any
 from enum import Enum
 
 
@@ -25,7 +25,9 @@ class StartAnalysisRequest(BaseModel):
 class AnswerRequest(BaseModel):
     """پاسخ کاربر به سوال"""
     session_id: str
-    answer: str = Field(..., min_length=3)
+    answer: str = Field(..., min_length=3, max_length=2000)
+    # ارسال دوباره با همان کلید، نتیجه قبلی را بدون فراخوانی دوباره AI برمی‌گرداند
+    idempotency_key: Optional[str] = Field(default=None, max_length=128)
 
 
 class WhyStep(BaseModel):
@@ -35,6 +37,29 @@ class WhyStep(BaseModel):
     answer: Optional[str] = None
     is_valid: bool = True
     clarification_note: Optional[str] = None
+    llm_calls: int = 0  # تعداد فراخوانی‌های AI برای پاسخ‌های این مرحله
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cached_tokens: int = 0  # توکن‌های ورودی که از کش prompt سرویس‌دهنده خوانده شدند
+
+
+class TokenBudget(BaseModel):
+    """مصرف توکن یک جلسه (مقادیر گزارش‌شده توسط provider یا تخمین محلی)"""
+    limit: int = 0  # 0 = بدون سقف
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    context_tokens: int = 0  # اندازه فعلی لاگ گفتگو (شمارش محلی)
+    compactions: int = 0
+
+    @computed_field
+    @property
+    def used(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    @computed_field
+    @property
+    def remaining(self) -> Optional[int]:
+        return max(0, self.limit - self.used) if self.limit else None
 
 
 class AnalysisSession(BaseModel):
@@ -46,6 +71,39 @@ class AnalysisSession(BaseModel):
     status: AnalysisStatus = AnalysisStatus.IN_PROGRESS
     root_cause: Optional[str] = None
     recommendations: Optional[List[str]] = None
+    messages: List[Dict[str, Any]] = []  # لاگ فقط‌افزودنی پیام‌های ارسال‌شده به AI
+    token_budget: TokenBudget = Field(default_factory=TokenBudget)
+
+
+class SimilarAnalysis(BaseModel):
+    """خلاصه عمومی یک تحلیل قبلی (بدون session_id تا جلسه کامل قابل خواندن نباشد)"""
+    created_at: float
+    problem: str
+    root_cause: str
+    recommendations: List[str] = []
+    total_steps: int
+    score: Optional[float] = None  # امتیاز ارتباط در جستجو (بزرگ‌تر = مرتبط‌تر)
+
+
+class ArchivedAnalysis(SimilarAnalysis):
+    """خلاصه یک تحلیل کامل‌شده در بایگانی (فقط مسیرهای مدیریتی)"""
+    session_id: str
+
+    def summary(self) -> SimilarAnalysis:
+        return SimilarAnalysis(**self.model_dump(exclude={"session_id"}))
+
+
+class ArchivePage(BaseModel):
+    """یک صفحه از فهرست یا نتایج جستجوی بایگانی"""
+    items: List[ArchivedAnalysis]
+    next_cursor: Optional[int] = None
+    next_offset: Optional[int] = None
+
+
+class SimilarRequest(BaseModel):
+    """یافتن تحلیل‌های قبلی مشابه بدون شروع تحلیل جدید"""
+    problem: str = Field(..., min_length=10)
+    limit: int = Field(default=5, ge=1, le=20)
 
 
 class NextQuestionResponse(BaseModel):
@@ -56,6 +114,8 @@ class NextQuestionResponse(BaseModel):
     status: AnalysisStatus
     needs_clarification: bool = False
     clarification_message: Optional[str] = None
+    # تحلیل‌های قبلی مشابه (فقط در پاسخ شروع تحلیل)
+    similar: Optional[List[SimilarAnalysis]] = None
 
 
 class FinalResultResponse(BaseModel):
@@ -65,4 +125,59 @@ class FinalResultResponse(BaseModel):
     steps: List[WhyStep]
     root_cause: str
     recommendations: List[str]
-    total_steps: int
\ No newline at end of file
+    total_steps: int
+
+
+class StepEvaluation(BaseModel):
+    """خروجی مدل برای ارزیابی پاسخ هر مرحله (مطابق STEP_RESPONSE_SCHEMA)"""
+    is_valid: bool = True
+    needs_clarification: bool = False
+    clarification_message: Optional[str] = None
+    is_root_found: bool = False
+    next_question: Optional[str] = None
+    root_cause: Optional[str] = None
+    recommendations: Optional[List[str]] = None
+
+    @field_validator("recommendations", mode="before")
+    @classmethod
+    def _single_recommendation(cls, value):
+        # بعضی مدل‌ها یک پیشنهاد را به‌صورت رشته برمی‌گردانند
+        return [value] if isinstance(value, str) else value
+
+
+class SummaryResult(BaseModel):
+    """خروجی مدل برای خلاصه نهایی (مطابق SUMMARY_RESPONSE_SCHEMA)"""
+    root_cause: str = Field(..., min_length=1)
+    recommendations: List[str] = []
+
+    @field_validator("recommendations", mode="before")
+    @classmethod
+    def _single_recommendation(cls, value):
+        if value is None:
+            return []
+        return [value] if isinstance(value, str) else value
+
+
+class BatchItem(BaseModel):
+    """یک سطر از ورودی تحلیل دسته‌ای (JSONL)"""
+    id: Optional[str] = None
+    problem: str = Field(..., min_length=10)
+    answers: List[str] = []  # پاسخ‌های ازپیش‌نوشته به ترتیب مراحل
+    summarize: bool = True  # اگر پاسخ‌ها تمام شد، علت ریشه‌ای از مراحل موجود استخراج شود
+
+
+class BatchResult(BaseModel):
+    """نتیجه یک مورد از تحلیل دسته‌ای"""
+    id: str
+    index: int
+    status: str  # یکی از AnalysisStatus یا error
+    problem: str
+    steps: List[WhyStep] = []
+    root_cause: Optional[str] = None
+    recommendations: List[str] = []
+    clarification_message: Optional[str] = None
+    error: Optional[str] = None
+    llm_calls: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    duration: float = 0.0
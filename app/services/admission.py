@@ -0,0 +1,297 @@
+import os
+import time
+import heapq
+import asyncio
+import itertools
+from email.utils import parsedate_to_datetime
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional
+
+from app.services.metrics import METRICS_ENABLED, admission_wait, record_error
+from app.services.token_budget import count_message_tokens
+
+# کنترل پذیرش درخواست‌ها به سرویس‌دهنده AI (0 یعنی بدون محدودیت)
+AI_MAX_IN_FLIGHT = int(os.getenv("AI_MAX_IN_FLIGHT", "8"))
+AI_RPM_LIMIT = float(os.getenv("AI_RPM_LIMIT", "0"))
+AI_TPM_LIMIT = float(os.getenv("AI_TPM_LIMIT", "0"))
+AI_QUEUE_MAX = int(os.getenv("AI_QUEUE_MAX", "100"))
+AI_QUEUE_TIMEOUT = float(os.getenv("AI_QUEUE_TIMEOUT", "30"))
+# توکن‌هایی که برای پاسخ مدل از بودجه TPM رزرو می‌شود (پس از دریافت usage اصلاح می‌شود)
+AI_TPM_COMPLETION_RESERVE = int(os.getenv("AI_TPM_COMPLETION_RESERVE", "300"))
+
+# اولویت هر نوع فراخوانی (عدد کمتر = اولویت بالاتر)؛ پایان تحلیل‌های جاری مقدم بر شروع تحلیل جدید است
+PRIORITIES = {
+    "summary": 0,
+    "repair": 0,
+    "next_step": 1,
+    "first_why": 2,
+    # خلاصه پیش‌دستانه نباید درخواست‌های واقعی را معطل کند
+    "speculative_summary": 3,
+}
+DEFAULT_PRIORITY = 1
+
+
+class AdmissionRejected(Exception):
+    """صف انتظار پر است یا زمان انتظار به پایان رسید"""
+
+
+def estimate_tokens(messages: list) -> int:
+    """تخمین تعداد توکن‌های یک درخواست (ورودی با شمارنده محلی + سهم خروجی)"""
+    return count_message_tokens(messages) + AI_TPM_COMPLETION_RESERVE
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """تبدیل هدر Retry-After (ثانیه یا تاریخ HTTP) به ثانیه"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """سطل توکن با نرخ پر شدن در دقیقه؛ ظرفیت برابر بودجه یک دقیقه است"""
+
+    def __init__(self, per_minute: float):
+        self.rate = per_minute / 60.0
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """ثانیه‌های لازم تا در دسترس بودن amount (درخواست بزرگ‌تر از ظرفیت با ظرفیت کامل پذیرفته می‌شود)"""
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float) -> None:
+        self._refill()
+        self.tokens -= min(amount, self.capacity)
+
+    def adjust(self, delta: float) -> None:
+        """اصلاح مصرف پس از دریافت مقدار واقعی (delta مثبت یعنی مصرف بیشتر از تخمین)"""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - delta)
+
+    def drain(self) -> None:
+        """خالی کردن سطل پس از دریافت 429 از سرویس‌دهنده"""
+        self._refill()
+        self.tokens = min(self.tokens, 0.0)
+
+
+class Slot:
+    """مجوز یک فراخوانی؛ مصرف واقعی توکن از طریق آن گزارش می‌شود"""
+
+    def __init__(self, controller: "AdmissionController", estimated_tokens: int):
+        self.controller = controller
+        self.estimated_tokens = estimated_tokens
+        self.wait_time = 0.0
+
+    def report_usage(self, usage: Dict[str, int]) -> None:
+        actual = usage.get("prompt_tokens", 0) + usage.get("completion_tokens", 0)
+        if actual and self.controller.tpm is not None:
+            self.controller.tpm.adjust(actual - self.estimated_tokens)
+            self.controller._dispatch()
+
+
+class AdmissionController:
+    """
+    کنترل پذیرش فراخوانی‌ها برای یک سرویس‌دهنده
+
+    حداکثر تعداد فراخوانی هم‌زمان، بودجه RPM/TPM و یک صف انتظار محدود و
+    اولویت‌دار را اعمال می‌کند تا نزدیک سقف سرویس‌دهنده بدون موج خطای 429 کار کنیم.
+    """
+
+    def __init__(
+        self,
+        max_in_flight: int = AI_MAX_IN_FLIGHT,
+        rpm: float = AI_RPM_LIMIT,
+        tpm: float = AI_TPM_LIMIT,
+        queue_max: int = AI_QUEUE_MAX,
+        queue_timeout: float = AI_QUEUE_TIMEOUT
+    ):
+        self.max_in_flight = max_in_flight
+        self.rpm = TokenBucket(rpm) if rpm > 0 else None
+        self.tpm = TokenBucket(tpm) if tpm > 0 else None
+        self.queue_max = queue_max
+        self.queue_timeout = queue_timeout
+
+        self.in_flight = 0
+        self._queue: List[tuple] = []
+        self._seq = itertools.count()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._paused_until = 0.0
+
+        self.admitted = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.throttled = 0
+        self.max_queue_depth = 0
+        self._wait_totals: Dict[str, List[float]] = {}  # purpose -> [تعداد، مجموع، بیشینه]
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(1 for entry in self._queue if not entry[3].done())
+
+    def _has_capacity(self) -> bool:
+        return self.max_in_flight <= 0 or self.in_flight < self.max_in_flight
+
+    def _rate_wait(self, tokens: int) -> float:
+        wait = self._paused_until - time.monotonic()
+        if self.rpm is not None:
+            wait = max(wait, self.rpm.wait_time(1))
+        if self.tpm is not None:
+            wait = max(wait, self.tpm.wait_time(tokens))
+        return max(wait, 0.0)
+
+    def _admit(self, tokens: int) -> None:
+        self.in_flight += 1
+        self.admitted += 1
+        if self.rpm is not None:
+            self.rpm.consume(1)
+        if self.tpm is not None:
+            self.tpm.consume(tokens)
+
+    def _schedule(self, delay: float) -> None:
+        if self._timer is not None:
+            return
+        loop = asyncio.get_running_loop()
+
+        def wake():
+            self._timer = None
+            self._dispatch()
+
+        self._timer = loop.call_later(delay, wake)
+
+    def _dispatch(self) -> None:
+        """پذیرش منتظرها به ترتیب اولویت تا جایی که ظرفیت و بودجه اجازه دهد"""
+        while self._queue and self._has_capacity():
+            _, _, tokens, future = self._queue[0]
+            if future.done():
+                heapq.heappop(self._queue)
+                continue
+            wait = self._rate_wait(tokens)
+            if wait > 0:
+                self.throttled += 1
+                self._schedule(wait)
+                return
+            heapq.heappop(self._queue)
+            self._admit(tokens)
+            future.set_result(None)
+
+    def _record_wait(self, purpose: str, waited: float) -> None:
+        if METRICS_ENABLED:
+            admission_wait.observe(waited, purpose=purpose)
+        totals = self._wait_totals.setdefault(purpose, [0, 0.0, 0.0])
+        totals[0] += 1
+        totals[1] += waited
+        totals[2] = max(totals[2], waited)
+
+    async def acquire(self, purpose: str, tokens: int) -> float:
+        """انتظار برای مجوز؛ مدت انتظار را برمی‌گرداند"""
+        if not self._queue and self._has_capacity() and self._rate_wait(tokens) == 0:
+            self._admit(tokens)
+            self._record_wait(purpose, 0.0)
+            return 0.0
+
+        if self.queue_depth >= self.queue_max:
+            self.rejected += 1
+            record_error("admission", "queue_full")
+            raise AdmissionRejected("سرویس AI در حال حاضر بیش از حد مشغول است. لطفاً چند لحظه دیگر دوباره تلاش کنید.")
+
+        future = asyncio.get_running_loop().create_future()
+        priority = PRIORITIES.get(purpose, DEFAULT_PRIORITY)
+        heapq.heappush(self._queue, (priority, next(self._seq), tokens, future))
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+
+        started = time.monotonic()
+        self._dispatch()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            if not future.done():
+                future.cancel()
+                self.timeouts += 1
+                record_error("admission", "queue_timeout")
+                raise AdmissionRejected("زمان انتظار در صف سرویس AI به پایان رسید. لطفاً دوباره تلاش کنید.")
+        except asyncio.CancelledError:
+            # اگر مجوز همزمان با لغو صادر شده باشد، آن را آزاد می‌کنیم
+            if future.done() and not future.cancelled():
+                self.release()
+            else:
+                future.cancel()
+            raise
+
+        waited = time.monotonic() - started
+        self._record_wait(purpose, waited)
+        return waited
+
+    def release(self) -> None:
+        self.in_flight -= 1
+        self._dispatch()
+
+    def throttle(self, seconds: float) -> None:
+        """توقف موقت پذیرش پس از 429 (بر اساس Retry-After)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        if self.rpm is not None:
+            self.rpm.drain()
+
+    @asynccontextmanager
+    async def slot(self, purpose: str, messages: list) -> AsyncIterator[Slot]:
+        tokens = estimate_tokens(messages) if self.tpm is not None else 0
+        slot = Slot(self, tokens)
+        slot.wait_time = await self.acquire(purpose, tokens)
+        try:
+            yield slot
+        finally:
+            self.release()
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "queue_depth": self.queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+            "throttled": self.throttled,
+            "rpm_available": round(self.rpm.tokens, 1) if self.rpm is not None else None,
+            "tpm_available": round(self.tpm.tokens, 1) if self.tpm is not None else None,
+            "wait": {
+                purpose: {
+                    "count": count,
+                    "avg_seconds": round(total / count, 4) if count else 0.0,
+                    "max_seconds": round(peak, 4),
+                }
+                for purpose, (count, total, peak) in self._wait_totals.items()
+            },
+        }
+
+
+# کنترل‌کننده هر سرویس‌دهنده (کلید: base_url)
+_controllers: Dict[str, AdmissionController] = {}
+
+
+def get_admission_controller(base_url: str) -> AdmissionController:
+    controller = _controllers.get(base_url)
+    if controller is None:
+        controller = AdmissionController()
+        _controllers[base_url] = controller
+    return controller
+
+
+def get_admission_stats() -> dict:
+    return {base_url: controller.stats() for base_url, controller in _controllers.items()}
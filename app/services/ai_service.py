@@ -1,21 +1,128 @@
 import httpx
 import json
-from typing import Tuple, List, Optional
+import asyncio
+from typing import Tuple, List, Optional, AsyncIterator
 from app.models.schemas import AIConfig, WhyStep
-from dotenv import load_dotenv
+from app.services.config import env_bool
+from app.services.http_client import get_http_client
+from app.services.provider_health import record_provider_result, is_provider_available, acquire_provider
+from app.services.streaming import iter_sse_json, JsonFieldStreamer
+from app.services.call_stats import record_call, record_usage, parse_usage
+from app.services.response_cache import get_first_why_cache
+from app.services.admission import get_admission_controller, parse_retry_after, estimate_tokens
+from app.services.provider_router import provider_router
+from app.services.metrics import RequestTrace, record_error
+from app.services.tracing import span, current_span
+from app.services.response_parser import ResponseParseError, parse_step, parse_summary, record_parse
+from app.services.token_budget import TokenBudgetManager, COMPLETION_TOKENS, digest_steps, usage_or_estimate
+from app.services.retry import (
+    retry_policy, RETRYABLE_STATUS, is_retryable_error, request_was_sent,
+    record_retry, record_outcome
+)
+from app.services.log_pipeline import log_payload, update_log_context
 import os
+import time
+import logging
 
-# Load environment variables
-load_dotenv()
+logger = logging.getLogger(__name__)
 
-def get_default_ai_config() -> AIConfig:
-    """دریافت تنظیمات پیش‌فرض AI از .env"""
-    return AIConfig(
-        base_url=os.getenv("AI_BASE_URL", "https://api.openai.com/v1"),
-        api_key=os.getenv("AI_API_KEY", ""),
-        model_id=os.getenv("AI_MODEL_ID", "gpt-3.5-turbo")
-    )
+# حالت خروجی ساختاریافته: json_schema | json_object | off
+AI_RESPONSE_FORMAT = os.getenv("AI_RESPONSE_FORMAT", "json_schema")
 
+# درج نشانه cache_control برای کش prompt: auto (فقط مدل‌های Anthropic) | on | off
+AI_PROMPT_CACHE = os.getenv("AI_PROMPT_CACHE", "auto")
+
+# درخواست گزارش مصرف توکن در حالت stream
+AI_STREAM_USAGE = env_bool("AI_STREAM_USAGE", True)
+
+# یک فراخوانی کوتاه برای اصلاح پاسخی که به JSON معتبر تبدیل نشد (به جای پاسخ پیش‌فرض)
+AI_PARSE_REPAIR = env_bool("AI_PARSE_REPAIR", True)
+PARSE_REPAIR_MAX_CHARS = 4000
+
+# نسخه prompt اولین سوال؛ با تغییر prompt باید افزایش یابد تا کش قبلی استفاده نشود
+FIRST_WHY_PROMPT_VERSION = "1"
+
+# سرویس‌دهنده‌هایی که پارامترهای اختیاری (response_format و stream_options) را رد کرده‌اند
+_optional_params_unsupported = set()
+
+# نام‌هایی که در متن خطای 400 نشانه رد شدن هر پارامتر اختیاری‌اند
+_OPTIONAL_PARAM_NAMES = {
+    "response_format": ("response_format", "json_schema", "json_object"),
+    "stream_options": ("stream_options", "include_usage"),
+}
+
+# prompt سیستمی ثابت گفتگوی تحلیل؛ تغییر نکردن آن شرط استفاده از کش prefix است
+STEP_SYSTEM_PROMPT = """شما متخصص تحلیل 5 Whys هستید.
+
+وظایف شما:
+1. بررسی کنید پاسخ کاربر منطقی و مرتبط با سوال است
+2. تشخیص دهید آیا به ریشه اصلی مشکل رسیده‌ایم
+3. اگر پاسخ نامناسب است، درخواست توضیح بیشتر کنید
+4. اگر به ریشه نرسیده‌ایم، سوال چرای بعدی را بپرسید
+5. اگر به ریشه رسیده‌ایم، root_cause و 3-5 پیشنهاد عملی را در همین پاسخ بدهید
+
+پاسخ را به فرمت JSON بدهید:
+{
+    "is_valid": true/false,
+    "needs_clarification": true/false,
+    "clarification_message": "پیام توضیحی اگر نیاز است",
+    "is_root_found": true/false,
+    "next_question": "سوال بعدی اگر ریشه پیدا نشده",
+    "root_cause": "علت ریشه‌ای اگر پیدا شد",
+    "recommendations": ["پیشنهاد 1", "پیشنهاد 2"] // اگر ریشه پیدا شد
+}"""
+
+REPAIR_PROMPT = """متن زیر باید یک شیء JSON مطابق این اسکیما باشد ولی قابل پارس نیست یا فیلدهای لازم را ندارد:
+{schema}
+
+فقط JSON اصلاح‌شده را برگردان، بدون هیچ توضیح اضافه. محتوای متن را تغییر نده."""
+
+SUMMARY_REQUEST = """تحلیل به پایان رسیده است. بر اساس گفتگوی بالا:
+1. علت ریشه‌ای را مشخص کن
+2. 3-5 پیشنهاد عملی برای حل ارائه بده
+
+پاسخ JSON:
+{
+    "root_cause": "علت ریشه‌ای",
+    "recommendations": ["پیشنهاد 1", "پیشنهاد 2", ...]
+}"""
+
+# اسکیمای خروجی ارزیابی هر مرحله؛ در مرحله نهایی خلاصه هم در همین پاسخ می‌آید
+STEP_RESPONSE_SCHEMA = {
+    "name": "why_step_evaluation",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "is_valid": {"type": "boolean"},
+            "needs_clarification": {"type": "boolean"},
+            "clarification_message": {"type": ["string", "null"]},
+            "is_root_found": {"type": "boolean"},
+            "next_question": {"type": ["string", "null"]},
+            "root_cause": {"type": ["string", "null"]},
+            "recommendations": {"type": ["array", "null"], "items": {"type": "string"}}
+        },
+        "required": [
+            "is_valid", "needs_clarification", "clarification_message",
+            "is_root_found", "next_question", "root_cause", "recommendations"
+        ],
+        "additionalProperties": False
+    }
+}
+
+SUMMARY_RESPONSE_SCHEMA = {
+    "name": "why_summary",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "root_cause": {"type": "string"},
+            "recommendations": {"type": "array", "items": {"type": "string"}}
+        },
+        "required": ["root_cause", "recommendations"],
+        "additionalProperties": False
+    }
+}
 
 def validate_openrouter_config(config: AIConfig) -> bool:
     """بررسی صحت تنظیمات OpenRouter"""
@@ -62,8 +169,6 @@ def get_openrouter_headers(api_key: str) -> dict:
 
 async def test_openrouter_connection(api_key: str, base_url: str, model_id: str) -> bool:
     """تست اتصال به OpenRouter"""
-    import httpx
-    
     headers = get_openrouter_headers(api_key)
     payload = {
         "model": model_id,
@@ -72,33 +177,36 @@ async def test_openrouter_connection(api_key: str, base_url: str, model_id: str)
     }
     
     try:
-        async with httpx.AsyncClient(timeout=10) as client:
-            response = await client.post(
-                f"{base_url}/chat/completions",
-                headers=headers,
-                json=payload
-            )
-            print(f"OpenRouter test response: {response.status_code}")
-            print(f"OpenRouter test response text: {response.text}")
+        client = get_http_client()
+        response = await client.post(
+            f"{base_url}/chat/completions",
+            headers=headers,
+            json=payload,
+            timeout=10
+        )
+        logger.info(
+            "OpenRouter test response: %d", response.status_code,
+            extra={"response": log_payload(response.text)}
+        )
+        
+        # بررسی کدهای وضعیت مختلف
+        if response.status_code == 200:
+            return True
+        elif response.status_code == 401:
+            logger.warning("OpenRouter 401 error: Authentication failed")
+            return False
+        elif response.status_code == 400:
+            logger.warning("OpenRouter 400 error: Bad request")
+            return False
+        elif response.status_code == 429:
+            logger.warning("OpenRouter 429 error: Rate limit exceeded")
+            return False
+        else:
+            logger.warning("OpenRouter unexpected status: %d", response.status_code)
+            return False
             
-            # بررسی کدهای وضعیت مختلف
-            if response.status_code == 200:
-                return True
-            elif response.status_code == 401:
-                print("OpenRouter 401 error: Authentication failed")
-                return False
-            elif response.status_code == 400:
-                print("OpenRouter 400 error: Bad request")
-                return False
-            elif response.status_code == 429:
-                print("OpenRouter 429 error: Rate limit exceeded")
-                return False
-            else:
-                print(f"OpenRouter unexpected status: {response.status_code}")
-                return False
-                
     except Exception as e:
-        print(f"OpenRouter test failed: {e}")
+        logger.warning("OpenRouter test failed: %s", e)
         return False
 
 
@@ -116,65 +224,411 @@ def get_openrouter_model_list() -> list:
 class AIService:
     """سرویس ارتباط با AI"""
     
-    def __init__(self, config: AIConfig):
+    def __init__(self, config: AIConfig, fallbacks: Optional[List[AIConfig]] = None):
         self.base_url = config.base_url.rstrip('/')
         self.api_key = config.api_key
         self.model_id = config.model_id
-        self.timeout = 30.0
-    
-    async def _call_ai(self, messages: list) -> str:
-        """فراخوانی API هوش مصنوعی"""
-        # بررسی صحت کلید API
-        if not validate_api_key(self.api_key):
-            raise Exception("کلید API نامعتبر است. لطفاً یک کلید API معتبر وارد کنید.")
-        
-        # برای OpenRouter از هدرهای خاص استفاده می‌کنیم
+        # کلید و هدرها یک بار هنگام ساخت بررسی و آماده می‌شوند (نمونه بین درخواست‌ها مشترک است)
+        self.key_valid = validate_api_key(self.api_key)
         if "openrouter" in self.base_url.lower():
-            headers = get_openrouter_headers(self.api_key)
+            # برای OpenRouter از هدرهای خاص استفاده می‌کنیم
+            self.headers = get_openrouter_headers(self.api_key)
         else:
-            headers = {
+            self.headers = {
                 "Authorization": f"Bearer {self.api_key}",
                 "Content-Type": "application/json"
             }
+        # سرویس‌دهنده اصلی و جایگزین‌ها به ترتیب تنظیمات؛ مسیریاب از بین آن‌ها انتخاب می‌کند
+        self.peers = [self] + [AIService(fallback) for fallback in fallbacks or []]
+        self.budget = TokenBudgetManager(self)
+    
+    def _response_format(self, schema: Optional[dict]) -> Optional[dict]:
+        """انتخاب response_format مناسب برای خروجی JSON (در صورت پشتیبانی سرویس‌دهنده)"""
+        if schema is None or AI_RESPONSE_FORMAT == "off":
+            return None
+        if self.base_url in _optional_params_unsupported:
+            return None
+        if AI_RESPONSE_FORMAT == "json_object":
+            return {"type": "json_object"}
+        return {"type": "json_schema", "json_schema": schema}
+    
+    def _build_request(
+        self,
+        messages: list,
+        stream: bool = False,
+        response_format: Optional[dict] = None,
+        optional_params: bool = True
+    ) -> Tuple[dict, dict]:
+        """ساخت هدرها و بدنه درخواست chat/completions"""
+        # بررسی صحت کلید API
+        if not self.key_valid:
+            raise Exception("کلید API نامعتبر است. لطفاً یک کلید API معتبر وارد کنید.")
         
         payload = {
             "model": self.model_id,
-            "messages": messages,
+            "messages": self._apply_prompt_cache(messages),
             "temperature": 0.7,
-            "max_tokens": 1000
+            "max_tokens": COMPLETION_TOKENS
         }
+        if stream:
+            payload["stream"] = True
+            if optional_params and AI_STREAM_USAGE and self.base_url not in _optional_params_unsupported:
+                payload["stream_options"] = {"include_usage": True}
+        if response_format:
+            payload["response_format"] = response_format
         
-        # برای OpenRouter ممکن است نیاز به تنظیمات اضافی باشد
-        if "openrouter" in self.base_url.lower():
-            # برخی مدل‌های OpenRouter ممکن است نیاز به تنظیمات خاص داشته باشند
-            pass
-        
-        async with httpx.AsyncClient(timeout=self.timeout) as client:
-            response = await client.post(
-                f"{self.base_url}/chat/completions",
-                headers=headers,
-                json=payload
+        return self.headers, payload
+    
+    def _check_response(self, response: httpx.Response) -> None:
+        """گزارش وضعیت به circuit breaker و تبدیل خطاهای سرویس‌دهنده به پیام کاربر"""
+        # خطاهای 400 و 429 خرابی سرویس نیستند
+        if response.status_code == 401 or response.status_code >= 500:
+            record_provider_result(self.base_url, False, f"HTTP {response.status_code}")
+        elif response.status_code < 400:
+            record_provider_result(self.base_url, True)
+        
+        # برای خطاهای احتمالی OpenRouter
+        if response.status_code == 401:
+            logger.warning("%s 401 error", self.base_url, extra={"response": log_payload(response.text)})
+            raise Exception("خطای احراز هویت OpenRouter. لطفاً کلید API را بررسی کنید.")
+        elif response.status_code == 400:
+            error_data = response.json()
+            logger.warning("%s 400 error", self.base_url, extra={"response": log_payload(response.text)})
+            raise Exception(f"درخواست نامعتبر به OpenRouter: {error_data.get('error', {}).get('message', 'Unknown error')}")
+        elif response.status_code == 429:
+            # پذیرش درخواست‌های بعدی تا پایان Retry-After متوقف می‌شود
+            retry_after = parse_retry_after(response.headers.get("retry-after"))
+            get_admission_controller(self.base_url).throttle(retry_after or 1.0)
+            logger.warning("%s 429 error", self.base_url, extra={"response": log_payload(response.text)})
+            raise Exception("محدودیت نرخ درخواست به OpenRouter. لطفاً کمی صبر کنید.")
+        
+        response.raise_for_status()
+    
+    def _uses_prompt_cache(self) -> bool:
+        if AI_PROMPT_CACHE == "on":
+            return True
+        if AI_PROMPT_CACHE != "auto":
+            return False
+        model = self.model_id.lower()
+        return "claude" in model or "anthropic" in model
+    
+    def _apply_prompt_cache(self, messages: list) -> list:
+        """
+        علامت‌گذاری انتهای prefix ثابت گفتگو با cache_control
+        
+        سرویس‌دهنده‌هایی مثل OpenAI و DeepSeek prefix را خودکار کش می‌کنند؛
+        برای Anthropic باید نقطه‌های کش صریحاً مشخص شوند.
+        """
+        if not self._uses_prompt_cache():
+            return messages
+        
+        def with_cache(message: dict) -> dict:
+            content = message["content"]
+            if isinstance(content, str):
+                content = [{"type": "text", "text": content}]
+            content = [dict(part) for part in content]
+            content[-1]["cache_control"] = {"type": "ephemeral"}
+            return {**message, "content": content}
+        
+        marked = list(messages)
+        # prompt سیستمی و آخرین پیامِ قبل از پیام جدید کاربر
+        breakpoints = {0}
+        if len(marked) > 2:
+            breakpoints.add(len(marked) - 2)
+        for index in breakpoints:
+            marked[index] = with_cache(marked[index])
+        return marked
+    
+    def _rejects_optional_params(self, response: httpx.Response, payload: dict) -> bool:
+        """
+        آیا خطای 400 مربوط به پارامترهای اختیاری همین درخواست است؟
+
+        فقط وقتی متن خطا نام پارامتر را آورده باشد؛ در این حالت درخواست یک بار بدون
+        آن‌ها تکرار می‌شود و اگر آن تکرار موفق شد برای فراخوانی‌های بعدی غیرفعال می‌شوند.
+        """
+        if response.status_code != 400:
+            return False
+        body = response.text.lower()
+        rejected = any(
+            name in body
+            for param, names in _OPTIONAL_PARAM_NAMES.items() if param in payload
+            for name in names
+        )
+        if rejected:
+            logger.info("Optional parameters rejected by %s; retrying without them", self.base_url)
+        return rejected
+    
+    def _disable_optional_params(self) -> None:
+        """تکرار بدون پارامترهای اختیاری موفق بود؛ از این به بعد فرستاده نمی‌شوند"""
+        if self.base_url not in _optional_params_unsupported:
+            logger.info("Disabling optional parameters for %s", self.base_url)
+            _optional_params_unsupported.add(self.base_url)
+    
+    def _retry_delay(
+        self,
+        attempt: int,
+        deadline: float,
+        error: Optional[Exception] = None,
+        response: Optional[httpx.Response] = None,
+        retries: bool = True
+    ) -> Optional[float]:
+        """مدت انتظار پیش از تکرار یک تلاش ناموفق؛ None یعنی خطا به کاربر برگردد"""
+        # وقتی سرویس‌دهنده جایگزین وجود دارد، failover سریع‌تر از تکرار است
+        if not retries:
+            return None
+        # اگر circuit breaker باز شده، تکرار فقط بار اضافه است
+        if not is_provider_available(self.base_url):
+            return None
+        if error is not None:
+            if not is_retryable_error(error):
+                return None
+            return retry_policy.next_delay(attempt, deadline)
+        if response is None or response.status_code not in RETRYABLE_STATUS:
+            return None
+        retry_after = parse_retry_after(response.headers.get("retry-after"))
+        return retry_policy.next_delay(attempt, deadline, retry_after)
+    
+    async def _call_ai(
+        self,
+        messages: list,
+        purpose: str = "generic",
+        schema: Optional[dict] = None
+    ) -> str:
+        """فراخوانی API هوش مصنوعی از طریق مسیریاب سرویس‌دهنده‌ها (failover و hedge)"""
+        return await provider_router.call(
+            self.peers,
+            lambda peer, last: peer._call_provider(messages, purpose, schema, retries=last)
+        )
+    
+    async def _stream_ai(
+        self,
+        messages: list,
+        purpose: str = "generic",
+        schema: Optional[dict] = None
+    ) -> AsyncIterator[str]:
+        """نسخه stream از _call_ai؛ انتخاب سرویس‌دهنده تا رسیدن اولین تکه متن انجام می‌شود"""
+        async for chunk in provider_router.stream(
+            self.peers,
+            lambda peer, last: peer._stream_provider(messages, purpose, schema, retries=last)
+        ):
+            yield chunk
+    
+    async def _call_provider(
+        self,
+        messages: list,
+        purpose: str = "generic",
+        schema: Optional[dict] = None,
+        retries: bool = True
+    ) -> str:
+        """فراخوانی همین سرویس‌دهنده (خطاهای گذرا طبق retry_policy تکرار می‌شوند)"""
+        with span("llm.call", provider=self.base_url, model=self.model_id, purpose=purpose):
+            started = time.perf_counter()
+            content = await self._post_with_retries(messages, purpose, schema, retries)
+            self._log_call(purpose, started, content)
+            return content
+    
+    def _log_call(self, purpose: str, started: float, content: str) -> None:
+        """تاخیر سرویس‌دهنده در context لاگ درخواست و (در سطح DEBUG) نمونه پاسخ"""
+        latency = round(time.perf_counter() - started, 4)
+        update_log_context(provider=self.base_url, provider_latency=latency)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "AI call completed",
+                extra={"purpose": purpose, "model": self.model_id, "response": log_payload(content)}
             )
+    
+    async def _post_with_retries(
+        self,
+        messages: list,
+        purpose: str,
+        schema: Optional[dict],
+        retries: bool,
+        optional_params: bool = True
+    ) -> str:
+        response_format = self._response_format(schema) if optional_params else None
+        headers, payload = self._build_request(messages, response_format=response_format)
+        
+        # استفاده از کلاینت مشترک برای بهره‌گیری از اتصال‌های keep-alive
+        client = get_http_client()
+        deadline = retry_policy.start()
+        attempt = 0
+        while True:
+            attempt += 1
+            error = None
+            # انتظار برای مجوز کنترل پذیرش (حداکثر هم‌زمانی، بودجه RPM/TPM و اولویت)
+            async with get_admission_controller(self.base_url).slot(purpose, messages) as slot:
+                acquire_provider(self.base_url)
+                record_call(purpose)
+                trace = RequestTrace(self.base_url, purpose)
+                try:
+                    response = await client.post(
+                        f"{self.base_url}/chat/completions",
+                        headers=headers,
+                        json=payload,
+                        timeout=retry_policy.attempt_timeout(client.timeout, deadline),
+                        extensions=trace.extensions
+                    )
+                except httpx.HTTPError as e:
+                    record_provider_result(self.base_url, False, f"{type(e).__name__}: {e}")
+                    record_error("llm", type(e).__name__)
+                    error = e
+                finally:
+                    trace.finish()
+            
+            # انتظار پیش از تکرار بیرون از slot انجام می‌شود تا ظرفیت دیگران را نگیرد
+            if error is not None:
+                delay = self._retry_delay(attempt, deadline, error=error, retries=retries)
+                wasted_tokens = estimate_tokens(messages) if request_was_sent(error) else 0
+                if delay is None:
+                    record_outcome(purpose, attempt, False, wasted_tokens)
+                    raise error
+                record_retry(purpose, delay, wasted_tokens)
+                await asyncio.sleep(delay)
+                continue
             
-            # برای خطاهای احتمالی OpenRouter
-            if response.status_code == 401:
-                print(f"OpenRouter 401 error: {response.text}")
-                raise Exception("خطای احراز هویت OpenRouter. لطفاً کلید API را بررسی کنید.")
-            elif response.status_code == 400:
-                error_data = response.json()
-                print(f"OpenRouter 400 error: {error_data}")
-                raise Exception(f"درخواست نامعتبر به OpenRouter: {error_data.get('error', {}).get('message', 'Unknown error')}")
-            elif response.status_code == 429:
-                print(f"OpenRouter 429 error: {response.text}")
-                raise Exception("محدودیت نرخ درخواست به OpenRouter. لطفاً کمی صبر کنید.")
+            if self._rejects_optional_params(response, payload):
+                return await self._post_with_retries(messages, purpose, schema, retries, optional_params=False)
             
-            response.raise_for_status()
-            data = response.json()
-            return data["choices"][0]["message"]["content"]
+            try:
+                self._check_response(response)
+            except Exception:
+                record_error("llm", f"http_{response.status_code}")
+                delay = self._retry_delay(attempt, deadline, response=response, retries=retries)
+                if delay is None:
+                    record_outcome(purpose, attempt, False)
+                    raise
+                record_retry(purpose, delay)
+                await asyncio.sleep(delay)
+                continue
+            break
+        
+        if not optional_params:
+            self._disable_optional_params()
+        record_outcome(purpose, attempt, True)
+        data = response.json()
+        content = data["choices"][0]["message"]["content"]
+        usage = usage_or_estimate(parse_usage(data), messages, content or "")
+        slot.report_usage(usage)
+        record_usage(purpose, usage)
+        current_span().set(attempts=attempt, queue_wait=round(slot.wait_time, 4), **usage)
+        return content
     
-    async def generate_first_why(self, problem: str) -> str:
-        """تولید اولین سوال چرا"""
-        messages = [
+    async def _stream_provider(
+        self,
+        messages: list,
+        purpose: str = "generic",
+        schema: Optional[dict] = None,
+        retries: bool = True
+    ) -> AsyncIterator[str]:
+        """
+        فراخوانی همین سرویس‌دهنده در حالت stream؛ تکه‌های متن را به محض رسیدن برمی‌گرداند
+        
+        تکرار فقط تا پیش از ارسال اولین تکه ممکن است؛ پس از آن خطا به فراخواننده می‌رسد.
+        """
+        with span("llm.stream", provider=self.base_url, model=self.model_id, purpose=purpose):
+            started = time.perf_counter()
+            parts = []
+            async for content in self._stream_with_retries(messages, purpose, schema, retries):
+                parts.append(content)
+                yield content
+            self._log_call(purpose, started, "".join(parts))
+    
+    async def _stream_with_retries(
+        self,
+        messages: list,
+        purpose: str,
+        schema: Optional[dict],
+        retries: bool,
+        optional_params: bool = True
+    ) -> AsyncIterator[str]:
+        response_format = self._response_format(schema) if optional_params else None
+        headers, payload = self._build_request(
+            messages, stream=True, response_format=response_format, optional_params=optional_params
+        )
+        
+        client = get_http_client()
+        deadline = retry_policy.start()
+        attempt = 0
+        while True:
+            attempt += 1
+            retry_without_format = False
+            yielded = False
+            delay = None
+            wasted_tokens = 0
+            async with get_admission_controller(self.base_url).slot(purpose, messages) as slot:
+                acquire_provider(self.base_url)
+                record_call(purpose)
+                trace = RequestTrace(self.base_url, purpose)
+                try:
+                    async with client.stream(
+                        "POST",
+                        f"{self.base_url}/chat/completions",
+                        headers=headers,
+                        json=payload,
+                        timeout=retry_policy.attempt_timeout(client.timeout, deadline),
+                        extensions=trace.extensions
+                    ) as response:
+                        if response.status_code >= 400:
+                            await response.aread()
+                        retry_without_format = self._rejects_optional_params(response, payload)
+                        if not retry_without_format:
+                            try:
+                                self._check_response(response)
+                            except Exception:
+                                record_error("llm", f"http_{response.status_code}")
+                                delay = self._retry_delay(attempt, deadline, response=response, retries=retries)
+                                if delay is None:
+                                    record_outcome(purpose, attempt, False)
+                                    raise
+                        
+                        if not retry_without_format and delay is None:
+                            if not optional_params:
+                                self._disable_optional_params()
+                            usage = None
+                            parts = []
+                            async for event in iter_sse_json(response):
+                                # آخرین رویداد (با choices خالی) مصرف توکن را گزارش می‌کند
+                                if event.get("usage"):
+                                    usage = parse_usage(event)
+                                choices = event.get("choices") or []
+                                if not choices:
+                                    continue
+                                delta = choices[0].get("delta") or {}
+                                content = delta.get("content")
+                                if content:
+                                    yielded = True
+                                    parts.append(content)
+                                    yield content
+                            usage = usage_or_estimate(usage or {}, messages, "".join(parts))
+                            slot.report_usage(usage)
+                            record_usage(purpose, usage)
+                            current_span().set(**usage)
+                except httpx.RequestError as e:
+                    record_provider_result(self.base_url, False, f"{type(e).__name__}: {e}")
+                    record_error("llm", type(e).__name__)
+                    delay = None if yielded else self._retry_delay(attempt, deadline, error=e, retries=retries)
+                    if request_was_sent(e):
+                        wasted_tokens = estimate_tokens(messages)
+                    if delay is None:
+                        record_outcome(purpose, attempt, False, wasted_tokens)
+                        raise
+                finally:
+                    trace.finish()
+            
+            if delay is None:
+                break
+            record_retry(purpose, delay, wasted_tokens)
+            await asyncio.sleep(delay)
+        
+        if retry_without_format:
+            async for content in self._stream_with_retries(messages, purpose, schema, retries, optional_params=False):
+                yield content
+            return
+        record_outcome(purpose, attempt, True)
+        current_span().set(attempts=attempt, queue_wait=round(slot.wait_time, 4))
+    
+    def _first_why_messages(self, problem: str) -> list:
+        return [
             {
                 "role": "system",
                 "content": """شما یک متخصص تحلیل ریشه‌ای مشکلات با تکنیک 5 Whys هستید.
@@ -191,28 +645,120 @@ class AIService:
                 "content": f"مشکل: {problem}\n\nاولین سوال چرا را بپرس:"
             }
         ]
+    
+    def _first_why_cache_key(self, problem: str) -> Optional[str]:
+        cache = get_first_why_cache()
+        if cache is None:
+            return None
+        return cache.make_key(problem, FIRST_WHY_PROMPT_VERSION, self.model_id)
+    
+    async def generate_first_why(self, problem: str) -> str:
+        """تولید اولین سوال چرا"""
+        with span("ai.generate_first_why") as current:
+            cache = get_first_why_cache()
+            cache_key = self._first_why_cache_key(problem)
+            if cache is not None:
+                cached = await cache.get(cache_key, problem)
+                current.set(cache_hit=cached is not None)
+                if cached is not None:
+                    return cached
+            
+            started = time.monotonic()
+            question = await self._call_ai(self._first_why_messages(problem), purpose="first_why")
+            if cache is not None and question.strip():
+                await cache.set(cache_key, question, problem, latency=time.monotonic() - started)
+            return question
+    
+    async def stream_first_why(self, problem: str) -> AsyncIterator[Tuple[str, str]]:
+        """
+        نسخه stream از generate_first_why
+        
+        رویدادهای ("delta", متن جزئی) و در پایان ("result", سوال کامل) تولید می‌کند.
+        """
+        cache = get_first_why_cache()
+        cache_key = self._first_why_cache_key(problem)
+        if cache is not None:
+            cached = await cache.get(cache_key, problem)
+            if cached is not None:
+                yield "delta", cached
+                yield "result", cached
+                return
+        
+        started = time.monotonic()
+        parts = []
+        async for chunk in self._stream_ai(self._first_why_messages(problem), purpose="first_why"):
+            parts.append(chunk)
+            yield "delta", chunk
+        question = "".join(parts)
+        if cache is not None and question.strip():
+            await cache.set(cache_key, question, problem, latency=time.monotonic() - started)
+        yield "result", question
+    
+    def start_conversation(self, problem: str, first_question: str) -> List[dict]:
+        """
+        ساخت لاگ پیام‌های جلسه (فقط‌افزودنی)
+        
+        prompt سیستمی ثابت و شرح مشکل در ابتدای لاگ قرار می‌گیرند و هر مرحله فقط
+        پیام‌های جدید خود را به انتها اضافه می‌کند؛ بنابراین prefix درخواست‌ها
+        بین مراحل یکسان می‌ماند و کش prompt سرویس‌دهنده استفاده می‌شود.
+        """
+        first_turn = {
+            "is_valid": True,
+            "needs_clarification": False,
+            "clarification_message": None,
+            "is_root_found": False,
+            "next_question": first_question,
+            "root_cause": None,
+            "recommendations": None
+        }
+        return [
+            {"role": "system", "content": STEP_SYSTEM_PROMPT},
+            {"role": "user", "content": f"مشکل اصلی: {problem}"},
+            {"role": "assistant", "content": json.dumps(first_turn, ensure_ascii=False)}
+        ]
+    
+    def compact_conversation(self, problem: str, steps: List[WhyStep], current_question: str) -> List[dict]:
+        """
+        فشرده‌سازی لاگ جلسه‌ای که از آستانه context بزرگ‌تر شده است
         
-        return await self._call_ai(messages)
+        مراحل قبلی (همراه با دورهای درخواست توضیح) در یک خلاصه کوتاه کنار شرح
+        مشکل قرار می‌گیرند و سوال فعلی دوباره به‌عنوان آخرین پاسخ مدل ثبت می‌شود.
+        پس از آن لاگ مثل قبل فقط‌افزودنی است تا فشرده‌سازی بعدی.
+        """
+        messages = self.start_conversation(problem, current_question)
+        digest = digest_steps(steps)
+        if digest:
+            messages[1] = {
+                "role": "user",
+                "content": f"مشکل اصلی: {problem}\n\nخلاصه مراحل قبلی:\n{digest}"
+            }
+        return messages
     
-    async def validate_and_generate_next(
+    def _validate_messages(
         self, 
         problem: str, 
         steps: List[WhyStep], 
-        current_answer: str
-    ) -> Tuple[bool, str, Optional[str], bool, Optional[str], Optional[List[str]]]:
-        """
-        بررسی پاسخ و تولید سوال بعدی
+        current_answer: str,
+        final_step: bool = False,
+        conversation: Optional[List[dict]] = None
+    ) -> list:
+        # در مرحله آخر، خلاصه نهایی باید در همین پاسخ برگردد
+        final_instruction = ""
+        if final_step:
+            final_instruction = (
+                "\n\nاین آخرین مرحله تحلیل است. اگر پاسخ معتبر است، is_root_found را true قرار بده "
+                "و root_cause و 3-5 پیشنهاد عملی در recommendations را حتماً در همین پاسخ بنویس."
+            )
         
-        Returns:
-            - is_valid: آیا پاسخ معتبر است
-            - next_question_or_message: سوال بعدی یا پیام توضیحی
-            - clarification: در صورت نیاز به توضیح بیشتر
-            - is_root_found: آیا به ریشه رسیدیم
-            - root_cause: علت ریشه‌ای (اگر پیدا شد)
-            - recommendations: پیشنهادات (اگر ریشه پیدا شد)
-        """
+        if conversation:
+            # فقط پیام جدید به انتهای لاگ جلسه اضافه می‌شود
+            step_number = steps[-1].step_number if steps else 1
+            return conversation + [{
+                "role": "user",
+                "content": f"پاسخ کاربر به سوال مرحله {step_number}: {current_answer}{final_instruction}\n\nتحلیل کن و پاسخ JSON بده:"
+            }]
         
-        # ساخت تاریخچه مکالمه
+        # ساخت تاریخچه مکالمه (جلساتی که لاگ پیام ندارند)
         history = "\n".join([
             f"سوال {s.step_number}: {s.question}\nپاسخ {s.step_number}: {s.answer}"
             for s in steps if s.answer
@@ -221,27 +767,10 @@ class AIService:
         current_step = len(steps) + 1
         last_question = steps[-1].question if steps else "سوال اولیه"
         
-        messages = [
+        return [
             {
                 "role": "system",
-                "content": """شما متخصص تحلیل 5 Whys هستید.
-
-وظایف شما:
-1. بررسی کنید پاسخ کاربر منطقی و مرتبط با سوال است
-2. تشخیص دهید آیا به ریشه اصلی مشکل رسیده‌ایم
-3. اگر پاسخ نامناسب است، درخواست توضیح بیشتر کنید
-4. اگر به ریشه نرسیده‌ایم، سوال چرای بعدی را بپرسید
-
-پاسخ را به فرمت JSON بدهید:
-{
-    "is_valid": true/false,
-    "needs_clarification": true/false,
-    "clarification_message": "پیام توضیحی اگر نیاز است",
-    "is_root_found": true/false,
-    "next_question": "سوال بعدی اگر ریشه پیدا نشده",
-    "root_cause": "علت ریشه‌ای اگر پیدا شد",
-    "recommendations": ["پیشنهاد 1", "پیشنهاد 2"] // اگر ریشه پیدا شد
-}"""
+                "content": STEP_SYSTEM_PROMPT
             },
             {
                 "role": "user",
@@ -251,47 +780,161 @@ class AIService:
 {history}
 
 سوال فعلی (مرحله {current_step}): {last_question}
-پاسخ کاربر: {current_answer}
+پاسخ کاربر: {current_answer}{final_instruction}
 
 تحلیل کن و پاسخ JSON بده:"""
             }
         ]
+    
+    async def _parse_with_repair(self, response: str, parse, schema: dict, kind: str):
+        """
+        پارس پاسخ مدل؛ اگر ناموفق بود فقط یک فراخوانی کوتاه اصلاح انجام می‌شود
         
-        response = await self._call_ai(messages)
-        
-        # پارس کردن JSON
-        try:
-            # پیدا کردن JSON در پاسخ
-            start = response.find('{')
-            end = response.rfind('}') + 1
-            json_str = response[start:end]
-            data = json.loads(json_str)
+        خروجی: (نتیجه پارس یا None، متنی که باید در لاگ گفتگو ثبت شود)
+        """
+        with span("parse", kind=kind) as current:
+            try:
+                result, tolerant = parse(response)
+                record_parse(kind, "tolerant" if tolerant else "direct")
+                current.set(outcome="tolerant" if tolerant else "direct")
+                return result, response
+            except ResponseParseError as e:
+                error = e
             
-            return (
-                data.get("is_valid", True),
-                data.get("next_question", ""),
-                data.get("clarification_message"),
-                data.get("is_root_found", False),
-                data.get("root_cause"),
-                data.get("recommendations", [])
-            )
-        except (json.JSONDecodeError, ValueError):
+            if AI_PARSE_REPAIR:
+                # فقط متن خراب ارسال می‌شود، نه کل گفتگو
+                messages = [
+                    {"role": "system", "content": REPAIR_PROMPT.format(
+                        schema=json.dumps(schema["schema"], ensure_ascii=False)
+                    )},
+                    {"role": "user", "content": response[:PARSE_REPAIR_MAX_CHARS] or "{}"}
+                ]
+                try:
+                    repaired = await self._call_ai(messages, purpose="repair", schema=schema)
+                    result, _ = parse(repaired)
+                    record_parse(kind, "repaired")
+                    current.set(outcome="repaired")
+                    return result, repaired
+                except Exception as e:
+                    error = e
+            
+            logger.warning("Unparseable %s response: %s", kind, error, extra={"response": log_payload(response)})
+            record_parse(kind, "fallback")
+            record_error("parser", kind)
+            current.set(outcome="fallback", error=str(error))
+            return None, response
+    
+    async def _parse_step_response(
+        self, 
+        response: str, 
+        current_answer: str
+    ) -> Tuple[Tuple[bool, str, Optional[str], bool, Optional[str], Optional[List[str]]], str]:
+        """خروجی: (tuple نتیجه مرحله، متن پاسخ برای لاگ گفتگو)"""
+        step, text = await self._parse_with_repair(response, parse_step, STEP_RESPONSE_SCHEMA, "next_step")
+        if step is None:
             # اگر JSON معتبر نبود، سوال ساده بپرس
-            return (True, f"چرا {current_answer}?", None, False, None, None)
+            return (True, f"چرا {current_answer}?", None, False, None, None), text
+        
+        return (
+            step.is_valid,
+            step.next_question or "",
+            step.clarification_message,
+            step.is_root_found,
+            step.root_cause,
+            step.recommendations or []
+        ), text
     
-    async def generate_summary(
+    async def validate_and_generate_next(
         self, 
         problem: str, 
-        steps: List[WhyStep]
-    ) -> Tuple[str, List[str]]:
-        """تولید خلاصه و پیشنهادات نهایی"""
+        steps: List[WhyStep], 
+        current_answer: str,
+        final_step: bool = False,
+        conversation: Optional[List[dict]] = None
+    ) -> Tuple[bool, str, Optional[str], bool, Optional[str], Optional[List[str]]]:
+        """
+        بررسی پاسخ و تولید سوال بعدی
+        
+        Returns:
+            - is_valid: آیا پاسخ معتبر است
+            - next_question_or_message: سوال بعدی یا پیام توضیحی
+            - clarification: در صورت نیاز به توضیح بیشتر
+            - is_root_found: آیا به ریشه رسیدیم
+            - root_cause: علت ریشه‌ای (اگر پیدا شد)
+            - recommendations: پیشنهادات (اگر ریشه پیدا شد)
+        
+        با final_step=True مدل موظف است خلاصه نهایی را در همین فراخوانی برگرداند
+        تا نیازی به فراخوانی جداگانه generate_summary نباشد.
+        
+        اگر conversation (لاگ پیام‌های جلسه) داده شود، فقط پیام جدید ارسال می‌شود
+        و پس از موفقیت، پیام کاربر و پاسخ مدل به انتهای همان لیست اضافه می‌شوند.
+        """
+        with span("ai.validate_and_generate_next", step=len(steps), final_step=final_step) as current:
+            messages = self._validate_messages(problem, steps, current_answer, final_step, conversation)
+            response = await self._call_ai(messages, purpose="next_step", schema=STEP_RESPONSE_SCHEMA)
+            result, text = await self._parse_step_response(response, current_answer)
+            self._extend_conversation(conversation, messages, text)
+            current.set(is_valid=result[0], is_root_found=result[3])
+            return result
+    
+    async def stream_validate_and_generate_next(
+        self, 
+        problem: str, 
+        steps: List[WhyStep], 
+        current_answer: str,
+        final_step: bool = False,
+        conversation: Optional[List[dict]] = None
+    ) -> AsyncIterator[Tuple[str, object]]:
+        """
+        نسخه stream از validate_and_generate_next
+        
+        JSON خروجی مدل به‌صورت تدریجی پارس می‌شود و متن next_question قبل از
+        کامل شدن JSON به شکل ("delta", متن) ارسال می‌شود. رویداد پایانی
+        ("result", tuple) همان خروجی validate_and_generate_next است.
+        """
+        messages = self._validate_messages(problem, steps, current_answer, final_step, conversation)
+        streamer = JsonFieldStreamer("next_question")
+        parts = []
+        
+        async for chunk in self._stream_ai(messages, purpose="next_step", schema=STEP_RESPONSE_SCHEMA):
+            parts.append(chunk)
+            text = streamer.feed(chunk)
+            # اگر مدل قبلاً نیاز به توضیح را اعلام کرده، سوال جدید نمایش داده نمی‌شود
+            if text and streamer.flag("is_valid") is not False and not streamer.flag("needs_clarification"):
+                yield "delta", text
+        
+        result, text = await self._parse_step_response("".join(parts), current_answer)
+        self._extend_conversation(conversation, messages, text)
+        yield "result", result
+    
+    def _extend_conversation(
+        self,
+        conversation: Optional[List[dict]],
+        messages: list,
+        response: str
+    ) -> None:
+        """افزودن پیام‌های جدید این مرحله و پاسخ مدل به لاگ جلسه"""
+        if not conversation:
+            return
+        conversation.extend(messages[len(conversation):])
+        conversation.append({"role": "assistant", "content": response})
+    
+    def _summary_messages(
+        self,
+        problem: str,
+        steps: List[WhyStep],
+        conversation: Optional[List[dict]] = None
+    ) -> list:
+        if conversation:
+            # استفاده از همان prefix کش‌شده گفتگو
+            return conversation + [{"role": "user", "content": SUMMARY_REQUEST}]
         
         history = "\n".join([
             f"چرا {s.step_number}: {s.question}\nپاسخ: {s.answer}"
             for s in steps if s.answer
         ])
         
-        messages = [
+        return [
             {
                 "role": "system",
                 "content": """بر اساس تحلیل 5 Whys انجام شده:
@@ -309,13 +952,47 @@ class AIService:
                 "content": f"مشکل: {problem}\n\nتحلیل:\n{history}"
             }
         ]
+    
+    async def _parse_summary(self, response: str) -> Tuple[str, List[str]]:
+        summary, _ = await self._parse_with_repair(response, parse_summary, SUMMARY_RESPONSE_SCHEMA, "summary")
+        if summary is None:
+            return "نیاز به بررسی بیشتر", ["تحلیل را با جزئیات بیشتر تکرار کنید"]
+        return summary.root_cause, summary.recommendations
+    
+    async def generate_summary(
+        self, 
+        problem: str, 
+        steps: List[WhyStep],
+        conversation: Optional[List[dict]] = None,
+        purpose: str = "summary"
+    ) -> Tuple[str, List[str]]:
+        """تولید خلاصه و پیشنهادات نهایی"""
+        with span("ai.generate_summary", steps=len(steps), purpose=purpose):
+            response = await self._call_ai(
+                self._summary_messages(problem, steps, conversation),
+                purpose=purpose,
+                schema=SUMMARY_RESPONSE_SCHEMA
+            )
+            return await self._parse_summary(response)
+    
+    async def stream_summary(
+        self, 
+        problem: str, 
+        steps: List[WhyStep],
+        conversation: Optional[List[dict]] = None
+    ) -> AsyncIterator[Tuple[str, object]]:
+        """نسخه stream از generate_summary؛ متن root_cause به‌صورت ("delta", متن) ارسال می‌شود"""
+        streamer = JsonFieldStreamer("root_cause")
+        parts = []
         
-        response = await self._call_ai(messages)
+        async for chunk in self._stream_ai(
+            self._summary_messages(problem, steps, conversation),
+            purpose="summary",
+            schema=SUMMARY_RESPONSE_SCHEMA
+        ):
+            parts.append(chunk)
+            text = streamer.feed(chunk)
+            if text:
+                yield "delta", text
         
-        try:
-            start = response.find('{')
-            end = response.rfind('}') + 1
-            data = json.loads(response[start:end])
-            return data["root_cause"], data["recommendations"]
-        except:
-            return "نیاز به بررسی بیشتر", ["تحلیل را با جزئیات بیشتر تکرار کنید"]
\ No newline at end of file
+        yield "result", await self._parse_summary("".join(parts))
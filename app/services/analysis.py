@@ -0,0 +1,249 @@
+import os
+import uuid
+from typing import AsyncIterator, List, Optional, Tuple, Union
+
+from app.models.schemas import (
+    AnalysisSession, WhyStep, AnalysisStatus,
+    NextQuestionResponse, FinalResultResponse
+)
+from app.services.ai_service import AIService
+from app.services.call_stats import track_calls, record_final_step
+from app.services.speculation import speculate_summary
+from app.services.archive import archive_session
+from app.services.screening import screen_answer
+from app.services.metrics import METRICS_ENABLED, session_steps
+
+MAX_STEPS = int(os.getenv("MAX_STEPS", "7"))  # حداکثر تعداد سوالات
+
+
+def create_session(
+    ai_service: AIService,
+    problem: str,
+    first_question: str,
+    calls=None
+) -> AnalysisSession:
+    """ایجاد جلسه جدید با اولین سوال (calls: مصرف فراخوانی سوال اول برای بودجه توکن)"""
+    session = AnalysisSession(
+        session_id=str(uuid.uuid4())[:8],
+        original_problem=problem,
+        steps=[WhyStep(step_number=1, question=first_question)],
+        current_step=1,
+        messages=ai_service.start_conversation(problem, first_question),
+        token_budget=ai_service.budget.new_budget()
+    )
+    if calls is not None:
+        ai_service.budget.record(session, calls)
+    return session
+
+
+def prepare_step(ai_service: AIService, session: AnalysisSession) -> bool:
+    """
+    آماده‌سازی جلسه پیش از ارزیابی پاسخ (بررسی بودجه و فشرده‌سازی context)
+    
+    خروجی True یعنی این مرحله باید آخرین مرحله باشد؛ چه به دلیل MAX_STEPS و چه
+    به دلیل کافی نبودن بودجه توکن باقی‌مانده. اگر بودجه تمام شده باشد
+    TokenBudgetExceeded پرتاب می‌شود.
+    """
+    budget_final = ai_service.budget.prepare(session)
+    return budget_final or session.current_step >= MAX_STEPS
+
+
+def screen_step(session: AnalysisSession, answer: str) -> Optional[NextQuestionResponse]:
+    """
+    بررسی محلی پاسخ پیش از فراخوانی AI
+
+    برای پاسخ‌های آشکارا نامعتبر (خیلی کوتاه، ناخوانا، تکراری یا تکرار سوال)
+    همان پاسخ درخواست توضیح apply_step_result را بدون تماس با مدل برمی‌گرداند.
+    """
+    clarification = screen_answer(session.original_problem, session.steps, session.current_step, answer)
+    if clarification is None:
+        return None
+    session.steps[session.current_step - 1].answer = answer
+    return apply_step_result(session, (False, None, clarification, False, None, None))
+
+
+def record_step_usage(ai_service: AIService, session: AnalysisSession, step: WhyStep, calls) -> None:
+    """ثبت تعداد فراخوانی‌ها و مصرف توکن یک مرحله (و کسر آن از بودجه جلسه)"""
+    step.llm_calls += calls.calls
+    step.prompt_tokens += calls.prompt_tokens
+    step.completion_tokens += calls.completion_tokens
+    step.cached_tokens += calls.cached_tokens
+    ai_service.budget.record(session, calls)
+
+
+def apply_step_result(
+    session: AnalysisSession,
+    result: tuple,
+    final_step: bool = False
+) -> Optional[Union[NextQuestionResponse, FinalResultResponse]]:
+    """
+    اعمال نتیجه validate_and_generate_next روی جلسه
+    
+    اگر تحلیل باید تمام شود ولی مدل علت ریشه‌ای را نداده، None برمی‌گرداند
+    تا فراخواننده generate_summary را اجرا کند و conclude_session را صدا بزند.
+    """
+    (
+        is_valid,
+        next_question,
+        clarification,
+        is_root_found,
+        root_cause,
+        recommendations
+    ) = result
+    current_step_idx = session.current_step - 1
+    
+    # اگر پاسخ نامعتبر است
+    if not is_valid or clarification:
+        session.steps[current_step_idx].is_valid = False
+        session.steps[current_step_idx].clarification_note = clarification
+        session.status = AnalysisStatus.NEEDS_CLARIFICATION
+        
+        return NextQuestionResponse(
+            session_id=session.session_id,
+            current_step=session.current_step,
+            question=session.steps[current_step_idx].question,
+            status=AnalysisStatus.NEEDS_CLARIFICATION,
+            needs_clarification=True,
+            clarification_message=clarification or "لطفاً پاسخ واضح‌تری بدهید"
+        )
+    
+    # پاسخ پذیرفته شد؛ درخواست توضیح قبلی همین مرحله پاک می‌شود
+    session.steps[current_step_idx].is_valid = True
+    session.steps[current_step_idx].clarification_note = None
+
+    # اگر به ریشه رسیدیم
+    if is_root_found or final_step or session.current_step >= MAX_STEPS:
+        if not root_cause:
+            return None
+        return conclude_session(session, root_cause, recommendations)
+    
+    # ادامه با سوال بعدی
+    session.current_step += 1
+    session.status = AnalysisStatus.IN_PROGRESS
+    session.steps.append(WhyStep(
+        step_number=session.current_step,
+        question=next_question
+    ))
+    
+    return NextQuestionResponse(
+        session_id=session.session_id,
+        current_step=session.current_step,
+        question=next_question,
+        status=AnalysisStatus.IN_PROGRESS
+    )
+
+
+def conclude_session(
+    session: AnalysisSession,
+    root_cause: str,
+    recommendations: Optional[List[str]]
+) -> FinalResultResponse:
+    """ثبت علت ریشه‌ای و پایان تحلیل"""
+    session.status = AnalysisStatus.ROOT_FOUND
+    session.root_cause = root_cause
+    if METRICS_ENABLED:
+        session_steps.observe(session.current_step)
+    session.recommendations = recommendations or []
+    archive_session(session)
+    
+    return FinalResultResponse(
+        session_id=session.session_id,
+        original_problem=session.original_problem,
+        steps=session.steps,
+        root_cause=root_cause,
+        recommendations=session.recommendations,
+        total_steps=session.current_step
+    )
+
+
+async def run_step(
+    ai_service: AIService,
+    session: AnalysisSession,
+    answer: str,
+    stream: bool = False
+) -> AsyncIterator[Tuple[str, object]]:
+    """
+    اعمال یک پاسخ روی جلسه (مسیر مشترک HTTP، SSE، WebSocket و دسته‌ای)
+    
+    بررسی محلی پاسخ، بودجه توکن، ارزیابی پاسخ و سوال بعدی، خلاصه پیش‌دستانه یا
+    جایگزین و ثبت مصرف. رویدادها: ("delta", {"field", "text"}) فقط با stream=True
+    برای متن سوال بعدی یا علت ریشه‌ای، و در پایان ("result", NextQuestionResponse
+    یا FinalResultResponse). ذخیره جلسه با فراخواننده است.
+    """
+    # پاسخ‌های آشکارا نامعتبر بدون فراخوانی AI رد می‌شوند
+    response = screen_step(session, answer)
+    if response is not None:
+        yield "result", response
+        return
+    
+    # بودجه توکن و فشرده‌سازی context پیش از ارسال پاسخ
+    final_step = prepare_step(ai_service, session)
+    step = session.steps[session.current_step - 1]
+    step.answer = answer
+    
+    with track_calls() as calls:
+        async with speculate_summary(ai_service, session, answer, final_step) as draft:
+            # بررسی و تولید سوال بعدی (در مرحله آخر خلاصه هم در همین فراخوانی می‌آید)
+            if stream:
+                result = None
+                async for kind, value in ai_service.stream_validate_and_generate_next(
+                    session.original_problem,
+                    session.steps,
+                    answer,
+                    final_step=final_step,
+                    conversation=session.messages
+                ):
+                    if kind == "delta":
+                        yield "delta", {"field": "question", "text": value}
+                    else:
+                        result = value
+            else:
+                result = await ai_service.validate_and_generate_next(
+                    session.original_problem,
+                    session.steps,
+                    answer,
+                    final_step=final_step,
+                    conversation=session.messages
+                )
+            
+            response = apply_step_result(session, result, final_step)
+            if response is None:
+                # مسیر جایگزین: مدل خلاصه را برنگرداند (پیش‌نویس پیش‌دستانه در صورت وجود)
+                summary = await draft.result(session.steps) if draft else None
+                if summary is not None:
+                    if stream:
+                        yield "delta", {"field": "root_cause", "text": summary[0]}
+                elif stream:
+                    async for kind, value in ai_service.stream_summary(
+                        session.original_problem,
+                        session.steps,
+                        session.messages
+                    ):
+                        if kind == "delta":
+                            yield "delta", {"field": "root_cause", "text": value}
+                        else:
+                            summary = value
+                else:
+                    summary = await ai_service.generate_summary(
+                        session.original_problem,
+                        session.steps,
+                        session.messages
+                    )
+                response = conclude_session(session, *summary)
+    
+    record_step_usage(ai_service, session, step, calls)
+    if session.status == AnalysisStatus.ROOT_FOUND:
+        record_final_step(calls)
+    yield "result", response
+
+
+async def answer_step(
+    ai_service: AIService,
+    session: AnalysisSession,
+    answer: str
+) -> Union[NextQuestionResponse, FinalResultResponse]:
+    """run_step بدون خروجی تدریجی؛ فقط نتیجه نهایی مرحله"""
+    response = None
+    async for _, value in run_step(ai_service, session, answer):
+        response = value
+    return response
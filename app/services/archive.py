@@ -0,0 +1,342 @@
+import os
+import re
+import hmac
+import json
+import time
+import asyncio
+import sqlite3
+import logging
+import threading
+from typing import List, Optional, Set, Tuple
+
+from app.models.schemas import AnalysisSession, ArchivedAnalysis, SimilarAnalysis
+from app.services.config import env_bool
+from app.services.session_store import serialize_session, deserialize_session
+
+logger = logging.getLogger(__name__)
+
+# بایگانی تحلیل‌های کامل‌شده (فقط‌افزودنی) با جستجوی متن کامل FTS5
+ARCHIVE_ENABLED = env_bool("ARCHIVE_ENABLED", True)
+ARCHIVE_PATH = os.getenv("ARCHIVE_PATH", "archive.db")
+# مسیرهای مرور بایگانی (/api/archive) شامل جلسات همه کاربران‌اند و فقط با این توکن
+# در دسترس‌اند؛ خالی یعنی این مسیرها غیرفعال‌اند
+ARCHIVE_ADMIN_TOKEN = os.getenv("ARCHIVE_ADMIN_TOKEN", "")
+# تعداد تحلیل‌های مشابه در پاسخ /api/start (0 = غیرفعال)
+ARCHIVE_SIMILAR_K = int(os.getenv("ARCHIVE_SIMILAR_K", "3"))
+ARCHIVE_MAX_PAGE = 50
+# صفحه‌بندی نتایج جستجو با offset است؛ بیشتر از این مقدار به جستجوی دقیق‌تر نیاز دارد
+ARCHIVE_MAX_OFFSET = 1000
+# حداکثر تعداد کلمات پرسش (مشکل طولانی برای یافتن موارد مشابه)
+MAX_QUERY_TERMS = 32
+# در یافتن موارد مشابه فقط کمیاب‌ترین کلمات استفاده می‌شوند؛ کلمه‌ای که در بیش
+# از این نسبت از تحلیل‌ها آمده تمایزی ایجاد نمی‌کند و رتبه‌بندی را کند می‌کند
+SIMILAR_MAX_TERMS = 8
+SIMILAR_MAX_DOC_RATIO = 0.2
+
+# وزن ستون‌ها در رتبه‌بندی bm25: شرح مشکل، علت ریشه‌ای، پیشنهادها
+_BM25_WEIGHTS = (3.0, 1.5, 0.5)
+
+_ARABIC_VARIANTS = str.maketrans({"ي": "ی", "ى": "ی", "ك": "ک", "ة": "ه", "ۀ": "ه", "أ": "ا", "إ": "ا", "آ": "ا"})
+_WORD = re.compile(r"\w+", re.UNICODE)
+# کلمات پرتکرار فارسی که در یافتن موارد مشابه نقشی ندارند
+_STOPWORDS = {
+    "و", "در", "به", "از", "که", "این", "آن", "را", "با", "است", "برای", "یک", "تا", "می",
+    "هم", "شود", "شده", "ما", "من", "هر", "یا", "بر", "اما", "اگر", "چرا", "نمی", "هست", "بود",
+}
+
+
+def normalize_text(text: str) -> str:
+    """یکسان‌سازی نویسه‌های عربی/فارسی و نیم‌فاصله پیش از ایندکس و جستجو"""
+    return (text or "").translate(_ARABIC_VARIANTS).replace("‌", " ").lower()
+
+
+def query_terms(text: str, drop_stopwords: bool = False) -> List[str]:
+    terms: List[str] = []
+    seen: Set[str] = set()
+    for term in _WORD.findall(normalize_text(text)):
+        if term in seen or (drop_stopwords and (term in _STOPWORDS or len(term) < 2)):
+            continue
+        seen.add(term)
+        terms.append(term)
+    return terms[:MAX_QUERY_TERMS]
+
+
+def _quote(term: str) -> str:
+    return '"' + term.replace('"', '""') + '"'
+
+
+class AnalysisArchive:
+    """
+    بایگانی SQLite تحلیل‌های کامل‌شده
+
+    جدول analyses فقط‌افزودنی است و ایندکس FTS5 (بدون محتوا، با rowid مشترک)
+    متن نرمال‌شده مشکل، علت ریشه‌ای و پیشنهادها را نگه می‌دارد. فهرست با
+    cursor روی id صفحه‌بندی می‌شود تا در تعداد رکورد زیاد هم سریع بماند.
+    """
+
+    def __init__(self, path: str = ARCHIVE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        try:
+            self._create_schema()
+        except sqlite3.Error:
+            # مثلاً فایل‌سیستم فقط‌خواندنی یا SQLite بدون FTS5
+            self._conn.close()
+            raise
+        self._pending: Set[asyncio.Task] = set()
+        self.stats_data = {"archived": 0, "duplicates": 0, "write_errors": 0, "searches": 0, "search_ms": 0.0}
+
+    def _create_schema(self) -> None:
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS analyses ("
+            "id INTEGER PRIMARY KEY, session_id TEXT NOT NULL UNIQUE, created_at REAL NOT NULL, "
+            "problem TEXT NOT NULL, root_cause TEXT NOT NULL, recommendations TEXT NOT NULL, "
+            "total_steps INTEGER NOT NULL, data BLOB NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS analyses_fts USING fts5("
+            "problem, root_cause, recommendations, content='', "
+            "tokenize='unicode61 remove_diacritics 2')"
+        )
+        # تعداد تحلیل‌های شامل هر کلمه (برای انتخاب کلمات کمیاب)
+        self._conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS analyses_vocab USING fts5vocab(analyses_fts, 'row')"
+        )
+        self._conn.commit()
+
+    def _execute(self, sql: str, params: tuple = ()) -> list:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def _insert(self, session_id: str, created_at: float, problem: str, root_cause: str,
+                recommendations: List[str], total_steps: int, data: bytes) -> bool:
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO analyses "
+                "(session_id, created_at, problem, root_cause, recommendations, total_steps, data) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (session_id, created_at, problem, root_cause,
+                 json.dumps(recommendations, ensure_ascii=False), total_steps, data)
+            )
+            if cursor.rowcount == 0:
+                # همان جلسه قبلاً بایگانی شده (مثلاً تلاش دوباره)
+                return False
+            self._conn.execute(
+                "INSERT INTO analyses_fts (rowid, problem, root_cause, recommendations) VALUES (?, ?, ?, ?)",
+                (cursor.lastrowid, normalize_text(problem), normalize_text(root_cause),
+                 normalize_text(" ".join(recommendations)))
+            )
+            self._conn.commit()
+            return True
+
+    async def add(self, session: AnalysisSession) -> bool:
+        """بایگانی یک جلسه کامل‌شده (لاگ پیام‌های AI ذخیره نمی‌شود)"""
+        snapshot = session.model_copy(update={"messages": []})
+        try:
+            added = await asyncio.to_thread(
+                self._insert,
+                session.session_id,
+                time.time(),
+                session.original_problem,
+                session.root_cause or "",
+                list(session.recommendations or []),
+                session.current_step,
+                serialize_session(snapshot)
+            )
+        except sqlite3.Error as e:
+            self.stats_data["write_errors"] += 1
+            logger.warning("Could not archive session %s: %s", session.session_id, e)
+            return False
+        self.stats_data["archived" if added else "duplicates"] += 1
+        return added
+
+    def record(self, session: AnalysisSession) -> None:
+        """بایگانی در پس‌زمینه تا پاسخ کاربر منتظر نوشتن روی دیسک نماند"""
+        snapshot = session.model_copy(update={"messages": []}, deep=True)
+        task = asyncio.get_running_loop().create_task(self.add(snapshot))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    @staticmethod
+    def _item(row: tuple, score: Optional[float] = None) -> ArchivedAnalysis:
+        session_id, created_at, problem, root_cause, recommendations, total_steps = row[:6]
+        return ArchivedAnalysis(
+            session_id=session_id,
+            created_at=created_at,
+            problem=problem,
+            root_cause=root_cause,
+            recommendations=json.loads(recommendations),
+            total_steps=total_steps,
+            score=score
+        )
+
+    async def recent(self, limit: int = 20, before: Optional[int] = None) -> Tuple[List[ArchivedAnalysis], Optional[int]]:
+        """جدیدترین تحلیل‌ها؛ خروجی: (موارد، cursor صفحه بعد)"""
+        limit = max(1, min(limit, ARCHIVE_MAX_PAGE))
+        rows = await asyncio.to_thread(
+            self._execute,
+            "SELECT session_id, created_at, problem, root_cause, recommendations, total_steps, id "
+            "FROM analyses WHERE id < ? ORDER BY id DESC LIMIT ?",
+            (before if before is not None else 2 ** 63 - 1, limit + 1)
+        )
+        next_cursor = rows[limit - 1][6] if len(rows) > limit else None
+        return [self._item(row) for row in rows[:limit]], next_cursor
+
+    async def _match(self, expression: str, limit: int, offset: int = 0) -> List[ArchivedAnalysis]:
+        started = time.perf_counter()
+        weights = ", ".join(str(weight) for weight in _BM25_WEIGHTS)
+        rows = await asyncio.to_thread(
+            self._execute,
+            "SELECT a.session_id, a.created_at, a.problem, a.root_cause, a.recommendations, a.total_steps, "
+            f"bm25(analyses_fts, {weights}) AS rank "
+            "FROM analyses_fts JOIN analyses a ON a.id = analyses_fts.rowid "
+            "WHERE analyses_fts MATCH ? ORDER BY rank LIMIT ? OFFSET ?",
+            (expression, limit, offset)
+        )
+        self.stats_data["searches"] += 1
+        self.stats_data["search_ms"] += (time.perf_counter() - started) * 1000
+        # bm25 در SQLite منفی است (کوچک‌تر = مرتبط‌تر)
+        return [self._item(row, score=round(-row[6], 4)) for row in rows]
+
+    async def search(self, query: str, limit: int = 20, offset: int = 0) -> List[ArchivedAnalysis]:
+        """جستجوی متن کامل؛ همه کلمات باید وجود داشته باشند (آخرین کلمه به‌صورت پیشوند)"""
+        terms = query_terms(query)
+        if not terms:
+            return []
+        expression = " ".join(_quote(term) for term in terms[:-1]) + f" {_quote(terms[-1])}*"
+        return await self._match(
+            expression.strip(),
+            max(1, min(limit, ARCHIVE_MAX_PAGE)),
+            max(0, min(offset, ARCHIVE_MAX_OFFSET))
+        )
+
+    async def similar(self, problem: str, k: int = ARCHIVE_SIMILAR_K) -> List[ArchivedAnalysis]:
+        """تحلیل‌های قبلی مشابه یک شرح مشکل (هر کلمه مشترک امتیاز می‌گیرد)"""
+        terms = query_terms(problem, drop_stopwords=True)
+        if not terms or k <= 0:
+            return []
+        terms = await asyncio.to_thread(self._rare_terms, terms)
+        if not terms:
+            return []
+        # پیشنهادها بین تحلیل‌ها تکراری‌اند و فقط شرح مشکل و علت ریشه‌ای مقایسه می‌شوند
+        expression = "{problem root_cause} : (" + " OR ".join(_quote(term) for term in terms) + ")"
+        return await self._match(expression, k)
+
+    def _rare_terms(self, terms: List[str]) -> List[str]:
+        placeholders = ", ".join("?" for _ in terms)
+        with self._lock:
+            total = self._conn.execute("SELECT MAX(id) FROM analyses").fetchone()[0] or 0
+            counts = dict(self._conn.execute(
+                f"SELECT term, doc FROM analyses_vocab WHERE term IN ({placeholders})", tuple(terms)
+            ).fetchall())
+        # کلمه‌ای که در هیچ تحلیلی نیامده امتیازی هم نمی‌آورد
+        present = sorted((counts[term], term) for term in terms if term in counts)
+        rare = [term for doc, term in present if doc <= max(1, total * SIMILAR_MAX_DOC_RATIO)]
+        if not rare and present:
+            rare = [present[0][1]]
+        return rare[:SIMILAR_MAX_TERMS]
+
+    async def get(self, session_id: str) -> Optional[AnalysisSession]:
+        rows = await asyncio.to_thread(
+            self._execute, "SELECT data FROM analyses WHERE session_id = ?", (session_id,)
+        )
+        return deserialize_session(rows[0][0]) if rows else None
+
+    async def count(self) -> int:
+        rows = await asyncio.to_thread(self._execute, "SELECT MAX(id) FROM analyses")
+        return rows[0][0] or 0
+
+    async def close(self) -> None:
+        if self._pending:
+            await asyncio.gather(*self._pending, return_exceptions=True)
+        with self._lock:
+            self._conn.close()
+
+    def stats(self) -> dict:
+        searches = self.stats_data["searches"]
+        return {
+            "path": self.path,
+            "similar_k": ARCHIVE_SIMILAR_K,
+            **{key: value for key, value in self.stats_data.items() if key != "search_ms"},
+            "avg_search_ms": round(self.stats_data["search_ms"] / searches, 3) if searches else None,
+        }
+
+
+_archive: Optional[AnalysisArchive] = None
+# خطای باز کردن بایگانی؛ پس از آن بایگانی تا راه‌اندازی دوباره worker غیرفعال است
+_archive_error: Optional[str] = None
+
+
+def _open_archive() -> Optional[AnalysisArchive]:
+    global _archive, _archive_error
+    try:
+        _archive = AnalysisArchive(ARCHIVE_PATH)
+    except (sqlite3.Error, OSError) as e:
+        _archive_error = f"{type(e).__name__}: {e}"
+        logger.error("Analysis archive disabled, could not open %s: %s", ARCHIVE_PATH, e)
+    return _archive
+
+
+async def open_archive() -> None:
+    """باز کردن بایگانی هنگام شروع worker (در thread جداگانه، نه روی event loop)"""
+    if ARCHIVE_ENABLED and _archive is None and _archive_error is None:
+        await asyncio.to_thread(_open_archive)
+
+
+def get_archive() -> Optional[AnalysisArchive]:
+    """بایگانی مشترک worker؛ None اگر غیرفعال است یا باز نشد"""
+    if _archive is None and ARCHIVE_ENABLED and _archive_error is None:
+        # استفاده بیرون از lifespan برنامه
+        _open_archive()
+    return _archive
+
+
+def archive_session(session: AnalysisSession) -> None:
+    """ثبت جلسه کامل‌شده در بایگانی (بدون انتظار)؛ خطای بایگانی درخواست را خراب نمی‌کند"""
+    try:
+        archive = get_archive()
+        if archive is not None:
+            archive.record(session)
+    except RuntimeError:
+        # خارج از event loop (مثلاً اسکریپت‌ها)؛ بایگانی انجام نمی‌شود
+        logger.debug("No running loop, session %s not archived", session.session_id)
+    except Exception as e:
+        logger.warning("Could not archive session %s: %s", session.session_id, e)
+
+
+def check_admin_token(token: Optional[str]) -> Optional[bool]:
+    """None: مرور بایگانی غیرفعال است؛ در غیر این صورت درست بودن توکن"""
+    if not ARCHIVE_ADMIN_TOKEN:
+        return None
+    return token is not None and hmac.compare_digest(token.encode("utf-8"), ARCHIVE_ADMIN_TOKEN.encode("utf-8"))
+
+
+async def find_similar(problem: str, k: int = ARCHIVE_SIMILAR_K) -> Optional[List[SimilarAnalysis]]:
+    """تحلیل‌های مشابه برای پاسخ شروع تحلیل؛ None یعنی بایگانی غیرفعال یا در دسترس نیست"""
+    if k <= 0:
+        return None
+    try:
+        archive = get_archive()
+        if archive is None:
+            return None
+        return [item.summary() for item in await archive.similar(problem, k)]
+    except Exception as e:
+        logger.warning("Similar lookup failed: %s", e)
+        return None
+
+
+async def close_archive() -> None:
+    global _archive, _archive_error
+    if _archive is not None:
+        await _archive.close()
+        _archive = None
+    _archive_error = None
+
+
+def get_archive_stats() -> dict:
+    if _archive is not None:
+        return _archive.stats()
+    return {"enabled": ARCHIVE_ENABLED, "error": _archive_error}
@@ -0,0 +1,191 @@
+import os
+import re
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Tuple
+
+from pydantic import ValidationError
+
+from app.models.schemas import BatchItem, BatchResult, AnalysisStatus
+from app.services.ai_service import AIService
+from app.services.analysis import create_session, answer_step, conclude_session
+from app.services.call_stats import track_calls
+
+logger = logging.getLogger(__name__)
+
+# تحلیل دسته‌ای
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "16"))
+BATCH_DIR = os.getenv("BATCH_DIR", "batches")  # محل نتایج دسته‌های دارای batch_id (برای ادامه پس از قطع)
+
+_BATCH_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+def parse_batch_lines(lines: Iterable[str]) -> List[BatchItem]:
+    """خواندن ورودی JSONL؛ سطرهای خالی نادیده گرفته می‌شوند"""
+    items = []
+    for number, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            items.append(BatchItem.model_validate_json(line))
+        except ValidationError as e:
+            raise ValueError(f"سطر {number} نامعتبر است: {e.errors()[0]['msg']}")
+    return items
+
+
+def item_id(item: BatchItem) -> str:
+    """شناسه پایدار هر مورد؛ برای ادامه دسته پس از قطع لازم است"""
+    if item.id:
+        return item.id
+    raw = json.dumps([item.problem, item.answers], ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:12]
+
+
+def batch_output_path(batch_id: str) -> str:
+    if not _BATCH_ID_PATTERN.match(batch_id):
+        raise ValueError("شناسه دسته فقط می‌تواند شامل حروف لاتین، عدد، - و _ باشد")
+    return os.path.join(BATCH_DIR, f"{batch_id}.jsonl")
+
+
+def load_completed(path: str) -> Dict[str, dict]:
+    """نتایج موفق قبلی یک فایل خروجی (نتایج خطادار دوباره اجرا می‌شوند)"""
+    completed: Dict[str, dict] = {}
+    if not os.path.exists(path):
+        return completed
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # سطر نیمه‌کاره هنگام crash
+                continue
+            if record.get("id") and record.get("status") != "error":
+                completed[record["id"]] = record
+    return completed
+
+
+async def analyze_item(ai_service: AIService, item: BatchItem, index: int) -> BatchResult:
+    """اجرای کامل یک تحلیل با پاسخ‌های ازپیش‌نوشته"""
+    started = time.monotonic()
+    result = BatchResult(
+        id=item_id(item),
+        index=index,
+        status=AnalysisStatus.IN_PROGRESS.value,
+        problem=item.problem
+    )
+    usage = []
+    session = None
+
+    try:
+        with track_calls() as calls:
+            first_question = await ai_service.generate_first_why(item.problem)
+        usage.append(calls)
+        session = create_session(ai_service, item.problem, first_question, calls)
+
+        for answer in item.answers:
+            response = await answer_step(ai_service, session, answer)
+            if session.status == AnalysisStatus.ROOT_FOUND:
+                break
+            if session.status == AnalysisStatus.NEEDS_CLARIFICATION:
+                # پاسخ بعدی برای سوال دیگری نوشته شده؛ ادامه دادن تحلیل را بی‌معنی می‌کند
+                result.clarification_message = response.clarification_message
+                break
+
+        # پاسخ‌ها تمام شده ولی هنوز به ریشه نرسیده‌ایم
+        if session.status == AnalysisStatus.IN_PROGRESS and item.summarize and item.answers:
+            with track_calls() as calls:
+                root_cause, recommendations = await ai_service.generate_summary(
+                    session.original_problem,
+                    session.steps,
+                    session.messages
+                )
+            usage.append(calls)
+            conclude_session(session, root_cause, recommendations)
+
+        result.status = session.status.value
+        result.root_cause = session.root_cause
+        result.recommendations = session.recommendations or []
+    except Exception as e:
+        logger.warning("Batch item %s failed: %s", result.id, e)
+        result.status = "error"
+        result.error = str(e)
+
+    if session is not None:
+        result.steps = session.steps
+
+    # مصرف هر مرحله روی خود مرحله ثبت شده است (record_step_usage)
+    result.llm_calls = sum(calls.calls for calls in usage) + sum(step.llm_calls for step in result.steps)
+    result.prompt_tokens = sum(calls.prompt_tokens for calls in usage) + sum(step.prompt_tokens for step in result.steps)
+    result.completion_tokens = (
+        sum(calls.completion_tokens for calls in usage) + sum(step.completion_tokens for step in result.steps)
+    )
+    result.duration = round(time.monotonic() - started, 3)
+    return result
+
+
+async def run_batch(
+    ai_service: AIService,
+    items: List[BatchItem],
+    concurrency: int = BATCH_CONCURRENCY,
+    output_path: Optional[str] = None,
+    resume: bool = True
+) -> AsyncIterator[Tuple[dict, dict]]:
+    """
+    اجرای هم‌زمان (با سقف concurrency) یک دسته و برگرداندن نتایج به ترتیب اتمام
+
+    هر نتیجه بلافاصله به output_path افزوده می‌شود؛ در اجرای دوباره با همان فایل،
+    موارد موفق قبلی با resumed=True برگردانده و دوباره اجرا نمی‌شوند.
+    خروجی: زوج (نتیجه، وضعیت پیشرفت)
+    """
+    concurrency = max(1, min(concurrency, BATCH_MAX_CONCURRENCY))
+    completed = load_completed(output_path) if output_path and resume else {}
+    progress = {"completed": 0, "total": len(items), "failed": 0, "resumed": 0}
+
+    pending = []
+    for index, item in enumerate(items):
+        previous = completed.get(item_id(item))
+        if previous is not None:
+            progress["completed"] += 1
+            progress["resumed"] += 1
+            yield {**previous, "index": index, "resumed": True}, dict(progress)
+        else:
+            pending.append((index, item))
+
+    if not pending:
+        return
+
+    output = None
+    if output_path:
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+        output = open(output_path, "a" if resume else "w", encoding="utf-8")
+
+    queue: asyncio.Queue = asyncio.Queue()
+    source = iter(pending)
+
+    async def worker():
+        for index, item in source:
+            await queue.put(await analyze_item(ai_service, item, index))
+
+    workers = [asyncio.create_task(worker()) for _ in range(min(concurrency, len(pending)))]
+    try:
+        for _ in range(len(pending)):
+            result = await queue.get()
+            record = result.model_dump(mode="json")
+            if output is not None:
+                output.write(json.dumps(record, ensure_ascii=False) + "\n")
+                output.flush()
+            progress["completed"] += 1
+            if result.status == "error":
+                progress["failed"] += 1
+            yield record, dict(progress)
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        if output is not None:
+            output.close()
@@ -0,0 +1,93 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, Optional
+
+from app.services.metrics import METRICS_ENABLED, llm_tokens
+
+
+class CallStats:
+    """شمارش فراخوانی‌های AI در یک مرحله از تحلیل"""
+
+    def __init__(self):
+        self.calls = 0
+        self.by_purpose: Dict[str, int] = {}
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+
+    def add(self, purpose: str) -> None:
+        self.calls += 1
+        self.by_purpose[purpose] = self.by_purpose.get(purpose, 0) + 1
+
+    def add_usage(self, usage: Dict[str, int]) -> None:
+        self.prompt_tokens += usage.get("prompt_tokens", 0)
+        self.completion_tokens += usage.get("completion_tokens", 0)
+        self.cached_tokens += usage.get("cached_tokens", 0)
+
+
+_current: ContextVar[Optional[CallStats]] = ContextVar("ai_call_stats", default=None)
+
+# آمار کل این worker
+_totals: Dict[str, int] = {}
+_token_totals: Dict[str, Dict[str, int]] = {}
+_final_steps = {"single_call": 0, "with_summary_call": 0}
+
+
+@contextmanager
+def track_calls() -> Iterator[CallStats]:
+    """جمع‌آوری تعداد فراخوانی‌های AI در محدوده این context"""
+    stats = CallStats()
+    token = _current.set(stats)
+    try:
+        yield stats
+    finally:
+        _current.reset(token)
+
+
+def record_call(purpose: str) -> None:
+    """ثبت یک فراخوانی AI (از داخل AIService)"""
+    _totals[purpose] = _totals.get(purpose, 0) + 1
+    stats = _current.get()
+    if stats is not None:
+        stats.add(purpose)
+
+
+def record_usage(purpose: str, usage: Dict[str, int]) -> None:
+    """ثبت مصرف توکن گزارش‌شده توسط سرویس‌دهنده"""
+    totals = _token_totals.setdefault(
+        purpose, {"prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0}
+    )
+    for key in totals:
+        totals[key] += usage.get(key, 0)
+        if METRICS_ENABLED and usage.get(key):
+            llm_tokens.inc(usage[key], purpose=purpose, kind=key.replace("_tokens", ""))
+    stats = _current.get()
+    if stats is not None:
+        stats.add_usage(usage)
+
+
+def parse_usage(data: Optional[dict]) -> Dict[str, int]:
+    """استخراج مصرف توکن از بخش usage پاسخ (سازگار با OpenAI، OpenRouter و Anthropic)"""
+    usage = (data or {}).get("usage") or {}
+    details = usage.get("prompt_tokens_details") or {}
+    return {
+        "prompt_tokens": usage.get("prompt_tokens") or 0,
+        "completion_tokens": usage.get("completion_tokens") or 0,
+        "cached_tokens": details.get("cached_tokens") or usage.get("cache_read_input_tokens") or 0,
+    }
+
+
+def record_final_step(stats: CallStats) -> None:
+    """ثبت اینکه مرحله نهایی با یک فراخوانی تمام شد یا به generate_summary نیاز داشت"""
+    if stats.by_purpose.get("summary"):
+        _final_steps["with_summary_call"] += 1
+    else:
+        _final_steps["single_call"] += 1
+
+
+def get_call_stats() -> dict:
+    return {
+        "calls": dict(_totals),
+        "tokens": {purpose: dict(totals) for purpose, totals in _token_totals.items()},
+        "final_steps": dict(_final_steps),
+    }
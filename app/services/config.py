@@ -0,0 +1,12 @@
+import os
+
+# مقادیری که برای متغیرهای محیطی بولی «روشن» به حساب می‌آیند
+_TRUE_VALUES = ("1", "true", "yes", "on")
+
+
+def env_bool(name: str, default: bool) -> bool:
+    """خواندن متغیر محیطی بولی (1/true/yes/on، بدون حساسیت به حروف)؛ مقدار خالی یعنی پیش‌فرض"""
+    value = os.getenv(name)
+    if value is None or value.strip() == "":
+        return default
+    return value.strip().lower() in _TRUE_VALUES
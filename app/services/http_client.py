@@ -0,0 +1,112 @@
+import os
+import logging
+from typing import Optional
+
+import httpx
+
+from app.services.config import env_bool
+
+logger = logging.getLogger(__name__)
+
+
+def _http2_available() -> bool:
+    """بررسی نصب بودن پکیج h2 برای پشتیبانی از HTTP/2"""
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+# تنظیمات pool اتصال‌ها (قابل تغییر از طریق .env)
+HTTP_MAX_CONNECTIONS = int(os.getenv("AI_HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("AI_HTTP_MAX_KEEPALIVE", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("AI_HTTP_KEEPALIVE_EXPIRY", "30"))
+HTTP_TIMEOUT = float(os.getenv("AI_HTTP_TIMEOUT", "30"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("AI_HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_POOL_TIMEOUT = float(os.getenv("AI_HTTP_POOL_TIMEOUT", "10"))
+HTTP2_ENABLED = env_bool("AI_HTTP2", True)
+
+# کلاینت مشترک در طول عمر worker
+_client: Optional[httpx.AsyncClient] = None
+_requests_sent = 0
+
+
+def create_http_client() -> httpx.AsyncClient:
+    """ساخت کلاینت HTTP با pool اتصال و keep-alive"""
+    global _client
+
+    if _client is not None and not _client.is_closed:
+        return _client
+
+    http2 = HTTP2_ENABLED and _http2_available()
+    if HTTP2_ENABLED and not http2:
+        logger.warning("AI_HTTP2 is enabled but 'h2' is not installed; falling back to HTTP/1.1")
+
+    _client = httpx.AsyncClient(
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(
+            HTTP_TIMEOUT,
+            connect=HTTP_CONNECT_TIMEOUT,
+            pool=HTTP_POOL_TIMEOUT,
+        ),
+        event_hooks={"request": [_count_request]},
+    )
+    logger.info(
+        "Shared HTTP client created (http2=%s, max_connections=%s, max_keepalive=%s)",
+        http2, HTTP_MAX_CONNECTIONS, HTTP_MAX_KEEPALIVE
+    )
+    return _client
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """دریافت کلاینت مشترک (در صورت نبود، ساخته می‌شود)"""
+    if _client is None or _client.is_closed:
+        return create_http_client()
+    return _client
+
+
+async def close_http_client() -> None:
+    """بستن کلاینت مشترک و آزادسازی اتصال‌ها"""
+    global _client
+
+    if _client is not None and not _client.is_closed:
+        await _client.aclose()
+    _client = None
+
+
+async def _count_request(request: httpx.Request) -> None:
+    global _requests_sent
+    _requests_sent += 1
+
+
+def get_pool_stats() -> dict:
+    """آمار pool اتصال‌های کلاینت مشترک"""
+    stats = {
+        "active": _client is not None and not _client.is_closed,
+        "http2_enabled": HTTP2_ENABLED and _http2_available(),
+        "max_connections": HTTP_MAX_CONNECTIONS,
+        "max_keepalive_connections": HTTP_MAX_KEEPALIVE,
+        "requests_sent": _requests_sent,
+        "connections": 0,
+        "idle_connections": 0,
+        "http2_connections": 0,
+    }
+    if not stats["active"]:
+        return stats
+
+    # httpcore اتصال‌های pool را از طریق transport در اختیار می‌گذارد
+    pool = getattr(_client._transport, "_pool", None)
+    for connection in getattr(pool, "connections", []):
+        stats["connections"] += 1
+        if connection.is_idle():
+            stats["idle_connections"] += 1
+        info = connection.info()
+        if "HTTP/2" in info:
+            stats["http2_connections"] += 1
+    return stats
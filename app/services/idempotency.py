@@ -0,0 +1,183 @@
+import os
+import time
+import asyncio
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional
+
+from app.services.tracing import span
+
+# مدت نگهداری نتیجه پاسخ‌های تکمیل‌شده برای تکرار درخواست با همان کلید
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", "300"))
+IDEMPOTENCY_MAX_ENTRIES = int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", "10000"))
+# درخواست در حال اجرایی که بیش از این زمان تمام نشده (مثلاً stream رهاشده) نادیده گرفته می‌شود
+IDEMPOTENCY_INFLIGHT_TIMEOUT = float(os.getenv("IDEMPOTENCY_INFLIGHT_TIMEOUT", "600"))
+
+
+class IdempotencyConflict(Exception):
+    """کلید تکراری با بدنه درخواست متفاوت"""
+
+
+class SessionLocks:
+    """قفل async برای هر جلسه؛ قفل‌های بدون استفاده بلافاصله حذف می‌شوند"""
+
+    def __init__(self):
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._holders: Dict[str, int] = {}
+        self.contended = 0
+
+    @asynccontextmanager
+    async def hold(self, session_id: str) -> AsyncIterator[None]:
+        lock = self._locks.get(session_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[session_id] = lock
+        if lock.locked():
+            self.contended += 1
+        self._holders[session_id] = self._holders.get(session_id, 0) + 1
+        try:
+            with span("session.lock_wait", contended=lock.locked()):
+                await lock.acquire()
+            try:
+                yield
+            finally:
+                lock.release()
+        finally:
+            self._holders[session_id] -= 1
+            if not self._holders[session_id]:
+                del self._holders[session_id]
+                del self._locks[session_id]
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+
+class IdempotencyCache:
+    """
+    یکی کردن درخواست‌های تکراری با کلید یکسان
+
+    درخواست تکراریِ در حال اجرا منتظر همان future می‌ماند و نتیجه درخواست
+    تکمیل‌شده تا ttl ثانیه بدون فراخوانی دوباره AI برگردانده می‌شود. خطاها
+    نگهداری نمی‌شوند تا تلاش دوباره ممکن باشد. اثر انگشت بدنه درخواست همراه
+    کلید ذخیره می‌شود و استفاده دوباره از کلید با بدنه دیگر IdempotencyConflict می‌دهد.
+    """
+
+    def __init__(self, ttl: float = IDEMPOTENCY_TTL, max_entries: int = IDEMPOTENCY_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # key -> (future، زمان انقضا یا None تا وقتی در حال اجراست، زمان شروع، اثر انگشت بدنه)
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+
+        self.executed = 0
+        self.coalesced = 0
+        self.replayed = 0
+        self.conflicts = 0
+
+    def _purge(self) -> None:
+        # نتایج تکمیل‌شده به ترتیب انقضا در انتهای OrderedDict اضافه می‌شوند
+        now = time.monotonic()
+        for key, (_, expires_at, _, _) in list(self._entries.items()):
+            if expires_at is None:
+                continue
+            if expires_at > now and len(self._entries) <= self.max_entries:
+                break
+            del self._entries[key]
+
+    def begin(self, key: str, fingerprint: Optional[str] = None) -> Optional[asyncio.Future]:
+        """
+        اگر درخواستی با این کلید در حال اجرا یا تکمیل‌شده باشد future آن را برمی‌گرداند؛
+        در غیر این صورت کلید را در حال اجرا ثبت می‌کند و None برمی‌گرداند
+
+        اگر درخواست قبلی با اثر انگشت دیگری ثبت شده باشد IdempotencyConflict پرتاب می‌شود.
+        """
+        self._purge()
+        entry = self._entries.get(key)
+        if entry is not None:
+            future, expires_at, started, stored = entry
+            now = time.monotonic()
+            live = (
+                (expires_at is None and now - started < IDEMPOTENCY_INFLIGHT_TIMEOUT)
+                or (expires_at is not None and expires_at > now)
+            )
+            if live:
+                if stored != fingerprint:
+                    self.conflicts += 1
+                    raise IdempotencyConflict(
+                        "این کلید idempotency قبلاً برای درخواست دیگری استفاده شده است."
+                    )
+                if expires_at is None:
+                    self.coalesced += 1
+                else:
+                    self.replayed += 1
+                return future
+            del self._entries[key]
+
+        self.executed += 1
+        future = asyncio.get_running_loop().create_future()
+        self._entries[key] = (future, None, time.monotonic(), fingerprint)
+        return None
+
+    def complete(self, key: str, value: Any) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        future, _, started, fingerprint = entry
+        if not future.done():
+            future.set_result(value)
+        self._entries[key] = (future, time.monotonic() + self.ttl, started, fingerprint)
+
+    def fail(self, key: str, error: BaseException) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        future = entry[0]
+        if future.done():
+            return
+        if isinstance(error, asyncio.CancelledError):
+            future.cancel()
+        else:
+            future.set_exception(error)
+            # اگر کسی منتظر نبود، هشدار «exception never retrieved» ندهد
+            future.exception()
+
+    async def run(
+        self,
+        key: str,
+        factory: Callable[[], Awaitable[Any]],
+        fingerprint: Optional[str] = None
+    ) -> Any:
+        """اجرای factory فقط یک بار برای هر کلید"""
+        existing = self.begin(key, fingerprint)
+        if existing is not None:
+            return await asyncio.shield(existing)
+        try:
+            value = await factory()
+        except BaseException as e:
+            self.fail(key, e)
+            raise
+        self.complete(key, value)
+        return value
+
+    def stats(self) -> dict:
+        in_flight = sum(1 for _, expires_at, _, _ in self._entries.values() if expires_at is None)
+        return {
+            "entries": len(self._entries),
+            "in_flight": in_flight,
+            "executed": self.executed,
+            "coalesced": self.coalesced,
+            "replayed": self.replayed,
+            "conflicts": self.conflicts,
+            "ttl": self.ttl,
+        }
+
+
+session_locks = SessionLocks()
+answer_cache = IdempotencyCache()
+
+
+def get_idempotency_stats() -> dict:
+    return {
+        **answer_cache.stats(),
+        "session_locks": len(session_locks),
+        "lock_contention": session_locks.contended,
+    }
@@ -0,0 +1,316 @@
+import os
+import re
+import copy
+import sys
+import json
+import time
+import queue
+import atexit
+import random
+import logging
+import threading
+from contextvars import ContextVar
+from typing import List, Optional, Set
+
+# قالب خروجی: json (یک شیء JSON در هر سطر) | text (قالب قبلی)
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# مسیر فایل لاگ؛ خالی = stderr (مانند قبل)
+LOG_FILE = os.getenv("LOG_FILE", "")
+# ظرفیت صف لاگ؛ با پر شدن صف رکوردهای جدید دور ریخته و شمرده می‌شوند (درخواست‌ها هیچ‌وقت منتظر نمی‌مانند)
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# متن‌های بلند (مثل پاسخ سرویس‌دهنده) حداکثر با این طول ثبت می‌شوند
+LOG_PAYLOAD_MAX_CHARS = int(os.getenv("LOG_PAYLOAD_MAX_CHARS", "512"))
+# سهم رکوردهایی که متن payload را هم دارند (بقیه فقط طول آن را)
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "0.1"))
+
+TEXT_FORMAT = "%(levelname)s:%(name)s:[%(trace_id)s] %(message)s"
+WRITE_BATCH = 256
+REDACTED = "[REDACTED]"
+
+# ویژگی‌های استاندارد LogRecord؛ بقیه (extra=...) به عنوان فیلد ساختاریافته ثبت می‌شوند
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "trace_id", "context"}
+_SECRET_KEY = re.compile(r"(?i)api[_-]?key|authorization|token|secret|password")
+_SECRET_PATTERNS = [
+    (re.compile(r"(?i)\bBearer\s+[A-Za-z0-9._~+/=\-]+"), "Bearer " + REDACTED),
+    (re.compile(r"\bsk-[A-Za-z0-9_\-]{8,}"), REDACTED),
+    (re.compile(r"""(?i)(["']?(?:api[_-]?key|authorization|token|secret|password)["']?\s*[:=]\s*["']?)[^"'\s,}]+"""), r"\1" + REDACTED),
+]
+# کلیدهای API شناخته‌شده (ثبت‌شده توسط رجیستری سرویس‌دهنده‌ها) با هر قالبی پوشانده می‌شوند
+_secrets: Set[str] = set()
+
+_context: ContextVar[Optional[dict]] = ContextVar("log_context", default=None)
+
+_stats = {
+    "enqueued": 0,
+    "written": 0,
+    "dropped": {},
+    "payloads": 0,
+    "payloads_sampled": 0,
+    "errors": 0,
+}
+
+
+def add_secret(value: Optional[str]) -> None:
+    """ثبت یک مقدار محرمانه برای پوشاندن در همه لاگ‌ها"""
+    if value and len(value) >= 8:
+        _secrets.add(value)
+
+
+def redact(text: str) -> str:
+    for secret in _secrets:
+        if secret in text:
+            text = text.replace(secret, REDACTED)
+    for pattern, replacement in _SECRET_PATTERNS:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+def log_payload(text: Optional[str]) -> dict:
+    """
+    فیلد لاگ برای یک متن بزرگ: همیشه طول، و فقط در سهمی از رکوردها خود متن (کوتاه‌شده)
+    """
+    text = text or ""
+    _stats["payloads"] += 1
+    payload = {"chars": len(text)}
+    if random.random() < LOG_PAYLOAD_SAMPLE_RATE:
+        _stats["payloads_sampled"] += 1
+        payload["text"] = text[:LOG_PAYLOAD_MAX_CHARS]
+        if len(text) > LOG_PAYLOAD_MAX_CHARS:
+            payload["truncated"] = True
+    return payload
+
+
+def update_log_context(**fields) -> None:
+    """افزودن فیلد به context درخواست جاری (session_id، step، تاخیر سرویس‌دهنده و ...)"""
+    current = _context.get()
+    if current is not None:
+        current.update(fields)
+
+
+class LogContextMiddleware:
+    """context خالی لاگ برای هر درخواست HTTP/WebSocket (مشترک بین taskهای همان درخواست)"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            await self.app(scope, receive, send)
+            return
+        token = _context.set({})
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _context.reset(token)
+
+
+class JsonLogFormatter(logging.Formatter):
+    """یک رکورد در هر سطر: زمان، سطح، logger، پیام، trace_id، context درخواست و فیلدهای extra"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        trace_id = getattr(record, "trace_id", None)
+        if trace_id and trace_id != "-":
+            entry["trace_id"] = trace_id
+        entry.update(getattr(record, "context", None) or {})
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and not key.startswith("_"):
+                entry[key] = REDACTED if _SECRET_KEY.search(key) else value
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return redact(json.dumps(entry, ensure_ascii=False, default=str))
+
+
+class RedactingFormatter(logging.Formatter):
+    """قالب متنی قبلی همراه با context درخواست و پوشاندن مقادیر محرمانه"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        context = getattr(record, "context", None)
+        if context:
+            text += " " + " ".join(f"{key}={value}" for key, value in context.items())
+        return redact(text)
+
+
+_STOP = object()
+
+
+class QueueLogHandler(logging.Handler):
+    """
+    handler غیرمسدودکننده: رکورد در همان لحظه آماده و در صف محدود قرار می‌گیرد
+
+    نوشتن روی stderr/فایل در یک thread جداگانه انجام می‌شود تا خروجی کند
+    event loop را متوقف نکند. با پر بودن صف، رکورد دور ریخته و در
+    تعداد dropped (به تفکیک سطح) شمرده می‌شود.
+    """
+
+    def __init__(
+        self,
+        formatter: logging.Formatter,
+        maxsize: int = LOG_QUEUE_SIZE,
+        path: str = LOG_FILE,
+        stream=None,
+        stats: Optional[dict] = None
+    ):
+        super().__init__()
+        self.setFormatter(formatter)
+        self.maxsize = maxsize
+        self.path = path
+        # خروجی بدون path (پیش‌فرض stderr) و آمار جداگانه برای خروجی‌های دیگر (مثل spanها)
+        self.default_stream = stream
+        self.stats = _stats if stats is None else stats
+        self.queue: "queue.Queue" = queue.Queue(maxsize)
+        self._stream = None
+        self._thread: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+        self._stopped = False
+        self._reported_drops = 0
+
+    def _output(self):
+        if self._stream is None:
+            self._stream = open(self.path, "a", encoding="utf-8") if self.path else (self.default_stream or sys.stderr)
+        return self._stream
+
+    def start(self) -> None:
+        # پس از fork (مثلاً preload در gunicorn) thread و صف والد در فرزند قابل استفاده نیستند
+        if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+            return
+        self.queue = queue.Queue(self.maxsize)
+        self._stream = None
+        self._pid = os.getpid()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """آماده‌سازی در thread فراخواننده: پیام نهایی، متن خطا و context درخواست"""
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = self.formatter.formatException(record.exc_info)
+            record.exc_info = None
+        record.context = dict(_context.get() or {})
+        return record
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            record = self.prepare(record)
+            if self._stopped:
+                # پس از توقف (خاموش شدن برنامه) مستقیم نوشته می‌شود
+                self._write([self.format(record)])
+                return
+            if self._pid != os.getpid():
+                self.start()
+            self.queue.put_nowait(record)
+            self.stats["enqueued"] += 1
+        except queue.Full:
+            self.stats["dropped"][record.levelname] = self.stats["dropped"].get(record.levelname, 0) + 1
+        except Exception:
+            self.stats["errors"] += 1
+
+    def _write(self, lines: List[str]) -> None:
+        try:
+            stream = self._output()
+            stream.write("\n".join(lines) + "\n")
+            stream.flush()
+            self.stats["written"] += len(lines)
+        except Exception:
+            self.stats["errors"] += 1
+
+    def _run(self) -> None:
+        while True:
+            records = [self.queue.get()]
+            try:
+                while len(records) < WRITE_BATCH:
+                    records.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            stop = False
+            lines = []
+            for record in records:
+                if record is _STOP:
+                    stop = True
+                    continue
+                try:
+                    lines.append(self.format(record))
+                except Exception:
+                    self.stats["errors"] += 1
+
+            dropped = sum(self.stats["dropped"].values())
+            if dropped > self._reported_drops:
+                lines.append(self.format(logging.makeLogRecord({
+                    "name": __name__,
+                    "levelno": logging.WARNING,
+                    "levelname": "WARNING",
+                    "trace_id": "-",
+                    "msg": f"{dropped - self._reported_drops} log records dropped (queue full)",
+                })))
+                self._reported_drops = dropped
+            if lines:
+                self._write(lines)
+            if stop:
+                return
+
+    def stop(self, timeout: float = 2.0) -> None:
+        """نوشتن رکوردهای باقی‌مانده و توقف thread"""
+        if self._stopped:
+            return
+        self._stopped = True
+        thread = self._thread
+        if thread is None or not thread.is_alive() or self._pid != os.getpid():
+            return
+        try:
+            self.queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            return
+        thread.join(timeout)
+
+
+_handler: Optional[QueueLogHandler] = None
+
+
+def configure_logging() -> None:
+    """
+    راه‌اندازی لاگ غیرمسدودکننده برای ریشه و loggerهای uvicorn (یک بار)
+
+    مانند logging.basicConfig، اگر ریشه از قبل handler داشته باشد تغییری نمی‌دهد.
+    """
+    global _handler
+    root = logging.getLogger()
+    if _handler is not None or root.handlers:
+        return
+    formatter = JsonLogFormatter() if LOG_FORMAT == "json" else RedactingFormatter(TEXT_FORMAT)
+    _handler = QueueLogHandler(formatter)
+    _handler.start()
+    root.addHandler(_handler)
+    root.setLevel(LOG_LEVEL)
+    # لاگ دسترسی uvicorn هم در مسیر هر درخواست نوشته می‌شود
+    for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+        uvicorn_logger = logging.getLogger(name)
+        uvicorn_logger.handlers = []
+        uvicorn_logger.propagate = True
+    atexit.register(stop_logging)
+
+
+def stop_logging() -> None:
+    if _handler is not None:
+        _handler.stop()
+
+
+def get_logging_stats() -> dict:
+    return {
+        "format": LOG_FORMAT,
+        "queue_size": LOG_QUEUE_SIZE,
+        "queued": _handler.queue.qsize() if _handler is not None else 0,
+        **_stats,
+        "dropped_total": sum(_stats["dropped"].values()),
+    }
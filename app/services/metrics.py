@@ -0,0 +1,485 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from app.services.config import env_bool
+
+try:
+    import fcntl
+except ImportError:  # ویندوز؛ gunicorn فقط روی یونیکس اجرا می‌شود
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# متریک‌های Prometheus بدون وابستگی خارجی
+METRICS_ENABLED = env_bool("METRICS_ENABLED", True)
+# پوشه مشترک workerهای gunicorn؛ هر worker آمار خود را در آن می‌نویسد و /metrics همه را جمع می‌کند
+METRICS_DIR = os.getenv("METRICS_DIR", "")
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))
+# gaugeهای workerی که در این مدت آمار ننوشته کنار گذاشته می‌شوند (شمارنده‌هایش می‌مانند)
+METRICS_STALE_AFTER = 3 * METRICS_FLUSH_INTERVAL
+# شمارنده‌ها و هیستوگرام‌های workerهای خاتمه‌یافته در این فایل جمع می‌شوند تا جمع کل عقب نرود
+METRICS_ARCHIVE_FILE = "metrics-archive.json"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], object] = {}
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def snapshot(self) -> dict:
+        return {
+            "kind": self.kind,
+            "help": self.documentation,
+            "labels": list(self.labelnames),
+            "values": [[list(key), value] for key, value in self._values.items()],
+        }
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """مقدار لحظه‌ای؛ در جمع چند worker فقط workerهای زنده جمع زده می‌شوند"""
+
+    kind = "gauge"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            # تعداد هر bucket (غیرتجمعی)، سپس مجموع و تعداد کل
+            state = [[0] * len(self.buckets), 0.0, 0]
+            self._values[key] = state
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[0][index] += 1
+                break
+        state[1] += value
+        state[2] += 1
+
+    def snapshot(self) -> dict:
+        data = super().snapshot()
+        data["buckets"] = list(self.buckets)
+        return data
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def snapshot(self) -> Dict[str, dict]:
+        return {metric.name: metric.snapshot() for metric in self._metrics}
+
+
+registry = Registry()
+
+http_request_duration = registry.register(Histogram(
+    "whys_http_request_duration_seconds",
+    "End-to-end HTTP request latency (including streamed bodies)",
+    ["route", "method", "status"]
+))
+llm_connect_duration = registry.register(Histogram(
+    "whys_llm_connect_seconds",
+    "Time to open a new connection to the AI provider (TCP + TLS)",
+    ["provider"]
+))
+llm_ttfb = registry.register(Histogram(
+    "whys_llm_ttfb_seconds",
+    "Time from sending an AI request to receiving response headers",
+    ["provider", "purpose"]
+))
+llm_duration = registry.register(Histogram(
+    "whys_llm_duration_seconds",
+    "Total AI request latency including the response body",
+    ["provider", "purpose"]
+))
+llm_in_flight = registry.register(Gauge(
+    "whys_llm_in_flight",
+    "AI requests currently in progress",
+    ["provider"]
+))
+llm_tokens = registry.register(Counter(
+    "whys_llm_tokens_total",
+    "Tokens reported by the AI provider per AIService call type",
+    ["purpose", "kind"]
+))
+admission_wait = registry.register(Histogram(
+    "whys_admission_wait_seconds",
+    "Time spent waiting in the AI admission queue",
+    ["purpose"]
+))
+session_steps = registry.register(Histogram(
+    "whys_session_steps",
+    "Number of why steps needed to reach the root cause",
+    [],
+    buckets=(1, 2, 3, 4, 5, 6, 7)
+))
+errors = registry.register(Counter(
+    "whys_errors_total",
+    "Errors by source and class",
+    ["source", "error"]
+))
+
+
+class RequestTrace:
+    """
+    زمان‌بندی مراحل یک درخواست AI با extension «trace» در httpx
+
+    زمان اتصال فقط وقتی ثبت می‌شود که اتصال جدیدی باز شده باشد (نه از pool).
+    """
+
+    def __init__(self, provider: str, purpose: str):
+        self.provider = provider
+        self.purpose = purpose
+        self.started = time.perf_counter()
+        self.connect_started: Optional[float] = None
+        self.connected: Optional[float] = None
+        self.headers_received: Optional[float] = None
+        self._finished = False
+        if METRICS_ENABLED:
+            llm_in_flight.inc(provider=provider)
+
+    async def __call__(self, event: str, info: dict) -> None:
+        now = time.perf_counter()
+        if event == "connection.connect_tcp.started":
+            self.connect_started = now
+        elif event in ("connection.connect_tcp.complete", "connection.start_tls.complete"):
+            self.connected = now
+        elif event.endswith("receive_response_headers.complete"):
+            self.headers_received = now
+
+    @property
+    def extensions(self) -> dict:
+        return {"trace": self} if METRICS_ENABLED else {}
+
+    def finish(self) -> None:
+        if self._finished or not METRICS_ENABLED:
+            return
+        self._finished = True
+        llm_in_flight.dec(provider=self.provider)
+        if self.connect_started is not None and self.connected is not None:
+            llm_connect_duration.observe(self.connected - self.connect_started, provider=self.provider)
+        if self.headers_received is not None:
+            llm_ttfb.observe(self.headers_received - self.started, provider=self.provider, purpose=self.purpose)
+            llm_duration.observe(time.perf_counter() - self.started, provider=self.provider, purpose=self.purpose)
+
+
+def record_error(source: str, error: str) -> None:
+    if METRICS_ENABLED:
+        errors.inc(source=source, error=error)
+
+
+class MetricsMiddleware:
+    """
+    ثبت زمان کل هر درخواست HTTP تا ارسال آخرین بخش بدنه
+
+    برای SSE و NDJSON یعنی تا پایان stream. برچسب route الگوی مسیر است
+    (مثلاً /api/session/{session_id}) تا تعداد سری‌ها محدود بماند.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not METRICS_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            http_request_duration.observe(
+                time.perf_counter() - started,
+                route=_route_label(scope),
+                method=scope["method"],
+                status=str(status)
+            )
+
+
+def _route_label(scope) -> str:
+    from starlette.routing import Match
+
+    app = scope.get("app")
+    for route in getattr(getattr(app, "router", None), "routes", []):
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return "unmatched"
+
+
+# --- جمع‌آوری بین workerها ---
+
+def _snapshot_path(pid: int) -> str:
+    return os.path.join(METRICS_DIR, f"metrics-{pid}.json")
+
+
+def _write_file(path: str, data: str) -> None:
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    temp = f"{path}.tmp"
+    with open(temp, "w", encoding="utf-8") as f:
+        f.write(data)
+    os.replace(temp, path)
+
+
+async def write_snapshot() -> None:
+    """نوشتن اتمی آمار این worker در METRICS_DIR (نوشتن فایل بیرون از event loop)"""
+    if not METRICS_DIR:
+        return
+    # سریال‌سازی روی event loop؛ حالت هیستوگرام‌ها هم‌زمان با درخواست‌ها تغییر می‌کند
+    data = json.dumps(registry.snapshot())
+    await asyncio.to_thread(_write_file, _snapshot_path(os.getpid()), data)
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+@contextmanager
+def _dir_lock():
+    """قفل بین فرایندی METRICS_DIR تا یک worker خاتمه‌یافته دو بار جمع زده نشود"""
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    with open(os.path.join(METRICS_DIR, ".lock"), "w") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def _read_snapshot(path: str) -> Optional[Dict[str, dict]]:
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (ValueError, OSError):
+        return None
+
+
+def _without_gauges(snapshot: Dict[str, dict]) -> Dict[str, dict]:
+    return {name: metric for name, metric in snapshot.items() if metric["kind"] != "gauge"}
+
+
+def _fold(archive: Dict[str, dict], snapshot: Dict[str, dict]) -> Dict[str, dict]:
+    """افزودن شمارنده‌ها و هیستوگرام‌های یک worker به آمار workerهای خاتمه‌یافته"""
+    merged = _merge([archive, _without_gauges(snapshot)])
+    return {
+        name: {**metric, "values": [[list(key), value] for key, value in metric["values"].items()]}
+        for name, metric in merged.items()
+    }
+
+
+def _retire(pid: int, snapshot: Dict[str, dict]) -> None:
+    """انتقال آمار یک worker به فایل بایگانی و حذف فایل آن (زیر قفل پوشه)"""
+    archive_path = os.path.join(METRICS_DIR, METRICS_ARCHIVE_FILE)
+    archive = _fold(_read_snapshot(archive_path) or {}, snapshot)
+    # اول بایگانی نوشته می‌شود؛ با خطا فایل worker می‌ماند و بعداً دوباره منتقل می‌شود
+    _write_file(archive_path, json.dumps(archive))
+    try:
+        os.remove(_snapshot_path(pid))
+    except OSError:
+        pass
+
+
+def _load_snapshots() -> List[Dict[str, dict]]:
+    """
+    خواندن آمار همه workerها (در thread جداگانه)
+
+    آمار workerهای خاتمه‌یافته به فایل بایگانی منتقل می‌شود تا شمارنده‌ها با
+    راه‌اندازی دوباره workerها عقب نروند؛ gaugeهای آن‌ها و gaugeهای workerی که
+    چند دوره آمار ننوشته کنار گذاشته می‌شوند.
+    """
+    snapshots = []
+    with _dir_lock():
+        for name in sorted(os.listdir(METRICS_DIR)):
+            if not (name.startswith("metrics-") and name.endswith(".json")) or name == METRICS_ARCHIVE_FILE:
+                continue
+            path = os.path.join(METRICS_DIR, name)
+            try:
+                pid = int(name[len("metrics-"):-len(".json")])
+                stale = pid != os.getpid() and time.time() - os.path.getmtime(path) > METRICS_STALE_AFTER
+            except (ValueError, OSError):
+                continue
+            snapshot = _read_snapshot(path)
+            if snapshot is None:
+                continue
+            if pid != os.getpid() and not _pid_alive(pid):
+                _retire(pid, snapshot)
+            elif stale:
+                snapshots.append(_without_gauges(snapshot))
+            else:
+                snapshots.append(snapshot)
+        archive = _read_snapshot(os.path.join(METRICS_DIR, METRICS_ARCHIVE_FILE))
+    if archive:
+        snapshots.append(archive)
+    return snapshots
+
+
+def _merge(snapshots: List[Dict[str, dict]]) -> Dict[str, dict]:
+    """جمع آمار workerها (شمارنده‌ها، gaugeها و bucketهای هیستوگرام)"""
+    merged: Dict[str, dict] = {}
+    for snapshot in snapshots:
+        for name, metric in snapshot.items():
+            target = merged.setdefault(name, {**metric, "values": {}})
+            for key, value in metric["values"]:
+                key = tuple(key)
+                current = target["values"].get(key)
+                if metric["kind"] == "histogram":
+                    if current is None or len(current[0]) != len(value[0]):
+                        current = [[0] * len(value[0]), 0.0, 0]
+                    target["values"][key] = [
+                        [a + b for a, b in zip(current[0], value[0])],
+                        current[1] + value[1],
+                        current[2] + value[2]
+                    ]
+                else:
+                    target["values"][key] = (current or 0) + value
+    return merged
+
+
+async def render_metrics() -> str:
+    """خروجی متنی قالب Prometheus (version 0.0.4) برای همه workerها"""
+    if not METRICS_DIR:
+        return _render(_merge([registry.snapshot()]))
+    await write_snapshot()
+    merged = await asyncio.to_thread(lambda: _merge(_load_snapshots()))
+    return _render(merged)
+
+
+def _render(merged: Dict[str, dict]) -> str:
+    lines = []
+    for name, metric in sorted(merged.items()):
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['kind']}")
+        labelnames = metric["labels"]
+        for key, value in sorted(metric["values"].items()):
+            if metric["kind"] != "histogram":
+                lines.append(f"{name}{_format_labels(labelnames, key)} {_format_value(value)}")
+                continue
+            counts, total, count = value
+            inf = 'le="+Inf"'
+            cumulative = 0
+            for bound, bucket_count in zip(metric["buckets"], counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{name}_bucket{_format_labels(labelnames, key, le)} {cumulative}")
+            lines.append(f"{name}_bucket{_format_labels(labelnames, key, inf)} {count}")
+            lines.append(f"{name}_sum{_format_labels(labelnames, key)} {_format_value(total)}")
+            lines.append(f"{name}_count{_format_labels(labelnames, key)} {count}")
+    return "\n".join(lines) + "\n"
+
+
+_writer: Optional[asyncio.Task] = None
+
+
+async def _write_periodically() -> None:
+    while True:
+        await asyncio.sleep(METRICS_FLUSH_INTERVAL)
+        try:
+            await write_snapshot()
+        except OSError as e:
+            logger.warning("Could not write metrics snapshot: %s", e)
+
+
+def start_metrics_writer() -> None:
+    """شروع نوشتن دوره‌ای آمار این worker (فقط در صورت تنظیم METRICS_DIR)"""
+    global _writer
+    if METRICS_DIR and METRICS_ENABLED and _writer is None:
+        _writer = asyncio.create_task(_write_periodically())
+
+
+async def stop_metrics_writer() -> None:
+    global _writer
+    if _writer is not None:
+        _writer.cancel()
+        try:
+            await _writer
+        except asyncio.CancelledError:
+            pass
+        _writer = None
+    if METRICS_DIR and METRICS_ENABLED:
+        # شمارنده‌های این worker در بایگانی می‌مانند و gaugeهایش از جمع /metrics حذف می‌شوند
+        snapshot = registry.snapshot()
+
+        def retire():
+            with _dir_lock():
+                _retire(os.getpid(), snapshot)
+
+        try:
+            await asyncio.to_thread(retire)
+        except OSError as e:
+            logger.warning("Could not archive metrics snapshot: %s", e)
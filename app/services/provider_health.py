@@ -0,0 +1,268 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Dict, Optional
+
+from app.models.schemas import AIConfig
+from app.services.http_client import get_http_client
+from app.services.admission import AdmissionRejected
+
+logger = logging.getLogger(__name__)
+
+# تنظیمات پایش سلامت سرویس‌دهنده AI
+HEALTH_PROBE_MODE = os.getenv("AI_HEALTH_PROBE", "models")  # models | chat | off
+HEALTH_INTERVAL = float(os.getenv("AI_HEALTH_INTERVAL", "30"))
+# اعتبار آخرین نشانه سلامت (probe یا فراخوانی موفق)؛ پس از آن تا تایید دوباره فقط یک درخواست آزمایشی
+HEALTH_TTL = float(os.getenv("AI_HEALTH_TTL", "90"))
+HEALTH_PROBE_TIMEOUT = float(os.getenv("AI_HEALTH_PROBE_TIMEOUT", "5"))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("AI_BREAKER_FAILURE_THRESHOLD", "3"))
+BREAKER_RESET_TIMEOUT = float(os.getenv("AI_BREAKER_RESET_TIMEOUT", "30"))
+
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_OPEN = "open"
+CIRCUIT_HALF_OPEN = "half_open"
+
+
+class ProviderUnavailable(AdmissionRejected):
+    """درخواست آزمایشی دیگری برای این سرویس‌دهنده در جریان است"""
+
+
+class ProviderHealthMonitor:
+    """پایش دوره‌ای سلامت سرویس‌دهنده AI همراه با circuit breaker"""
+
+    def __init__(self, config: AIConfig):
+        self.base_url = config.base_url.rstrip('/')
+        self.api_key = config.api_key
+        self.model_id = config.model_id
+
+        self.circuit = CIRCUIT_CLOSED
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+        self.last_probe_at: Optional[float] = None
+        self.last_probe_ok: Optional[bool] = None
+        self.last_probe_status: Optional[int] = None
+        self.last_probe_latency: Optional[float] = None
+        self.last_error: Optional[str] = None
+        self.probes = 0
+        self.trips = 0
+        # آخرین موفقیت (probe یا فراخوانی واقعی)؛ در شروع سالم فرض می‌شود
+        self.last_ok_at = time.monotonic()
+        # زمان شروع درخواست آزمایشی در جریان (حالت نیمه‌باز یا سلامت تاییدنشده)
+        self.trial_started_at: Optional[float] = None
+
+        self._task: Optional[asyncio.Task] = None
+
+    async def probe(self) -> bool:
+        """یک بار بررسی سلامت سرویس‌دهنده"""
+        started = time.monotonic()
+        status = None
+        try:
+            if HEALTH_PROBE_MODE == "chat":
+                # تست کامل (پرهزینه) فقط در صورت درخواست صریح
+                from app.services.ai_service import test_openrouter_connection
+                ok = await test_openrouter_connection(self.api_key, self.base_url, self.model_id)
+                error = None if ok else "chat probe failed"
+            else:
+                # endpoint لیست مدل‌ها رایگان و سبک است
+                response = await get_http_client().get(
+                    f"{self.base_url}/models",
+                    headers={"Authorization": f"Bearer {self.api_key}"},
+                    timeout=HEALTH_PROBE_TIMEOUT
+                )
+                status = response.status_code
+                # 404/405 یعنی سرویس در دسترس است ولی این endpoint را ندارد
+                ok = status < 500 and status not in (401, 403)
+                error = None if ok else f"HTTP {status}"
+        except Exception as e:
+            ok = False
+            error = f"{type(e).__name__}: {e}"
+
+        self.probes += 1
+        self.last_probe_at = time.time()
+        self.last_probe_ok = ok
+        self.last_probe_status = status
+        self.last_probe_latency = round(time.monotonic() - started, 4)
+
+        if ok:
+            self.record_success()
+        else:
+            self.record_failure(error)
+        return ok
+
+    def record_success(self) -> None:
+        """ثبت موفقیت (از probe یا فراخوانی واقعی)"""
+        if self.circuit != CIRCUIT_CLOSED:
+            logger.info("Provider circuit closed for %s", self.base_url)
+        self.circuit = CIRCUIT_CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.last_ok_at = time.monotonic()
+        self.trial_started_at = None
+
+    def record_failure(self, error: Optional[str] = None) -> None:
+        """ثبت خطا و باز کردن مدار پس از رسیدن به آستانه"""
+        self.consecutive_failures += 1
+        self.last_error = error
+        self.trial_started_at = None
+
+        if self.circuit == CIRCUIT_HALF_OPEN or (
+            self.circuit == CIRCUIT_CLOSED
+            and self.consecutive_failures >= BREAKER_FAILURE_THRESHOLD
+        ):
+            self.circuit = CIRCUIT_OPEN
+            self.opened_at = time.monotonic()
+            self.trips += 1
+            logger.warning("Provider circuit opened for %s: %s", self.base_url, error)
+
+    def _needs_trial(self) -> bool:
+        """نیمه‌باز، یا بدون نشانه سلامت در HEALTH_TTL اخیر (پایشگر متوقف یا گیر کرده)"""
+        if self.circuit == CIRCUIT_HALF_OPEN:
+            return True
+        return HEALTH_PROBE_MODE != "off" and time.monotonic() - self.last_ok_at > HEALTH_TTL
+
+    def _trial_in_flight(self) -> bool:
+        # درخواست آزمایشی بی‌نتیجه (مثلاً 429) پس از BREAKER_RESET_TIMEOUT آزاد می‌شود
+        return (
+            self.trial_started_at is not None
+            and time.monotonic() - self.trial_started_at < BREAKER_RESET_TIMEOUT
+        )
+
+    def is_available(self, peek: bool = False) -> bool:
+        """
+        آیا می‌توان درخواست را به سرویس‌دهنده فرستاد (فقط از وضعیت کش‌شده)
+
+        با peek=True وضعیت فقط خوانده می‌شود و مدار باز نیمه‌باز نمی‌شود (/health و ترتیب مسیریاب).
+        """
+        if self.circuit == CIRCUIT_OPEN:
+            if time.monotonic() - self.opened_at < BREAKER_RESET_TIMEOUT:
+                return False
+            if peek:
+                # با رسیدن اولین درخواست، مدار نیمه‌باز و درخواست آزمایشی آزاد است
+                return not self._trial_in_flight()
+            # پس از گذشت زمان انتظار، یک درخواست آزمایشی مجاز است
+            self.circuit = CIRCUIT_HALF_OPEN
+        # تا مشخص شدن نتیجه درخواست آزمایشی، بقیه درخواست‌ها رد می‌شوند
+        return not (self._needs_trial() and self._trial_in_flight())
+
+    def acquire(self) -> bool:
+        """مجوز ارسال یک فراخوانی واقعی؛ در حالت آزمایشی فقط یک فراخوانی هم‌زمان"""
+        if not self.is_available():
+            return False
+        if self._needs_trial():
+            self.trial_started_at = time.monotonic()
+        return True
+
+    def is_probe_fresh(self) -> bool:
+        return (
+            self.last_probe_at is not None
+            and time.time() - self.last_probe_at <= HEALTH_TTL
+        )
+
+    def snapshot(self) -> dict:
+        """وضعیت فعلی برای نمایش در /health"""
+        return {
+            "base_url": self.base_url,
+            "circuit": self.circuit,
+            "available": self.is_available(peek=True),
+            "trial_in_flight": self._needs_trial() and self._trial_in_flight(),
+            "consecutive_failures": self.consecutive_failures,
+            "trips": self.trips,
+            "probe_mode": HEALTH_PROBE_MODE,
+            "probes": self.probes,
+            "last_probe_ok": self.last_probe_ok if self.is_probe_fresh() else None,
+            "last_probe_status": self.last_probe_status,
+            "last_probe_latency": self.last_probe_latency,
+            "last_probe_at": self.last_probe_at,
+            "last_error": self.last_error,
+        }
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.probe()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Provider health probe crashed: %s", e)
+            await asyncio.sleep(HEALTH_INTERVAL)
+
+    def start(self) -> None:
+        if HEALTH_PROBE_MODE == "off" or self._task is not None:
+            return
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+
+# یک پایشگر برای هر base_url در هر worker
+_monitors: Dict[str, ProviderHealthMonitor] = {}
+
+
+def start_health_monitor(config: AIConfig) -> Optional[ProviderHealthMonitor]:
+    """ساخت و شروع پایشگر برای یک سرویس‌دهنده"""
+    if not config.api_key:
+        return None
+    base_url = config.base_url.rstrip('/')
+    monitor = _monitors.get(base_url)
+    if monitor is None:
+        monitor = ProviderHealthMonitor(config)
+        _monitors[base_url] = monitor
+    monitor.start()
+    return monitor
+
+
+async def stop_health_monitors() -> None:
+    for monitor in _monitors.values():
+        await monitor.stop()
+    _monitors.clear()
+
+
+async def stop_health_monitor(base_url: str) -> None:
+    """توقف پایشگر یک سرویس‌دهنده (مثلاً پس از حذف یا تغییر آن در تنظیمات)"""
+    monitor = _monitors.pop(base_url.rstrip('/'), None)
+    if monitor is not None:
+        await monitor.stop()
+
+
+def get_health_monitor(base_url: str) -> Optional[ProviderHealthMonitor]:
+    return _monitors.get(base_url.rstrip('/'))
+
+
+def is_provider_available(base_url: str) -> bool:
+    """وضعیت کش‌شده سرویس‌دهنده بدون تغییر وضعیت مدار؛ بدون پایشگر همیشه True است"""
+    monitor = get_health_monitor(base_url)
+    return monitor is None or monitor.is_available(peek=True)
+
+
+def acquire_provider(base_url: str) -> None:
+    """
+    گرفتن مجوز پیش از ارسال فراخوانی؛ ProviderUnavailable اگر مدار باز است یا
+    درخواست آزمایشی دیگری در جریان است (مسیریاب به سرویس‌دهنده بعدی می‌رود)
+    """
+    monitor = get_health_monitor(base_url)
+    if monitor is not None and not monitor.acquire():
+        raise ProviderUnavailable("اتصال به سرویس AI در حال بررسی است. لطفاً چند لحظه دیگر دوباره تلاش کنید.")
+
+
+def record_provider_result(base_url: str, ok: bool, error: Optional[str] = None) -> None:
+    """گزارش نتیجه فراخوانی واقعی به circuit breaker"""
+    monitor = get_health_monitor(base_url)
+    if monitor is None:
+        return
+    if ok:
+        monitor.record_success()
+    else:
+        monitor.record_failure(error)
+
+
+def get_health_snapshot() -> list:
+    return [monitor.snapshot() for monitor in _monitors.values()]
@@ -0,0 +1,265 @@
+import os
+import time
+import asyncio
+import signal
+import hashlib
+import logging
+from typing import Dict, List, Optional, Set
+from dotenv import dotenv_values
+
+from app.models.schemas import AIConfig
+from app.services.ai_service import AIService, validate_openrouter_config
+from app.services.provider_router import parse_provider_configs, load_provider_configs
+from app.services.provider_health import start_health_monitor, stop_health_monitor
+from app.services.log_pipeline import add_secret
+
+logger = logging.getLogger(__name__)
+
+# فایل تنظیمات سرویس‌دهنده‌ها (قالب .env)؛ مقادیر آن بر متغیرهای محیطی مقدم‌اند و با reload دوباره خوانده می‌شوند
+AI_CONFIG_FILE = os.getenv("AI_CONFIG_FILE", "")
+# فاصله بررسی تغییر AI_CONFIG_FILE (ثانیه)؛ 0 = فقط با سیگنال
+AI_CONFIG_WATCH_INTERVAL = float(os.getenv("AI_CONFIG_WATCH_INTERVAL", "0"))
+# سیگنالی که هر worker با دریافت آن تنظیمات را دوباره می‌خواند (خالی = غیرفعال)؛
+# SIGHUP نیست چون gunicorn با آن workerها را دوباره راه‌اندازی می‌کند
+AI_CONFIG_RELOAD_SIGNAL = os.getenv("AI_CONFIG_RELOAD_SIGNAL", "SIGUSR2")
+
+# تنظیماتی که بدون راه‌اندازی دوباره قابل تغییرند
+PROVIDER_SETTINGS = {
+    "AI_BASE_URL": "https://api.openai.com/v1",
+    "AI_API_KEY": "",
+    "AI_MODEL_ID": "gpt-3.5-turbo",
+    "AI_PROVIDERS": "",
+}
+
+OPENROUTER_CONFIG_ERROR = "تنظیمات OpenRouter نامعتبر است. لطفاً کلید API و مدل را بررسی کنید."
+
+
+class ProviderConfigError(ValueError):
+    """تنظیمات سرویس‌دهنده نامعتبر است"""
+
+
+def read_provider_settings(path: str = AI_CONFIG_FILE) -> Dict[str, str]:
+    """خواندن تنظیمات سرویس‌دهنده‌ها از محیط و (در صورت تعیین) AI_CONFIG_FILE"""
+    settings = {key: os.getenv(key, default) for key, default in PROVIDER_SETTINGS.items()}
+    if path:
+        if not os.path.exists(path):
+            raise ProviderConfigError(f"AI_CONFIG_FILE not found: {path}")
+        for key, value in dotenv_values(path).items():
+            if key in PROVIDER_SETTINGS and value is not None:
+                settings[key] = value
+    return settings
+
+
+class ProviderSnapshot:
+    """تنظیمات بررسی‌شده و سرویس AI آماده یک نسخه از تنظیمات (تغییرناپذیر)"""
+
+    __slots__ = ("version", "configs", "service", "error", "fingerprint", "loaded_at")
+
+    def __init__(self, version: int, configs: List[AIConfig], error: Optional[str] = None):
+        self.version = version
+        self.configs = configs
+        self.error = error
+        for config in configs:
+            # کلیدها با هر قالبی در لاگ‌ها پوشانده می‌شوند
+            add_secret(config.api_key)
+        self.service = AIService(configs[0], fallbacks=configs[1:])
+        self.fingerprint = hashlib.sha256(
+            "\x00".join(f"{c.base_url}\x01{c.api_key}\x01{c.model_id}" for c in configs).encode("utf-8")
+        ).hexdigest()[:16]
+        self.loaded_at = time.time()
+
+
+class ProviderRegistry:
+    """
+    رجیستری تنظیمات سرویس‌دهنده‌های هر worker
+
+    تنظیمات یک بار در شروع (و در هر reload) بررسی و به AIService آماده
+    تبدیل می‌شوند؛ درخواست‌ها همان نمونه را استفاده می‌کنند. reload نسخه
+    جدید را کامل می‌سازد و با یک جایگزینی ارجاع فعال می‌کند، پس درخواست‌های
+    در حال اجرا با نسخه قبلی تمام می‌شوند. تنظیمات نامعتبر هنگام reload رد
+    می‌شوند و نسخه فعلی باقی می‌ماند.
+    """
+
+    def __init__(self, path: str = AI_CONFIG_FILE):
+        self.path = path
+        self._current: Optional[ProviderSnapshot] = None
+        self._lock = asyncio.Lock()
+        self._watcher: Optional[asyncio.Task] = None
+        self._signal: Optional[int] = None
+        # reloadهای شروع‌شده با سیگنال (ارجاع نگه داشته می‌شود تا task جمع‌آوری نشود)
+        self._pending: Set[asyncio.Task] = set()
+        self._mtime: Optional[int] = None
+        self.reloads = 0
+        self.reload_failures = 0
+        self.last_error: Optional[str] = None
+
+    def _build(self, strict: bool, path: Optional[str] = None) -> ProviderSnapshot:
+        settings = read_provider_settings(self.path if path is None else path)
+        default = AIConfig(
+            base_url=settings["AI_BASE_URL"],
+            api_key=settings["AI_API_KEY"],
+            model_id=settings["AI_MODEL_ID"]
+        )
+        if strict:
+            configs = parse_provider_configs(settings["AI_PROVIDERS"], default)
+        else:
+            configs = load_provider_configs(default, settings["AI_PROVIDERS"])
+
+        error = None
+        if not all(validate_openrouter_config(config) for config in configs):
+            if strict:
+                raise ProviderConfigError(OPENROUTER_CONFIG_ERROR)
+            error = OPENROUTER_CONFIG_ERROR
+        version = self._current.version + 1 if self._current is not None else 1
+        return ProviderSnapshot(version, configs, error)
+
+    def load(self) -> ProviderSnapshot:
+        """
+        بارگذاری اولیه؛ تنظیمات نامعتبر با خطای ذخیره‌شده بارگذاری می‌شوند
+
+        اگر AI_CONFIG_FILE وجود نداشته باشد تنظیمات محیطی استفاده می‌شوند ولی مسیر
+        نگه داشته می‌شود تا reload یا بررسی بعدی فایل دوباره آن را امتحان کند.
+        """
+        try:
+            self._current = self._build(strict=False)
+        except ProviderConfigError as e:
+            logger.error("%s; using environment settings until the next reload", e)
+            self.last_error = str(e)
+            self._current = self._build(strict=False, path="")
+        self._mtime = self._file_mtime()
+        return self._current
+
+    @property
+    def current(self) -> ProviderSnapshot:
+        if self._current is None:
+            self.load()
+        return self._current
+
+    def service(self) -> AIService:
+        """سرویس AI آماده نسخه فعلی؛ برای تنظیمات نامعتبر ProviderConfigError"""
+        snapshot = self.current
+        if snapshot.error:
+            raise ProviderConfigError(snapshot.error)
+        return snapshot.service
+
+    def configured(self) -> bool:
+        return bool(self.current.configs[0].api_key)
+
+    async def reload(self) -> bool:
+        """خواندن دوباره تنظیمات؛ True اگر نسخه جدیدی فعال شد"""
+        async with self._lock:
+            self._mtime = self._file_mtime()
+            try:
+                snapshot = self._build(strict=True)
+            except ValueError as e:
+                self.reload_failures += 1
+                self.last_error = str(e)
+                logger.error("Provider config reload rejected, keeping version %d: %s", self.current.version, e)
+                return False
+            previous = self.current
+            if snapshot.fingerprint == previous.fingerprint and not previous.error:
+                return False
+            # جایگزینی اتمی: درخواست‌های بعدی نسخه جدید را می‌گیرند
+            self._current = snapshot
+            self.reloads += 1
+            self.last_error = None
+            await self._sync_monitors(previous.configs, snapshot.configs)
+            logger.info(
+                "Provider config reloaded: version %d, %d provider(s)",
+                snapshot.version, len(snapshot.configs)
+            )
+            return True
+
+    async def _sync_monitors(self, previous: List[AIConfig], configs: List[AIConfig]) -> None:
+        current = {config.base_url.rstrip('/'): config for config in configs}
+        for config in previous:
+            base_url = config.base_url.rstrip('/')
+            if current.get(base_url) != config:
+                await stop_health_monitor(base_url)
+        for config in configs:
+            start_health_monitor(config)
+
+    def _file_mtime(self) -> Optional[int]:
+        if not self.path:
+            return None
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    async def _watch(self) -> None:
+        while True:
+            await asyncio.sleep(AI_CONFIG_WATCH_INTERVAL)
+            mtime = self._file_mtime()
+            if mtime is not None and mtime != self._mtime:
+                await self.reload()
+
+    def _on_signal(self) -> None:
+        logger.info("Reload signal received")
+        task = asyncio.get_running_loop().create_task(self.reload())
+        self._pending.add(task)
+        task.add_done_callback(self._reload_done)
+
+    def _reload_done(self, task: asyncio.Task) -> None:
+        self._pending.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Provider config reload failed: %s", task.exception(), exc_info=task.exception())
+
+    def start(self) -> None:
+        """بارگذاری تنظیمات، شروع پایشگرها و فعال کردن reload با سیگنال/بررسی فایل"""
+        self.load()
+        for config in self._current.configs:
+            start_health_monitor(config)
+
+        if AI_CONFIG_RELOAD_SIGNAL:
+            try:
+                signum = getattr(signal, AI_CONFIG_RELOAD_SIGNAL)
+                asyncio.get_running_loop().add_signal_handler(signum, self._on_signal)
+                self._signal = signum
+            except (AttributeError, NotImplementedError, RuntimeError, ValueError) as e:
+                # ویندوز یا اجرای lifespan خارج از thread اصلی
+                logger.warning("Reload signal %s not available: %s", AI_CONFIG_RELOAD_SIGNAL, e)
+
+        if self.path and AI_CONFIG_WATCH_INTERVAL > 0 and self._watcher is None:
+            self._watcher = asyncio.create_task(self._watch())
+
+    async def stop(self) -> None:
+        if self._signal is not None:
+            try:
+                asyncio.get_running_loop().remove_signal_handler(self._signal)
+            except (NotImplementedError, RuntimeError):
+                pass
+            self._signal = None
+        if self._watcher is not None:
+            self._watcher.cancel()
+            try:
+                await self._watcher
+            except asyncio.CancelledError:
+                pass
+            self._watcher = None
+        for task in list(self._pending):
+            task.cancel()
+        if self._pending:
+            await asyncio.gather(*self._pending, return_exceptions=True)
+
+    def stats(self) -> dict:
+        snapshot = self.current
+        return {
+            "version": snapshot.version,
+            "loaded_at": snapshot.loaded_at,
+            "providers": [{"base_url": c.base_url, "model_id": c.model_id} for c in snapshot.configs],
+            "valid": snapshot.error is None,
+            "source": self.path or "environment",
+            "reload_signal": AI_CONFIG_RELOAD_SIGNAL if self._signal is not None else None,
+            "watch_interval": AI_CONFIG_WATCH_INTERVAL if self._watcher is not None else None,
+            "reloads": self.reloads,
+            "reload_failures": self.reload_failures,
+            "last_error": self.last_error,
+        }
+
+
+provider_registry = ProviderRegistry()
+
+
+def get_registry_stats() -> dict:
+    return provider_registry.stats()
@@ -0,0 +1,302 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, List, Optional
+
+from app.models.schemas import AIConfig
+from app.services.config import env_bool
+from app.services.provider_health import is_provider_available
+
+logger = logging.getLogger(__name__)
+
+# فهرست مرتب سرویس‌دهنده‌ها به صورت JSON؛ اگر خالی باشد فقط AI_BASE_URL استفاده می‌شود
+# مثال: [{"base_url": "...", "api_key": "...", "model_id": "..."}, ...]
+AI_PROVIDERS = os.getenv("AI_PROVIDERS", "")
+
+# درخواست hedge: اگر سرویس‌دهنده اول تا صدک مشخصی از تاخیر معمولش پاسخ نداد، دومی هم فراخوانی می‌شود
+AI_HEDGE = env_bool("AI_HEDGE", False)
+AI_HEDGE_PERCENTILE = float(os.getenv("AI_HEDGE_PERCENTILE", "95"))
+AI_HEDGE_MIN_DELAY = float(os.getenv("AI_HEDGE_MIN_DELAY", "0.5"))
+AI_HEDGE_DEFAULT_DELAY = float(os.getenv("AI_HEDGE_DEFAULT_DELAY", "5"))  # تا پیش از جمع شدن نمونه کافی
+
+# حداقل نمونه برای استفاده از آمار تاخیر و سقف نرخ خطا برای مقدم ماندن یک سرویس‌دهنده
+ROUTER_MIN_SAMPLES = int(os.getenv("AI_ROUTER_MIN_SAMPLES", "5"))
+ROUTER_MAX_ERROR_RATE = float(os.getenv("AI_ROUTER_MAX_ERROR_RATE", "0.5"))
+ROUTER_WINDOW = int(os.getenv("AI_ROUTER_WINDOW", "200"))
+ROUTER_ERROR_ALPHA = 0.2  # وزن EWMA نرخ خطا
+
+
+def parse_provider_configs(raw: str, default: AIConfig) -> List[AIConfig]:
+    """تبدیل مقدار AI_PROVIDERS به فهرست تنظیمات؛ در صورت نامعتبر بودن ValueError"""
+    if not raw.strip():
+        return [default]
+    try:
+        entries = json.loads(raw)
+        configs = [
+            AIConfig(
+                base_url=entry["base_url"],
+                api_key=entry.get("api_key", default.api_key),
+                model_id=entry.get("model_id", default.model_id)
+            )
+            for entry in entries
+        ]
+    except (ValueError, KeyError, TypeError) as e:
+        raise ValueError(f"Invalid AI_PROVIDERS: {e}") from e
+    return configs or [default]
+
+
+def load_provider_configs(default: AIConfig, raw: Optional[str] = None) -> List[AIConfig]:
+    """خواندن فهرست سرویس‌دهنده‌ها از AI_PROVIDERS (اولی سرویس‌دهنده اصلی است)"""
+    try:
+        return parse_provider_configs(AI_PROVIDERS if raw is None else raw, default)
+    except ValueError as e:
+        logger.error("%s; using AI_BASE_URL only", e)
+        return [default]
+
+
+def percentile(values, pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+class ProviderStats:
+    """تاخیر (پنجره لغزان) و نرخ خطای (EWMA) یک سرویس‌دهنده"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies: Dict[str, Deque[float]] = {}
+        self.error_rate = 0.0
+        self.successes = 0
+        self.failures = 0
+        self.last_error: Optional[str] = None
+
+    def record_success(self, kind: str, latency: float) -> None:
+        self.latencies.setdefault(kind, deque(maxlen=ROUTER_WINDOW)).append(latency)
+        self.successes += 1
+        self.error_rate *= 1 - ROUTER_ERROR_ALPHA
+
+    def record_failure(self, error: Exception) -> None:
+        self.failures += 1
+        self.error_rate = self.error_rate * (1 - ROUTER_ERROR_ALPHA) + ROUTER_ERROR_ALPHA
+        self.last_error = f"{type(error).__name__}: {error}"
+
+    def latency(self, kind: str, pct: float) -> Optional[float]:
+        window = self.latencies.get(kind)
+        if not window or len(window) < ROUTER_MIN_SAMPLES:
+            return None
+        return percentile(window, pct)
+
+    def snapshot(self) -> dict:
+        return {
+            "provider": self.name,
+            "successes": self.successes,
+            "failures": self.failures,
+            "error_rate": round(self.error_rate, 4),
+            "latency": {
+                kind: {
+                    "samples": len(window),
+                    "p50": round(percentile(window, 50), 4),
+                    "p95": round(percentile(window, 95), 4),
+                }
+                for kind, window in self.latencies.items() if window
+            },
+            "last_error": self.last_error,
+        }
+
+
+class ProviderRouter:
+    """
+    انتخاب سرویس‌دهنده بر اساس دسترس‌پذیری، نرخ خطا و تاخیر مشاهده‌شده
+
+    peerها اشیایی با base_url و model_id هستند (در عمل AIService). ترتیب فهرست
+    تنظیمات تا زمان جمع شدن نمونه کافی حفظ می‌شود.
+    """
+
+    def __init__(self):
+        self._stats: Dict[str, ProviderStats] = {}
+        self.failovers = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def stats_for(self, peer: Any) -> ProviderStats:
+        name = f"{peer.model_id}@{peer.base_url}"
+        stats = self._stats.get(name)
+        if stats is None:
+            stats = ProviderStats(name)
+            self._stats[name] = stats
+        return stats
+
+    def order(self, peers: List[Any], kind: str) -> List[Any]:
+        def key(item):
+            index, peer = item
+            stats = self.stats_for(peer)
+            p50 = stats.latency(kind, 50)
+            return (
+                not is_provider_available(peer.base_url),
+                stats.error_rate > ROUTER_MAX_ERROR_RATE,
+                p50 if p50 is not None else float("inf"),
+                index
+            )
+
+        return [peer for _, peer in sorted(enumerate(peers), key=key)]
+
+    def hedge_delay(self, peer: Any, kind: str) -> float:
+        observed = self.stats_for(peer).latency(kind, AI_HEDGE_PERCENTILE)
+        if observed is None:
+            return AI_HEDGE_DEFAULT_DELAY
+        return max(AI_HEDGE_MIN_DELAY, observed)
+
+    async def _race(
+        self,
+        order: List[Any],
+        start: Callable[[Any, bool], Awaitable[Any]],
+        kind: str,
+        on_loser: Optional[Callable[[Any], Awaitable[None]]] = None
+    ) -> Any:
+        """
+        اجرای start روی سرویس‌دهنده‌ها با failover و hedge اختیاری
+
+        start(peer, last) یک awaitable برمی‌گرداند؛ last نشان می‌دهد که این آخرین
+        گزینه است (و تکرار داخلی فقط برای آن لازم است). اولین نتیجه موفق برگردانده
+        و بقیه لغو می‌شوند.
+        """
+        remaining = list(order)
+        tasks: Dict[asyncio.Future, tuple] = {}
+        first_peer = order[0]
+        hedged = False
+        last_error: Optional[BaseException] = None
+
+        def launch():
+            peer = remaining.pop(0)
+            task = asyncio.ensure_future(start(peer, not remaining))
+            tasks[task] = (peer, time.monotonic())
+
+        launch()
+        try:
+            while tasks:
+                timeout = None
+                if AI_HEDGE and remaining and not hedged:
+                    timeout = self.hedge_delay(first_peer, kind)
+                done, _ = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedged = True
+                    self.hedges += 1
+                    launch()
+                    continue
+
+                for task in done:
+                    peer, started = tasks.pop(task)
+                    error = task.exception()
+                    if error is None:
+                        self.stats_for(peer).record_success(kind, time.monotonic() - started)
+                        if hedged and peer is not first_peer:
+                            self.hedge_wins += 1
+                        return task.result()
+                    self.stats_for(peer).record_failure(error)
+                    last_error = error
+
+                if not tasks and remaining:
+                    self.failovers += 1
+                    logger.warning("AI provider failed, failing over: %s", last_error)
+                    launch()
+            raise last_error
+        finally:
+            for task in tasks:
+                task.cancel()
+            for task in tasks:
+                try:
+                    result = await task
+                except BaseException:
+                    continue
+                if on_loser is not None:
+                    await on_loser(result)
+
+    async def call(self, peers: List[Any], call: Callable[[Any, bool], Awaitable[Any]]) -> Any:
+        """فراخوانی غیر stream"""
+        order = self.order(peers, "call")
+        if len(order) > 1:
+            return await self._race(order, call, "call")
+
+        stats = self.stats_for(order[0])
+        started = time.monotonic()
+        try:
+            result = await call(order[0], True)
+        except Exception as e:
+            stats.record_failure(e)
+            raise
+        stats.record_success("call", time.monotonic() - started)
+        return result
+
+    async def stream(
+        self,
+        peers: List[Any],
+        open_stream: Callable[[Any, bool], AsyncIterator[str]]
+    ) -> AsyncIterator[str]:
+        """
+        فراخوانی stream؛ رقابت تا رسیدن اولین تکه متن است
+
+        پس از رسیدن اولین تکه از یک سرویس‌دهنده، بقیه بسته می‌شوند و ادامه متن
+        فقط از همان سرویس‌دهنده خوانده می‌شود.
+        """
+        order = self.order(peers, "first_chunk")
+        if len(order) == 1:
+            stats = self.stats_for(order[0])
+            started = time.monotonic()
+            first = True
+            try:
+                async for chunk in open_stream(order[0], True):
+                    if first:
+                        stats.record_success("first_chunk", time.monotonic() - started)
+                        first = False
+                    yield chunk
+            except Exception as e:
+                if first:
+                    stats.record_failure(e)
+                raise
+            return
+
+        async def first_chunk(peer, last):
+            stream = open_stream(peer, last)
+            try:
+                chunk = await stream.__anext__()
+            except StopAsyncIteration:
+                chunk = None
+            except BaseException:
+                await stream.aclose()
+                raise
+            return stream, chunk
+
+        async def close_loser(result):
+            await result[0].aclose()
+
+        stream, chunk = await self._race(order, first_chunk, "first_chunk", close_loser)
+        try:
+            if chunk is None:
+                return
+            yield chunk
+            async for chunk in stream:
+                yield chunk
+        finally:
+            await stream.aclose()
+
+    def snapshot(self) -> dict:
+        return {
+            "hedging": AI_HEDGE,
+            "failovers": self.failovers,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "providers": [stats.snapshot() for stats in self._stats.values()],
+        }
+
+
+provider_router = ProviderRouter()
+
+
+def get_router_stats() -> dict:
+    return provider_router.snapshot()
@@ -0,0 +1,285 @@
+import os
+import re
+import time
+import random
+import hashlib
+import logging
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+
+from app.services.session_store import RedisClient
+from app.services.config import env_bool
+
+logger = logging.getLogger(__name__)
+
+
+# کش پاسخ اولین سوال (به‌صورت پیش‌فرض غیرفعال)
+FIRST_WHY_CACHE_ENABLED = env_bool("FIRST_WHY_CACHE", False)
+FIRST_WHY_CACHE_TTL = float(os.getenv("FIRST_WHY_CACHE_TTL", "86400"))
+FIRST_WHY_CACHE_MAX_ENTRIES = int(os.getenv("FIRST_WHY_CACHE_MAX_ENTRIES", "5000"))
+FIRST_WHY_CACHE_REDIS_URL = os.getenv("FIRST_WHY_CACHE_REDIS_URL", "")
+FIRST_WHY_CACHE_NEAR_DUP = env_bool("FIRST_WHY_CACHE_NEAR_DUP", False)
+FIRST_WHY_CACHE_NEAR_DUP_THRESHOLD = float(os.getenv("FIRST_WHY_CACHE_NEAR_DUP_THRESHOLD", "0.85"))
+
+_ARABIC_TO_PERSIAN = str.maketrans({
+    "ي": "ی", "ى": "ی", "ك": "ک", "ة": "ه", "ۀ": "ه", "أ": "ا", "إ": "ا", "آ": "ا",
+    "۰": "0", "۱": "1", "۲": "2", "۳": "3", "۴": "4",
+    "۵": "5", "۶": "6", "۷": "7", "۸": "8", "۹": "9",
+    "٠": "0", "١": "1", "٢": "2", "٣": "3", "٤": "4",
+    "٥": "5", "٦": "6", "٧": "7", "٨": "8", "٩": "9",
+    "‌": " ", "‍": "", "‎": "", "‏": "", "ـ": "",
+})
+_PUNCTUATION = re.compile(r"[^\w\s]", re.UNICODE)
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    """یکسان‌سازی متن فارسی/انگلیسی برای کلید کش"""
+    text = unicodedata.normalize("NFKC", text).translate(_ARABIC_TO_PERSIAN).lower()
+    # حذف اعراب و علائم ترکیبی
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    text = _PUNCTUATION.sub(" ", text)
+    return _WHITESPACE.sub(" ", text).strip()
+
+
+class MinHasher:
+    """امضای MinHash روی shingleهای کاراکتری برای یافتن متن‌های تقریباً تکراری"""
+
+    _PRIME = (1 << 61) - 1
+
+    def __init__(self, num_perm: int = 64, bands: int = 16, shingle_size: int = 4):
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        rng = random.Random(1234)
+        self._perms = [
+            (rng.randrange(1, self._PRIME), rng.randrange(0, self._PRIME))
+            for _ in range(num_perm)
+        ]
+
+    def _shingles(self, text: str) -> Set[int]:
+        size = self.shingle_size
+        if len(text) <= size:
+            grams = {text}
+        else:
+            grams = {text[i:i + size] for i in range(len(text) - size + 1)}
+        return {
+            int.from_bytes(hashlib.blake2b(gram.encode("utf-8"), digest_size=8).digest(), "big")
+            for gram in grams
+        }
+
+    def signature(self, text: str) -> Tuple[int, ...]:
+        shingles = self._shingles(text)
+        return tuple(
+            min((a * value + b) % self._PRIME for value in shingles)
+            for a, b in self._perms
+        )
+
+    def band_keys(self, signature: Tuple[int, ...]) -> List[Tuple[int, int]]:
+        return [
+            (band, hash(signature[band * self.rows:(band + 1) * self.rows]))
+            for band in range(self.bands)
+        ]
+
+    @staticmethod
+    def similarity(first: Tuple[int, ...], second: Tuple[int, ...]) -> float:
+        return sum(1 for a, b in zip(first, second) if a == b) / len(first)
+
+
+class ResponseCache:
+    """کش LRU با انقضای زمانی، پشتوانه اشتراکی اختیاری و تطبیق تقریبی اختیاری"""
+
+    def __init__(
+        self,
+        name: str,
+        ttl: float,
+        max_entries: int,
+        redis_url: str = "",
+        near_duplicates: bool = False,
+        near_duplicate_threshold: float = 0.85
+    ):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.shared = RedisClient(redis_url) if redis_url else None
+        self.hasher = MinHasher() if near_duplicates else None
+        self.near_duplicate_threshold = near_duplicate_threshold
+
+        # key -> (مقدار، زمان انقضا، امضای MinHash)
+        self._entries: "OrderedDict[str, Tuple[str, float, Optional[tuple]]]" = OrderedDict()
+        # (بخش کلید، شماره band، hash) -> کلیدها؛ بخش کلید (مدل و نسخه prompt) مانع
+        # تطبیق تقریبی با پاسخی می‌شود که برای مدل یا prompt دیگری ذخیره شده است
+        self._buckets: Dict[Tuple[str, int, int], Set[str]] = {}
+
+        self.hits = 0
+        self.near_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stores = 0
+        self.miss_latency_total = 0.0
+        self.latency_saved = 0.0
+
+    def make_key(self, text: str, *parts: str) -> str:
+        """کلید دقیق به شکل «بخش:hash»؛ بخش از parts (مثلاً نسخه prompt و مدل) ساخته می‌شود"""
+        normalized = normalize_text(text)
+        partition = hashlib.sha256("|".join(parts).encode("utf-8")).hexdigest()[:16]
+        raw = "|".join([*parts, normalized])
+        return f"{partition}:{hashlib.sha256(raw.encode('utf-8')).hexdigest()}"
+
+    @staticmethod
+    def _partition(key: str) -> str:
+        return key.split(":", 1)[0] if ":" in key else ""
+
+    def _bucket_keys(self, key: str, signature: tuple) -> List[Tuple[str, int, int]]:
+        partition = self._partition(key)
+        return [(partition, band, value) for band, value in self.hasher.band_keys(signature)]
+
+    def _avg_miss_latency(self) -> float:
+        return self.miss_latency_total / self.stores if self.stores else 0.0
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is None or entry[2] is None:
+            return
+        for band_key in self._bucket_keys(key, entry[2]):
+            bucket = self._buckets.get(band_key)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self._buckets[band_key]
+
+    def _get_local(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= time.monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def _find_near_duplicate(self, key: str, signature: tuple) -> Optional[str]:
+        """نزدیک‌ترین متن ذخیره‌شده در همان بخش کلید (همان مدل و نسخه prompt)"""
+        candidates: Set[str] = set()
+        for band_key in self._bucket_keys(key, signature):
+            candidates |= self._buckets.get(band_key, set())
+
+        best_key, best_score = None, 0.0
+        for candidate in candidates:
+            entry = self._entries.get(candidate)
+            if entry is None or entry[2] is None:
+                continue
+            score = MinHasher.similarity(signature, entry[2])
+            if score > best_score:
+                best_key, best_score = candidate, score
+        if best_key is not None and best_score >= self.near_duplicate_threshold:
+            return self._get_local(best_key)
+        return None
+
+    async def get(self, key: str, text: Optional[str] = None) -> Optional[str]:
+        """جستجو به ترتیب: کش محلی، کش اشتراکی، تطبیق تقریبی"""
+        value = self._get_local(key)
+        if value is not None:
+            self.hits += 1
+            self.latency_saved += self._avg_miss_latency()
+            return value
+
+        if self.shared is not None:
+            try:
+                shared_value = await self.shared.execute("GET", f"5whys:cache:{self.name}:{key}")
+            except Exception as e:
+                logger.warning("Shared response cache unavailable: %s", e)
+                shared_value = None
+            if shared_value is not None:
+                value = shared_value.decode("utf-8")
+                self._set_local(key, value, text)
+                self.hits += 1
+                self.shared_hits += 1
+                self.latency_saved += self._avg_miss_latency()
+                return value
+
+        if self.hasher is not None and text:
+            value = self._find_near_duplicate(key, self.hasher.signature(normalize_text(text)))
+            if value is not None:
+                self.near_hits += 1
+                self.latency_saved += self._avg_miss_latency()
+                return value
+
+        self.misses += 1
+        return None
+
+    def _set_local(self, key: str, value: str, text: Optional[str]) -> None:
+        self._remove(key)
+        signature = None
+        if self.hasher is not None and text:
+            signature = self.hasher.signature(normalize_text(text))
+            for band_key in self._bucket_keys(key, signature):
+                self._buckets.setdefault(band_key, set()).add(key)
+        self._entries[key] = (value, time.monotonic() + self.ttl, signature)
+
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    async def set(self, key: str, value: str, text: Optional[str] = None, latency: float = 0.0) -> None:
+        """ذخیره پاسخ؛ latency زمان تولید پاسخ برای محاسبه زمان صرفه‌جویی‌شده است"""
+        self.stores += 1
+        self.miss_latency_total += latency
+        self._set_local(key, value, text)
+        if self.shared is not None:
+            try:
+                await self.shared.execute(
+                    "SET", f"5whys:cache:{self.name}:{key}", value, "EX", max(1, int(self.ttl))
+                )
+            except Exception as e:
+                logger.warning("Shared response cache unavailable: %s", e)
+
+    async def close(self) -> None:
+        if self.shared is not None:
+            await self.shared.close()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.near_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "shared_hits": self.shared_hits,
+            "near_hits": self.near_hits,
+            "misses": self.misses,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "hit_rate": round((self.hits + self.near_hits) / lookups, 4) if lookups else 0.0,
+            "avg_miss_latency": round(self._avg_miss_latency(), 4),
+            "latency_saved_seconds": round(self.latency_saved, 3),
+        }
+
+
+_first_why_cache: Optional[ResponseCache] = None
+if FIRST_WHY_CACHE_ENABLED:
+    _first_why_cache = ResponseCache(
+        "first_why",
+        ttl=FIRST_WHY_CACHE_TTL,
+        max_entries=FIRST_WHY_CACHE_MAX_ENTRIES,
+        redis_url=FIRST_WHY_CACHE_REDIS_URL,
+        near_duplicates=FIRST_WHY_CACHE_NEAR_DUP,
+        near_duplicate_threshold=FIRST_WHY_CACHE_NEAR_DUP_THRESHOLD
+    )
+
+
+def get_first_why_cache() -> Optional[ResponseCache]:
+    """کش اولین سوال؛ اگر FIRST_WHY_CACHE فعال نباشد None است"""
+    return _first_why_cache
+
+
+async def close_response_caches() -> None:
+    if _first_why_cache is not None:
+        await _first_why_cache.close()
+
+
+def get_cache_stats() -> dict:
+    if _first_why_cache is None:
+        return {"first_why": {"enabled": False}}
+    return {"first_why": {"enabled": True, **_first_why_cache.stats()}}
@@ -0,0 +1,200 @@
+import re
+import json
+from typing import Callable, Dict, Iterator, Optional, Tuple, Type, TypeVar
+
+from pydantic import BaseModel, ValidationError
+
+from app.models.schemas import StepEvaluation, SummaryResult
+
+ModelT = TypeVar("ModelT", bound=BaseModel)
+
+_CLOSERS = {"{": "}", "[": "]"}
+_FENCE = re.compile(r"```(?:json)?\s*(.*?)```", re.DOTALL | re.IGNORECASE)
+# حداکثر تعداد { آزموده‌شده در یک پاسخ
+MAX_CANDIDATES = 8
+
+
+class ResponseParseError(ValueError):
+    """پاسخ مدل به JSON معتبر مطابق مدل مورد انتظار تبدیل نشد"""
+
+
+def extract_json(text: str, start: int = 0) -> Tuple[Optional[str], bool]:
+    """
+    استخراج اولین شیء JSON از متن پاسخ مدل (از محل start به بعد) در یک پیمایش
+
+    code fence و متن قبل/بعد از JSON نادیده گرفته می‌شوند، ویرگول‌های اضافه
+    پیش از } و ] حذف و شیء نیمه‌تمام (پاسخ بریده‌شده) بسته می‌شود.
+    خروجی: (متن JSON یا None، آیا اصلاحی لازم شد)
+    """
+    start = text.find("{", start)
+    if start < 0:
+        return None, False
+
+    out = []
+    stack = []
+    in_string = False
+    escaped = False
+    repaired = False
+    # محل آخرین ویرگول خارج از رشته در out؛ اگر بلافاصله } یا ] بیاید حذف می‌شود
+    pending_comma = -1
+
+    for char in text[start:]:
+        if in_string:
+            out.append(char)
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+            elif char == "\n":
+                # خط جدید خام داخل رشته در JSON مجاز نیست
+                out[-1] = "\\n"
+                repaired = True
+            continue
+
+        if char in " \t\r\n":
+            out.append(char)
+            continue
+
+        if char in "}]":
+            if pending_comma >= 0:
+                del out[pending_comma]
+                repaired = True
+            pending_comma = -1
+            if not stack or stack[-1] != char:
+                # بستن نامتوازن؛ ادامه دادن فقط خروجی خراب می‌سازد
+                break
+            stack.pop()
+            out.append(char)
+            if not stack:
+                return "".join(out), repaired
+            continue
+
+        pending_comma = -1
+        if char == '"':
+            in_string = True
+        elif char in _CLOSERS:
+            stack.append(_CLOSERS[char])
+        elif char == ",":
+            pending_comma = len(out)
+        out.append(char)
+
+    # پاسخ بریده‌شده: بستن رشته و ساختارهای باز
+    if in_string:
+        if escaped:
+            out.pop()
+        out.append('"')
+    body = "".join(out).rstrip()
+    if body.endswith(":"):
+        # کلید بدون مقدار حذف می‌شود
+        body = body[:-1].rstrip()
+        body = body[:body.rfind('"', 0, len(body) - 1)].rstrip()
+    body = body.rstrip(",").rstrip()
+    return body + "".join(reversed(stack)), True
+
+
+def json_candidates(text: str) -> Iterator[Tuple[str, bool]]:
+    """
+    متن‌های JSON احتمالی پاسخ به ترتیب: اول بلوک code fence (در صورت وجود)،
+    سپس شیء شروع‌شده از هر { متن (تا MAX_CANDIDATES مورد)
+    """
+    fence = _FENCE.search(text)
+    if fence is not None:
+        candidate, repaired = extract_json(fence.group(1))
+        if candidate is not None:
+            yield candidate, repaired
+    start = text.find("{")
+    for _ in range(MAX_CANDIDATES):
+        if start < 0:
+            return
+        candidate, repaired = extract_json(text, start)
+        yield candidate, repaired
+        start = text.find("{", start + 1)
+
+
+def _validate_candidate(
+    candidate: str,
+    model: Type[ModelT],
+    check: Optional[Callable[[ModelT], None]]
+) -> ModelT:
+    try:
+        data = json.loads(candidate)
+    except json.JSONDecodeError as e:
+        raise ResponseParseError(f"JSON نامعتبر: {e}")
+    if not isinstance(data, dict):
+        raise ResponseParseError("پاسخ یک شیء JSON نیست")
+    try:
+        result = model.model_validate(data)
+    except ValidationError as e:
+        raise ResponseParseError(f"ساختار نامعتبر: {e.errors()[0]['msg']}")
+    if check is not None:
+        check(result)
+    return result
+
+
+def parse_model(
+    text: str,
+    model: Type[ModelT],
+    check: Optional[Callable[[ModelT], None]] = None
+) -> Tuple[ModelT, bool]:
+    """
+    تبدیل پاسخ مدل به نمونه‌ای از model (check: بررسی اضافه با ResponseParseError)
+
+    اگر یک { (مثلاً متن توضیحی با آکولاد) به JSON معتبر نرسد، { بعدی امتحان می‌شود.
+    خروجی: (نمونه، آیا اصلاح تحمل‌پذیر لازم شد). در صورت شکست ResponseParseError
+    با خطای اولین متن احتمالی
+    """
+    first_error: Optional[ResponseParseError] = None
+    try:
+        result = model.model_validate_json(text)
+        if check is not None:
+            check(result)
+        return result, False
+    except ValidationError:
+        pass
+    except ResponseParseError as e:
+        first_error = e
+
+    for candidate, repaired in json_candidates(text):
+        try:
+            return _validate_candidate(candidate, model, check), True
+        except ResponseParseError as e:
+            first_error = first_error or e
+    raise first_error or ResponseParseError("پاسخ شامل JSON نیست")
+
+
+def _check_step(step: StepEvaluation) -> None:
+    if step.is_valid and not step.needs_clarification and not step.is_root_found and not step.next_question:
+        raise ResponseParseError("سوال بعدی در پاسخ نیست")
+
+
+def parse_step(text: str) -> Tuple[StepEvaluation, bool]:
+    """پارس ارزیابی یک مرحله؛ پاسخ بدون سوال بعدی و بدون نتیجه قابل استفاده نیست"""
+    return parse_model(text, StepEvaluation, _check_step)
+
+
+def parse_summary(text: str) -> Tuple[SummaryResult, bool]:
+    return parse_model(text, SummaryResult)
+
+
+# آمار پارس پاسخ‌ها به تفکیک نوع: direct (بدون اصلاح)، tolerant (اصلاح محلی)،
+# repaired (با فراخوانی اصلاح) و fallback (پاسخ پیش‌فرض)
+_stats: Dict[str, Dict[str, int]] = {}
+
+
+def record_parse(kind: str, outcome: str) -> None:
+    stats = _stats.setdefault(kind, {"direct": 0, "tolerant": 0, "repaired": 0, "fallback": 0})
+    stats[outcome] += 1
+
+
+def get_parse_stats() -> dict:
+    result = {}
+    for kind, stats in _stats.items():
+        total = sum(stats.values())
+        result[kind] = {
+            **stats,
+            "success_rate": round((total - stats["fallback"]) / total, 4) if total else None,
+            "fallback_rate": round(stats["fallback"] / total, 4) if total else None,
+        }
+    return result
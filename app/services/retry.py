@@ -0,0 +1,128 @@
+import os
+import time
+import random
+from typing import Dict, Optional
+
+import httpx
+
+# سیاست تکرار فراخوانی‌های AI
+AI_RETRY_ATTEMPTS = int(os.getenv("AI_RETRY_ATTEMPTS", "3"))  # شامل تلاش اول
+AI_RETRY_BASE_DELAY = float(os.getenv("AI_RETRY_BASE_DELAY", "0.5"))
+AI_RETRY_MAX_DELAY = float(os.getenv("AI_RETRY_MAX_DELAY", "8"))
+AI_RETRY_DEADLINE = float(os.getenv("AI_RETRY_DEADLINE", "60"))  # بودجه زمانی کل یک فراخوانی (ثانیه)
+
+# وضعیت‌هایی که خطای گذرا محسوب می‌شوند
+RETRYABLE_STATUS = {408, 425, 429, 500, 502, 503, 504, 529}
+
+
+def is_retryable_error(exc: Exception) -> bool:
+    """خطاهای شبکه و timeout گذرا هستند"""
+    return isinstance(exc, (httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError))
+
+
+def request_was_sent(exc: Exception) -> bool:
+    """
+    آیا درخواست احتمالاً به سرویس‌دهنده رسیده است؟
+
+    فراخوانی LLM idempotent نیست: اگر درخواست ارسال شده و پاسخ نرسیده باشد،
+    سرویس‌دهنده ممکن است هزینه تولید را حساب کرده باشد.
+    """
+    return not isinstance(exc, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+
+
+class RetryPolicy:
+    """تکرار با backoff نمایی، jitter کامل، رعایت Retry-After و سقف زمانی کل"""
+
+    def __init__(
+        self,
+        max_attempts: int = AI_RETRY_ATTEMPTS,
+        base_delay: float = AI_RETRY_BASE_DELAY,
+        max_delay: float = AI_RETRY_MAX_DELAY,
+        deadline: float = AI_RETRY_DEADLINE
+    ):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+
+    def start(self) -> float:
+        """زمان پایان بودجه یک فراخوانی"""
+        return time.monotonic() + self.deadline
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** (attempt - 1))))
+
+    def next_delay(self, attempt: int, deadline: float, retry_after: Optional[float] = None) -> Optional[float]:
+        """مدت انتظار پیش از تلاش بعدی؛ None یعنی دیگر تلاش نکن"""
+        if attempt >= self.max_attempts:
+            return None
+        delay = retry_after if retry_after is not None else self.backoff(attempt)
+        if time.monotonic() + delay >= deadline:
+            return None
+        return delay
+
+    def attempt_timeout(self, timeout: httpx.Timeout, deadline: float) -> httpx.Timeout:
+        """محدود کردن timeoutهای کلاینت به باقی‌مانده بودجه زمانی"""
+        remaining = max(deadline - time.monotonic(), 0.1)
+
+        def bound(value: Optional[float]) -> float:
+            return remaining if value is None else min(value, remaining)
+
+        return httpx.Timeout(
+            connect=bound(timeout.connect),
+            read=bound(timeout.read),
+            write=bound(timeout.write),
+            pool=bound(timeout.pool)
+        )
+
+
+retry_policy = RetryPolicy()
+
+# آمار تکرار این worker به تفکیک نوع فراخوانی
+_stats: Dict[str, Dict[str, float]] = {}
+
+
+def _purpose_stats(purpose: str) -> Dict[str, float]:
+    return _stats.setdefault(purpose, {
+        "retries": 0,
+        "recovered": 0,
+        "gave_up": 0,
+        "backoff_seconds": 0.0,
+        "wasted_attempts": 0,
+        "wasted_tokens_estimate": 0,
+    })
+
+
+def record_retry(purpose: str, delay: float, wasted_tokens: int = 0) -> None:
+    """ثبت یک تلاش ناموفق که تکرار می‌شود؛ wasted_tokens هزینه احتمالی تلاش ارسال‌شده است"""
+    stats = _purpose_stats(purpose)
+    stats["retries"] += 1
+    stats["backoff_seconds"] += delay
+    if wasted_tokens:
+        stats["wasted_attempts"] += 1
+        stats["wasted_tokens_estimate"] += wasted_tokens
+
+
+def record_outcome(purpose: str, attempts: int, ok: bool, wasted_tokens: int = 0) -> None:
+    """ثبت نتیجه نهایی یک فراخوانی (هزینه احتمالی تلاش آخرِ ناموفق هم حساب می‌شود)"""
+    if wasted_tokens:
+        stats = _purpose_stats(purpose)
+        stats["wasted_attempts"] += 1
+        stats["wasted_tokens_estimate"] += wasted_tokens
+    if attempts > 1:
+        _purpose_stats(purpose)["recovered" if ok else "gave_up"] += 1
+
+
+def get_retry_stats() -> dict:
+    return {
+        "policy": {
+            "max_attempts": retry_policy.max_attempts,
+            "base_delay": retry_policy.base_delay,
+            "max_delay": retry_policy.max_delay,
+            "deadline": retry_policy.deadline,
+        },
+        "by_purpose": {
+            purpose: {key: round(value, 3) if isinstance(value, float) else value for key, value in stats.items()}
+            for purpose, stats in _stats.items()
+        },
+    }
@@ -0,0 +1,149 @@
+import os
+import re
+import unicodedata
+from typing import List, Optional, Set, Tuple
+
+from app.models.schemas import WhyStep
+from app.services.config import env_bool
+from app.services.archive import normalize_text, query_terms
+
+# بررسی محلی پاسخ پیش از فراخوانی AI؛ پاسخ‌های آشکارا نامعتبر بدون فراخوانی رد می‌شوند
+SCREEN_ANSWERS = env_bool("SCREEN_ANSWERS", True)
+# حداقل تعداد کلمات پاسخ؛ پاسخ تک‌کلمه‌ای مثل «OOM» یا «2FA» می‌تواند علت ریشه‌ای باشد
+SCREEN_MIN_WORDS = int(os.getenv("SCREEN_MIN_WORDS", "1"))
+# حداقل نسبت حروف به کل نویسه‌های غیرفاصله (پاسخ‌های فقط عدد/علامت/ایموجی)
+SCREEN_MIN_LETTER_RATIO = float(os.getenv("SCREEN_MIN_LETTER_RATIO", "0.5"))
+# حداقل سهم حروف پاسخ که به خط مشکل/سوال یا لاتین (اصطلاحات فنی) هستند (0 = غیرفعال)
+SCREEN_MIN_SCRIPT_RATIO = float(os.getenv("SCREEN_MIN_SCRIPT_RATIO", "0.5"))
+# شباهت کلمات با پاسخ‌های قبلی که پاسخ را تکراری می‌کند (0 = غیرفعال)
+SCREEN_DUPLICATE_SIMILARITY = float(os.getenv("SCREEN_DUPLICATE_SIMILARITY", "0.9"))
+# نسبت کلمات پاسخ که در خود سوال آمده‌اند (تکرار سوال؛ 0 = غیرفعال)
+SCREEN_ECHO_SIMILARITY = float(os.getenv("SCREEN_ECHO_SIMILARITY", "0.8"))
+# حداقل نسبت کلمات مشترک پاسخ کوتاه با سوال، مشکل و پاسخ‌های قبلی (0 = غیرفعال)
+SCREEN_MIN_RELEVANCE = float(os.getenv("SCREEN_MIN_RELEVANCE", "0"))
+# پاسخ‌های بلندتر از این تعداد کلمه از بررسی ارتباط معاف‌اند
+RELEVANCE_MAX_WORDS = 6
+
+MESSAGES = {
+    "non_answer": "اگر علت را دقیق نمی‌دانید، حدس خود یا اولین چیزی که به ذهنتان می‌رسد را بنویسید.",
+    "too_short": "لطفاً پاسخ کامل‌تری بدهید و در یک جمله توضیح دهید چرا این اتفاق افتاد.",
+    "unreadable": "پاسخ قابل فهم نیست. لطفاً آن را به‌صورت یک جمله بنویسید.",
+    "wrong_script": "لطفاً پاسخ را به همان زبان سوال بنویسید.",
+    "duplicate": "این پاسخ قبلاً برای مرحله {step} داده شده است. لطفاً علت یک سطح عمیق‌تر را توضیح دهید.",
+    "echo": "پاسخ شما تکرار خود سوال است. لطفاً علت را توضیح دهید.",
+    "irrelevant": "پاسخ به نظر به این سوال مربوط نیست. لطفاً درباره همین مشکل توضیح دهید.",
+}
+
+_PUNCTUATION = re.compile(r"[^\w\s]|_", re.UNICODE)
+_REPEATED = re.compile(r"(.)\1{3,}")
+
+
+def _plain(text: str) -> str:
+    return " ".join(_PUNCTUATION.sub(" ", normalize_text(text)).split())
+
+
+# پاسخ‌هایی که یعنی «نمی‌دانم» یا اصلاً پاسخ نیستند (به شکل نرمال‌شده مقایسه می‌شوند)
+NON_ANSWERS = {
+    _plain(text) for text in (
+        "نمی‌دونم", "نمیدونم", "نمی‌دانم", "نمیدانم", "نمی‌دونم چرا", "نمی‌دانم چرا", "هیچ ایده‌ای ندارم",
+        "هیچی", "هیچ", "ندارم", "نه", "بله", "آره", "باشه", "سلام", "تست",
+        "idk", "i don't know", "i dont know", "don't know", "dont know", "no idea", "nothing", "none",
+        "n/a", "test", "asdf", "no", "yes", "ok",
+    )
+}
+
+_stats = {"screened": 0, "passed": 0, "llm_calls_avoided": 0, "rejected": {reason: 0 for reason in MESSAGES}}
+
+
+def _script(char: str) -> str:
+    """خط یک حرف از نام یونیکد آن (ARABIC، LATIN، CYRILLIC، CJK و ...)"""
+    return unicodedata.name(char, "").split(" ", 1)[0]
+
+
+def _scripts(text: str) -> Set[str]:
+    return {_script(char) for char in text if char.isalpha()}
+
+
+def _similarity(a: Set[str], b: Set[str]) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def check_answer(
+    problem: str,
+    question: str,
+    previous: List[WhyStep],
+    answer: str
+) -> Optional[Tuple[str, str]]:
+    """
+    بررسی سریع یک پاسخ؛ خروجی (دلیل، پیام درخواست توضیح) یا None اگر پاسخ باید به AI برسد
+
+    فقط موارد آشکار رد می‌شوند و در حالت تردید پاسخ به مدل سپرده می‌شود.
+    """
+    plain = _plain(answer)
+    if plain in NON_ANSWERS:
+        return "non_answer", MESSAGES["non_answer"]
+
+    visible = [char for char in answer if not char.isspace()]
+    letters = [char for char in visible if char.isalpha()]
+    if not letters or len(letters) / len(visible) < SCREEN_MIN_LETTER_RATIO:
+        return "unreadable", MESSAGES["unreadable"]
+    # کوبیدن روی صفحه‌کلید: «ههههههه» یا «aaaaaaa»
+    if _REPEATED.sub("", plain).replace(" ", "") == "":
+        return "unreadable", MESSAGES["unreadable"]
+
+    if SCREEN_MIN_SCRIPT_RATIO > 0:
+        # لاتین همیشه مجاز است (نام سرویس‌ها، کدهای خطا و اصطلاحات فنی)
+        allowed = _scripts(problem) | _scripts(question) | {"LATIN"}
+        matching = sum(1 for char in letters if _script(char) in allowed)
+        if matching / len(letters) < SCREEN_MIN_SCRIPT_RATIO:
+            return "wrong_script", MESSAGES["wrong_script"]
+
+    if len(plain.split()) < SCREEN_MIN_WORDS:
+        return "too_short", MESSAGES["too_short"]
+
+    words = set(query_terms(answer, drop_stopwords=True))
+
+    if SCREEN_DUPLICATE_SIMILARITY > 0:
+        for step in previous:
+            if not step.answer:
+                continue
+            if plain == _plain(step.answer) or (
+                _similarity(words, set(query_terms(step.answer, drop_stopwords=True))) >= SCREEN_DUPLICATE_SIMILARITY
+            ):
+                return "duplicate", MESSAGES["duplicate"].format(step=step.step_number)
+
+    question_words = set(query_terms(question, drop_stopwords=True))
+    if SCREEN_ECHO_SIMILARITY > 0 and len(words) >= 2:
+        if plain == _plain(question) or len(words & question_words) / len(words) >= SCREEN_ECHO_SIMILARITY:
+            return "echo", MESSAGES["echo"]
+
+    if SCREEN_MIN_RELEVANCE > 0 and words and len(plain.split()) <= RELEVANCE_MAX_WORDS:
+        context = question_words | set(query_terms(problem, drop_stopwords=True))
+        for step in previous:
+            context |= set(query_terms(step.answer or "", drop_stopwords=True))
+        if len(words & context) / len(words) < SCREEN_MIN_RELEVANCE:
+            return "irrelevant", MESSAGES["irrelevant"]
+
+    return None
+
+
+def screen_answer(problem: str, steps: List[WhyStep], current_step: int, answer: str) -> Optional[str]:
+    """پیام درخواست توضیح برای پاسخ رد‌شده (و ثبت آمار)؛ None یعنی ادامه با AI"""
+    if not SCREEN_ANSWERS:
+        return None
+    _stats["screened"] += 1
+    result = check_answer(problem, steps[current_step - 1].question, steps[:current_step - 1], answer)
+    if result is None:
+        _stats["passed"] += 1
+        return None
+    reason, message = result
+    _stats["rejected"][reason] += 1
+    # هر پاسخ رد‌شده دست‌کم یک فراخوانی validate_and_generate_next کمتر است
+    _stats["llm_calls_avoided"] += 1
+    return message
+
+
+def get_screening_stats() -> dict:
+    return {"enabled": SCREEN_ANSWERS, **_stats}
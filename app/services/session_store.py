@@ -0,0 +1,462 @@
+import os
+import time
+import zlib
+import asyncio
+import sqlite3
+import logging
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Optional, Tuple
+from urllib.parse import urlparse
+
+from app.models.schemas import AnalysisSession
+
+logger = logging.getLogger(__name__)
+
+# تنظیمات ذخیره‌سازی جلسات
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory")  # memory | sqlite | redis
+SESSION_TIMEOUT = float(os.getenv("SESSION_TIMEOUT", "3600"))
+SESSION_SQLITE_PATH = os.getenv("SESSION_SQLITE_PATH", "sessions.db")
+SESSION_REDIS_URL = os.getenv("SESSION_REDIS_URL", "redis://localhost:6379/0")
+SESSION_KEY_PREFIX = os.getenv("SESSION_KEY_PREFIX", "5whys:session:")
+SESSION_MAX_ENTRIES = int(os.getenv("SESSION_MAX_ENTRIES", "10000"))
+SESSION_MAX_BYTES = int(os.getenv("SESSION_MAX_BYTES", "0"))  # 0 یعنی بدون محدودیت
+SESSION_SWEEP_INTERVAL = float(os.getenv("SESSION_SWEEP_INTERVAL", "60"))
+# مدت اعتبار تعداد جلسات Redis (SCAN کامل برای هر /health پرهزینه است)
+SESSION_COUNT_CACHE_SECONDS = float(os.getenv("SESSION_COUNT_CACHE_SECONDS", "5"))
+
+# جلسات بزرگ‌تر از این اندازه فشرده ذخیره می‌شوند
+_COMPRESS_THRESHOLD = 1024
+_RAW_MARKER = b"j"
+_ZLIB_MARKER = b"z"
+
+
+def serialize_session(session: AnalysisSession) -> bytes:
+    """تبدیل جلسه به بایت‌های فشرده (JSON بدون مقادیر پیش‌فرض)"""
+    data = session.model_dump_json(exclude_defaults=True).encode("utf-8")
+    if len(data) > _COMPRESS_THRESHOLD:
+        return _ZLIB_MARKER + zlib.compress(data, 6)
+    return _RAW_MARKER + data
+
+
+def deserialize_session(data: bytes) -> AnalysisSession:
+    """بازسازی جلسه از خروجی serialize_session"""
+    marker, payload = data[:1], data[1:]
+    if marker == _ZLIB_MARKER:
+        payload = zlib.decompress(payload)
+    return AnalysisSession.model_validate_json(payload)
+
+
+class SessionStore(ABC):
+    """رابط پایه برای ذخیره‌سازی جلسات تحلیل"""
+
+    backend = "base"
+
+    def __init__(self, ttl: float = SESSION_TIMEOUT):
+        self.ttl = ttl
+        self._sweeper: Optional[asyncio.Task] = None
+
+    @abstractmethod
+    async def get(self, session_id: str) -> Optional[AnalysisSession]:
+        ...
+
+    @abstractmethod
+    async def save(self, session: AnalysisSession) -> None:
+        ...
+
+    @abstractmethod
+    async def delete(self, session_id: str) -> bool:
+        ...
+
+    @abstractmethod
+    async def count(self) -> int:
+        ...
+
+    async def sweep(self) -> int:
+        """حذف جلسات منقضی‌شده؛ تعداد حذف‌شده‌ها را برمی‌گرداند"""
+        return 0
+
+    async def _sweep_forever(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                removed = await self.sweep()
+                if removed:
+                    logger.info("Session sweeper removed %d expired sessions", removed)
+            except Exception as e:
+                logger.error("Session sweeper failed: %s", e)
+
+    def start_sweeper(self, interval: float = SESSION_SWEEP_INTERVAL) -> None:
+        """شروع پاک‌سازی دوره‌ای در پس‌زمینه"""
+        if self._sweeper is None and interval > 0:
+            self._sweeper = asyncio.create_task(self._sweep_forever(interval))
+
+    async def stop_sweeper(self) -> None:
+        if self._sweeper is None:
+            return
+        self._sweeper.cancel()
+        try:
+            await self._sweeper
+        except asyncio.CancelledError:
+            pass
+        self._sweeper = None
+
+    async def close(self) -> None:
+        await self.stop_sweeper()
+
+    def stats(self) -> dict:
+        return {"backend": self.backend, "ttl": self.ttl}
+
+
+class MemorySessionStore(SessionStore):
+    """ذخیره جلسات در حافظه همین worker (پیش‌فرض) با سقف LRU و انقضای بیکاری"""
+
+    backend = "memory"
+
+    def __init__(
+        self,
+        ttl: float = SESSION_TIMEOUT,
+        max_entries: int = SESSION_MAX_ENTRIES,
+        max_bytes: int = SESSION_MAX_BYTES
+    ):
+        super().__init__(ttl)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # session_id -> (جلسه، زمان آخرین دسترسی، اندازه تقریبی)
+        self._sessions: "OrderedDict[str, Tuple[AnalysisSession, float, int]]" = OrderedDict()
+        self._total_bytes = 0
+        self.evicted_idle = 0
+        self.evicted_lru = 0
+
+    def _remove(self, session_id: str) -> bool:
+        entry = self._sessions.pop(session_id, None)
+        if entry is None:
+            return False
+        self._total_bytes -= entry[2]
+        return True
+
+    async def get(self, session_id: str) -> Optional[AnalysisSession]:
+        entry = self._sessions.get(session_id)
+        if entry is None:
+            return None
+        session, last_access, size = entry
+        now = time.monotonic()
+        if now - last_access > self.ttl:
+            self._remove(session_id)
+            self.evicted_idle += 1
+            return None
+        # دسترسی، جلسه را به انتهای صف LRU منتقل می‌کند
+        self._sessions[session_id] = (session, now, size)
+        self._sessions.move_to_end(session_id)
+        return session
+
+    async def save(self, session: AnalysisSession) -> None:
+        size = len(session.model_dump_json())
+        self._remove(session.session_id)
+        self._sessions[session.session_id] = (session, time.monotonic(), size)
+        self._total_bytes += size
+
+        # حذف قدیمی‌ترین جلسات در صورت عبور از سقف تعداد یا حجم
+        while len(self._sessions) > 1 and (
+            len(self._sessions) > self.max_entries
+            or (self.max_bytes and self._total_bytes > self.max_bytes)
+        ):
+            oldest = next(iter(self._sessions))
+            self._remove(oldest)
+            self.evicted_lru += 1
+
+    async def delete(self, session_id: str) -> bool:
+        return self._remove(session_id)
+
+    async def count(self) -> int:
+        return len(self._sessions)
+
+    async def sweep(self) -> int:
+        deadline = time.monotonic() - self.ttl
+        # ترتیب LRU یعنی جلسات بیکار در ابتدای صف هستند
+        expired = []
+        for session_id, (_, last_access, _) in self._sessions.items():
+            if last_access > deadline:
+                break
+            expired.append(session_id)
+        for session_id in expired:
+            self._remove(session_id)
+        self.evicted_idle += len(expired)
+        return len(expired)
+
+    def stats(self) -> dict:
+        return {
+            **super().stats(),
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "memory_bytes": self._total_bytes,
+            "evicted_idle": self.evicted_idle,
+            "evicted_lru": self.evicted_lru,
+        }
+
+
+class SQLiteSessionStore(SessionStore):
+    """ذخیره جلسات در SQLite با حالت WAL (مشترک بین workerهای یک ماشین)"""
+
+    backend = "sqlite"
+
+    def __init__(self, path: str = SESSION_SQLITE_PATH, ttl: float = SESSION_TIMEOUT):
+        super().__init__(ttl)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "session_id TEXT PRIMARY KEY, data BLOB NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions(expires_at)"
+        )
+        self._conn.commit()
+
+    def _execute(self, sql: str, params: tuple = (), commit: bool = False):
+        with self._lock:
+            cursor = self._conn.execute(sql, params)
+            rows = cursor.fetchall()
+            if commit:
+                self._conn.commit()
+            return rows, cursor.rowcount
+
+    async def get(self, session_id: str) -> Optional[AnalysisSession]:
+        rows, _ = await asyncio.to_thread(
+            self._execute,
+            "SELECT data FROM sessions WHERE session_id = ? AND expires_at > ?",
+            (session_id, time.time())
+        )
+        if not rows:
+            return None
+        return deserialize_session(rows[0][0])
+
+    async def save(self, session: AnalysisSession) -> None:
+        await asyncio.to_thread(
+            self._execute,
+            "INSERT OR REPLACE INTO sessions (session_id, data, expires_at) VALUES (?, ?, ?)",
+            (session.session_id, serialize_session(session), time.time() + self.ttl),
+            True
+        )
+
+    async def delete(self, session_id: str) -> bool:
+        _, rowcount = await asyncio.to_thread(
+            self._execute,
+            "DELETE FROM sessions WHERE session_id = ?",
+            (session_id,),
+            True
+        )
+        return rowcount > 0
+
+    async def count(self) -> int:
+        rows, _ = await asyncio.to_thread(
+            self._execute,
+            "SELECT COUNT(*) FROM sessions WHERE expires_at > ?",
+            (time.time(),)
+        )
+        return rows[0][0]
+
+    async def sweep(self) -> int:
+        _, rowcount = await asyncio.to_thread(
+            self._execute,
+            "DELETE FROM sessions WHERE expires_at <= ?",
+            (time.time(),),
+            True
+        )
+        return rowcount
+
+    async def close(self) -> None:
+        await super().close()
+        with self._lock:
+            self._conn.close()
+
+    def stats(self) -> dict:
+        return {**super().stats(), "path": self.path}
+
+
+class RedisError(Exception):
+    """خطای برگشتی از سرور Redis"""
+
+
+class RedisClient:
+    """کلاینت حداقلی پروتکل RESP (سازگار با Redis، Valkey، KeyDB و ...)"""
+
+    def __init__(self, url: str = SESSION_REDIS_URL):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.username = parsed.username
+        self.db = int((parsed.path or "/0").lstrip("/") or 0)
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._lock = asyncio.Lock()
+
+    async def _connect(self) -> None:
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        if self.password:
+            if self.username:
+                await self._send("AUTH", self.username, self.password)
+            else:
+                await self._send("AUTH", self.password)
+        if self.db:
+            await self._send("SELECT", self.db)
+
+    @staticmethod
+    def _encode(*args) -> bytes:
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            if isinstance(arg, bytes):
+                value = arg
+            else:
+                value = str(arg).encode("utf-8")
+            parts.append(b"$%d\r\n%s\r\n" % (len(value), value))
+        return b"".join(parts)
+
+    async def _read_reply(self):
+        line = await self._reader.readline()
+        if not line:
+            raise ConnectionError("Redis connection closed")
+        kind, body = line[:1], line[1:-2]
+        if kind == b"+":
+            return body.decode("utf-8")
+        if kind == b"-":
+            raise RedisError(body.decode("utf-8"))
+        if kind == b":":
+            return int(body)
+        if kind == b"$":
+            length = int(body)
+            if length == -1:
+                return None
+            data = await self._reader.readexactly(length + 2)
+            return data[:-2]
+        if kind == b"*":
+            length = int(body)
+            if length == -1:
+                return None
+            return [await self._read_reply() for _ in range(length)]
+        raise RedisError(f"Unknown RESP reply type: {line!r}")
+
+    async def _send(self, *args):
+        self._writer.write(self._encode(*args))
+        await self._writer.drain()
+        return await self._read_reply()
+
+    async def execute(self, *args):
+        """اجرای یک دستور؛ در صورت قطع اتصال یک بار دوباره وصل می‌شود"""
+        async with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._writer is None:
+                        await self._connect()
+                    return await self._send(*args)
+                except (ConnectionError, asyncio.IncompleteReadError, OSError):
+                    await self._reset()
+                    if attempt == 1:
+                        raise
+
+    async def _reset(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except Exception:
+                pass
+        self._reader = None
+        self._writer = None
+
+    async def close(self) -> None:
+        async with self._lock:
+            await self._reset()
+
+
+class RedisSessionStore(SessionStore):
+    """ذخیره جلسات روی سرور سازگار با Redis (مشترک بین workerها و ماشین‌ها)"""
+
+    backend = "redis"
+
+    def __init__(
+        self,
+        url: str = SESSION_REDIS_URL,
+        ttl: float = SESSION_TIMEOUT,
+        prefix: str = SESSION_KEY_PREFIX,
+        count_cache_seconds: float = SESSION_COUNT_CACHE_SECONDS
+    ):
+        super().__init__(ttl)
+        self.url = url
+        self.prefix = prefix
+        self.client = RedisClient(url)
+        self.count_cache_seconds = count_cache_seconds
+        self._count: Optional[int] = None
+        self._counted_at = 0.0
+        self._count_lock = asyncio.Lock()
+
+    def _key(self, session_id: str) -> str:
+        return f"{self.prefix}{session_id}"
+
+    async def get(self, session_id: str) -> Optional[AnalysisSession]:
+        data = await self.client.execute("GET", self._key(session_id))
+        if data is None:
+            return None
+        return deserialize_session(data)
+
+    async def save(self, session: AnalysisSession) -> None:
+        await self.client.execute(
+            "SET", self._key(session.session_id), serialize_session(session),
+            "EX", max(1, int(self.ttl))
+        )
+
+    async def delete(self, session_id: str) -> bool:
+        return await self.client.execute("DEL", self._key(session_id)) > 0
+
+    def _count_is_fresh(self) -> bool:
+        return (
+            self._count is not None
+            and time.monotonic() - self._counted_at < self.count_cache_seconds
+        )
+
+    async def _scan_count(self) -> int:
+        total = 0
+        cursor = "0"
+        while True:
+            cursor, keys = await self.client.execute(
+                "SCAN", cursor, "MATCH", f"{self.prefix}*", "COUNT", 1000
+            )
+            total += len(keys)
+            cursor = cursor.decode("utf-8")
+            if cursor == "0":
+                return total
+
+    async def count(self) -> int:
+        """تعداد تقریبی جلسات؛ حداکثر یک SCAN در هر count_cache_seconds"""
+        if self._count_is_fresh():
+            return self._count
+        async with self._count_lock:
+            # درخواست‌های هم‌زمان منتظر همان یک SCAN می‌مانند
+            if not self._count_is_fresh():
+                self._count = await self._scan_count()
+                self._counted_at = time.monotonic()
+            return self._count
+
+    async def close(self) -> None:
+        await super().close()
+        await self.client.close()
+
+    def stats(self) -> dict:
+        parsed = urlparse(self.url)
+        return {**super().stats(), "host": parsed.hostname, "port": parsed.port}
+
+
+def create_session_store(backend: str = SESSION_BACKEND) -> SessionStore:
+    """ساخت ذخیره‌ساز جلسات بر اساس تنظیمات SESSION_BACKEND"""
+    if backend == "sqlite":
+        return SQLiteSessionStore()
+    if backend == "redis":
+        return RedisSessionStore()
+    if backend != "memory":
+        logger.warning("Unknown SESSION_BACKEND %r; using in-memory store", backend)
+    return MemorySessionStore()
@@ -0,0 +1,171 @@
+import os
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, List, Optional, Tuple
+
+from app.models.schemas import AnalysisSession, WhyStep
+from app.services.config import env_bool
+
+logger = logging.getLogger(__name__)
+
+# تولید پیش‌دستانه خلاصه نهایی هم‌زمان با ارزیابی پاسخ (هزینه توکن بیشتر، مرحله آخر سریع‌تر)
+SPECULATIVE_SUMMARY = env_bool("SPECULATIVE_SUMMARY", False)
+# از این مرحله به بعد (و همیشه در مرحله آخر) خلاصه پیش‌دستانه ساخته می‌شود
+SPECULATIVE_SUMMARY_DEPTH = int(os.getenv("SPECULATIVE_SUMMARY_DEPTH", "5"))
+# حداکثر تعداد پیش‌نویس‌های نگه‌داشته‌شده (برای تلاش دوباره پس از خطا)
+SPECULATIVE_SUMMARY_MAX_DRAFTS = 1000
+
+PURPOSE = "speculative_summary"
+
+_stats = {
+    "started": 0,
+    "reused": 0,
+    "hits": 0,
+    "hits_in_flight": 0,
+    "misses": 0,
+    "wasted": 0,
+    "errors": 0,
+}
+
+
+def chain_fingerprint(steps: List[WhyStep]) -> str:
+    """اثرانگشت زنجیره سوال/پاسخ‌ها؛ با هر پاسخ جدید تغییر می‌کند"""
+    digest = hashlib.sha256()
+    for step in steps:
+        digest.update(f"{step.step_number}\x00{step.question}\x00{step.answer or ''}\x01".encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+class SummaryDraft:
+    """خلاصه پیش‌دستانه یک زنجیره مشخص (task در حال اجرا یا تمام‌شده)"""
+
+    __slots__ = ("session_id", "chain", "task", "used")
+
+    def __init__(self, session_id: str, chain: str, task: asyncio.Task):
+        self.session_id = session_id
+        self.chain = chain
+        self.task = task
+        self.used = False
+
+    async def result(self, steps: List[WhyStep]) -> Optional[Tuple[str, List[str]]]:
+        """
+        خلاصه آماده برای همین زنجیره؛ None یعنی باید generate_summary اجرا شود
+        """
+        if chain_fingerprint(steps) != self.chain:
+            _stats["misses"] += 1
+            return None
+        in_flight = not self.task.done()
+        try:
+            summary = await asyncio.shield(self.task)
+        except asyncio.CancelledError:
+            if not self.task.cancelled():
+                raise
+            _stats["misses"] += 1
+            return None
+        except Exception as e:
+            logger.warning("Speculative summary failed for %s: %s", self.session_id, e)
+            _stats["misses"] += 1
+            return None
+        self.used = True
+        _stats["hits_in_flight" if in_flight else "hits"] += 1
+        return summary
+
+    def discard(self) -> None:
+        if not self.used:
+            _stats["wasted"] += 1
+        if not self.task.done():
+            self.task.cancel()
+
+
+class SummarySpeculator:
+    """نگه‌داری پیش‌نویس خلاصه هر جلسه (در حافظه همین worker)"""
+
+    def __init__(self, max_drafts: int = SPECULATIVE_SUMMARY_MAX_DRAFTS):
+        self.max_drafts = max_drafts
+        self._drafts: "OrderedDict[str, SummaryDraft]" = OrderedDict()
+
+    def should_speculate(self, session: AnalysisSession, final_step: bool) -> bool:
+        return SPECULATIVE_SUMMARY and (final_step or session.current_step >= SPECULATIVE_SUMMARY_DEPTH)
+
+    def start(self, ai_service, session: AnalysisSession, answer: str) -> SummaryDraft:
+        """شروع (یا استفاده دوباره از) خلاصه پیش‌دستانه با فرض پذیرفته شدن answer"""
+        chain = chain_fingerprint(session.steps)
+        draft = self._drafts.get(session.session_id)
+        if draft is not None:
+            if draft.chain == chain and not draft.task.cancelled():
+                _stats["reused"] += 1
+                self._drafts.move_to_end(session.session_id)
+                return draft
+            self.invalidate(session.session_id)
+
+        steps = [step.model_copy() for step in session.steps]
+        conversation = None
+        if session.messages:
+            conversation = session.messages + [{
+                "role": "user",
+                "content": f"پاسخ کاربر به سوال مرحله {session.current_step}: {answer}"
+            }]
+        task = asyncio.create_task(ai_service.generate_summary(
+            session.original_problem, steps, conversation, purpose=PURPOSE
+        ))
+        task.add_done_callback(_record_task_error)
+        draft = SummaryDraft(session.session_id, chain, task)
+        self._drafts[session.session_id] = draft
+        _stats["started"] += 1
+
+        while len(self._drafts) > self.max_drafts:
+            _, oldest = self._drafts.popitem(last=False)
+            oldest.discard()
+        return draft
+
+    def invalidate(self, session_id: str) -> None:
+        draft = self._drafts.pop(session_id, None)
+        if draft is not None:
+            draft.discard()
+
+    def stats(self) -> dict:
+        resolved = _stats["hits"] + _stats["hits_in_flight"] + _stats["misses"]
+        return {
+            "enabled": SPECULATIVE_SUMMARY,
+            "depth": SPECULATIVE_SUMMARY_DEPTH,
+            "drafts": len(self._drafts),
+            **_stats,
+            "hit_ratio": round((_stats["hits"] + _stats["hits_in_flight"]) / resolved, 4) if resolved else None,
+            "waste_ratio": round(_stats["wasted"] / _stats["started"], 4) if _stats["started"] else None,
+        }
+
+
+def _record_task_error(task: asyncio.Task) -> None:
+    if not task.cancelled() and task.exception() is not None:
+        _stats["errors"] += 1
+
+
+summary_speculator = SummarySpeculator()
+
+
+@asynccontextmanager
+async def speculate_summary(
+    ai_service,
+    session: AnalysisSession,
+    answer: str,
+    final_step: bool
+) -> AsyncIterator[Optional[SummaryDraft]]:
+    """
+    اجرای یک مرحله با خلاصه پیش‌دستانه در پس‌زمینه
+
+    اگر مرحله بدون خطا تمام شود پیش‌نویس کنار گذاشته می‌شود (پاسخ بعدی زنجیره را
+    تغییر می‌دهد)؛ در صورت خطا برای تلاش دوباره با همان پاسخ نگه داشته می‌شود.
+    """
+    if not summary_speculator.should_speculate(session, final_step):
+        yield None
+        return
+    draft = summary_speculator.start(ai_service, session, answer)
+    yield draft
+    summary_speculator.invalidate(session.session_id)
+
+
+def get_speculation_stats() -> dict:
+    return summary_speculator.stats()
@@ -0,0 +1,256 @@
+import os
+import re
+import gzip
+import hashlib
+import logging
+import mimetypes
+from typing import Dict, List, Optional, Tuple
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse, Response
+
+logger = logging.getLogger(__name__)
+
+STATIC_DIR = os.getenv("STATIC_DIR", "static")
+# مدت کش فایل‌های دارای اثرانگشت (ثانیه)؛ محتوای آن‌ها هیچ‌وقت تغییر نمی‌کند
+STATIC_MAX_AGE = int(os.getenv("STATIC_MAX_AGE", "31536000"))
+# فایل‌های کوچک‌تر از این اندازه فشرده نمی‌شوند
+STATIC_COMPRESS_MIN_BYTES = int(os.getenv("STATIC_COMPRESS_MIN_BYTES", "1024"))
+
+INDEX_FILE = "index.html"
+URL_PREFIX = "/static/"
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml")
+# ارجاع‌های صفحه اصلی به فایل‌های استاتیک که با نسخه دارای اثرانگشت جایگزین می‌شوند
+_STATIC_REF = re.compile(r'((?:href|src)=")(/static/[^"?#]+)(")')
+
+
+def _brotli():
+    """ماژول brotli در صورت نصب بودن (وابستگی اختیاری)"""
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+def _fingerprinted(path: str, digest: str) -> str:
+    """css/output.css -> css/output.3f2a9c1b7e.css"""
+    base, ext = os.path.splitext(path)
+    return f"{base}.{digest}{ext}"
+
+
+class Asset:
+    """یک فایل استاتیک در حافظه همراه با نسخه‌های فشرده‌شده"""
+
+    __slots__ = ("path", "content_type", "digest", "variants")
+
+    def __init__(self, path: str, content: bytes, content_type: str):
+        self.path = path
+        self.content_type = content_type
+        self.digest = hashlib.sha256(content).hexdigest()[:10]
+        self.variants: Dict[str, bytes] = {"identity": content}
+
+    def compress(self, brotli) -> None:
+        content = self.variants["identity"]
+        if len(content) < STATIC_COMPRESS_MIN_BYTES or not self.content_type.startswith(COMPRESSIBLE_TYPES):
+            return
+        candidates = {"gzip": gzip.compress(content, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            candidates["br"] = brotli.compress(content, quality=11)
+        for encoding, data in candidates.items():
+            if len(data) < len(content):
+                self.variants[encoding] = data
+
+    def etag(self, encoding: str) -> str:
+        return f'"{self.digest}"' if encoding == "identity" else f'"{self.digest}-{encoding}"'
+
+
+def parse_accept_encoding(header: Optional[str]) -> Dict[str, float]:
+    """تبدیل هدر Accept-Encoding به {encoding: q}"""
+    accepted: Dict[str, float] = {}
+    for part in (header or "").split(","):
+        name, _, params = part.strip().partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[name] = q
+    return accepted
+
+
+def choose_encoding(asset: Asset, header: Optional[str]) -> str:
+    """انتخاب بهترین نسخه موجود بر اساس Accept-Encoding (ترجیح با br)"""
+    accepted = parse_accept_encoding(header)
+    best, best_q = "identity", 0.0
+    for encoding in ("br", "gzip"):
+        if encoding not in asset.variants:
+            continue
+        q = accepted.get(encoding, accepted.get("*", 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def _etag_matches(header: Optional[str], asset: Asset) -> bool:
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    # مقایسه ضعیف: هر نسخه فشرده‌ای از همین محتوا معتبر است
+    tags = {tag.strip().removeprefix("W/") for tag in header.split(",")}
+    return any(asset.etag(encoding) in tags for encoding in asset.variants)
+
+
+class AssetPipeline:
+    """
+    آماده‌سازی فایل‌های استاتیک یک بار در شروع برنامه
+
+    هر فایل با اثرانگشت محتوا (مثلاً css/output.3f2a9c1b7e.css) و کش بلندمدت
+    immutable سرو می‌شود و نسخه‌های gzip/brotli از قبل ساخته می‌شوند.
+    ارجاع‌های index.html به نام‌های جدید بازنویسی و خود صفحه در حافظه نگه داشته
+    می‌شود؛ صفحه و نام‌های قدیمی با ETag اعتبارسنجی می‌شوند.
+    """
+
+    def __init__(self, directory: str = STATIC_DIR):
+        self.directory = directory
+        self.assets: Dict[str, Asset] = {}
+        self.fingerprinted: Dict[str, Asset] = {}
+        self.manifest: Dict[str, str] = {}
+        self.index: Optional[Asset] = None
+        self.built = False
+
+    def _files(self) -> List[str]:
+        paths = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                full = os.path.join(root, name)
+                paths.append(os.path.relpath(full, self.directory).replace(os.sep, "/"))
+        return sorted(paths)
+
+    def build(self) -> None:
+        brotli = _brotli()
+        assets: Dict[str, Asset] = {}
+        for path in self._files():
+            content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+            if content_type.startswith("text/"):
+                content_type += "; charset=utf-8"
+            with open(os.path.join(self.directory, path), "rb") as f:
+                asset = Asset(path, f.read(), content_type)
+            assets[path] = asset
+
+        manifest = {URL_PREFIX + path: URL_PREFIX + _fingerprinted(path, asset.digest) for path, asset in assets.items()}
+
+        index = assets.get(INDEX_FILE)
+        if index is not None:
+            html = index.variants["identity"].decode("utf-8")
+            html = _STATIC_REF.sub(lambda m: m.group(1) + manifest.get(m.group(2), m.group(2)) + m.group(3), html)
+            index = Asset(INDEX_FILE, html.encode("utf-8"), index.content_type)
+
+        original = compressed = 0
+        for asset in list(assets.values()) + ([index] if index is not None else []):
+            asset.compress(brotli)
+            original += len(asset.variants["identity"])
+            compressed += min(len(data) for data in asset.variants.values())
+
+        self.assets = assets
+        self.fingerprinted = {_fingerprinted(path, asset.digest): asset for path, asset in assets.items()}
+        self.manifest = manifest
+        self.index = index
+        self.built = True
+        _stats["files"] = len(assets)
+        _stats["bytes"] = original
+        _stats["compressed_bytes"] = compressed
+        _stats["brotli"] = brotli is not None
+        logger.info(
+            "Static assets ready: %d files, %d -> %d bytes (brotli=%s)",
+            len(assets), original, compressed, brotli is not None
+        )
+
+    def ensure_built(self) -> None:
+        if not self.built:
+            self.build()
+
+    def lookup(self, path: str) -> Tuple[Optional[Asset], bool]:
+        """خروجی: (فایل، آیا نام دارای اثرانگشت است)"""
+        self.ensure_built()
+        asset = self.fingerprinted.get(path)
+        if asset is not None:
+            return asset, True
+        return self.assets.get(path), False
+
+    def response(self, request: Request, asset: Asset, immutable: bool) -> Response:
+        cache_control = f"public, max-age={STATIC_MAX_AGE}, immutable" if immutable else "no-cache"
+        encoding = choose_encoding(asset, request.headers.get("accept-encoding"))
+        headers = {
+            "Cache-Control": cache_control,
+            "ETag": asset.etag(encoding),
+            "Vary": "Accept-Encoding",
+        }
+
+        if _etag_matches(request.headers.get("if-none-match"), asset):
+            _stats["not_modified"] += 1
+            return Response(status_code=304, headers=headers)
+
+        body = asset.variants[encoding]
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+            _stats["compressed_responses"] += 1
+        _stats["responses"] += 1
+        if request.method == "HEAD":
+            headers["Content-Length"] = str(len(body))
+            body = b""
+        return Response(body, media_type=asset.content_type, headers=headers)
+
+    def index_response(self, request: Request) -> Response:
+        self.ensure_built()
+        if self.index is None:
+            return PlainTextResponse("Not Found", status_code=404)
+        return self.response(request, self.index, immutable=False)
+
+
+class StaticAssets:
+    """برنامه ASGI جایگزین StaticFiles برای مسیر /static"""
+
+    def __init__(self, pipeline: AssetPipeline):
+        self.pipeline = pipeline
+
+    async def __call__(self, scope, receive, send):
+        request = Request(scope, receive)
+        if request.method not in ("GET", "HEAD"):
+            response = PlainTextResponse("Method Not Allowed", status_code=405, headers={"Allow": "GET, HEAD"})
+        else:
+            # در نسخه‌های مختلف starlette، path داخل Mount با یا بدون root_path است
+            path = scope["path"]
+            root_path = scope.get("root_path", "")
+            if root_path and path.startswith(root_path):
+                path = path[len(root_path):]
+            path = path.lstrip("/")
+            asset, immutable = self.pipeline.lookup(path)
+            if asset is None:
+                response = PlainTextResponse("Not Found", status_code=404)
+            else:
+                response = self.pipeline.response(request, asset, immutable)
+        await response(scope, receive, send)
+
+
+_stats = {
+    "files": 0,
+    "bytes": 0,
+    "compressed_bytes": 0,
+    "brotli": False,
+    "responses": 0,
+    "compressed_responses": 0,
+    "not_modified": 0,
+}
+
+static_pipeline = AssetPipeline()
+
+
+def get_static_stats() -> dict:
+    return dict(_stats)
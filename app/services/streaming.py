@@ -0,0 +1,97 @@
+import re
+import json
+from typing import AsyncIterator, Optional
+
+import httpx
+
+
+def sse_event(event: str, data) -> str:
+    """ساخت یک رویداد Server-Sent Events"""
+    payload = json.dumps(data, ensure_ascii=False)
+    return f"event: {event}\ndata: {payload}\n\n"
+
+
+async def iter_sse_json(response: httpx.Response) -> AsyncIterator[dict]:
+    """خواندن خطوط data: از پاسخ استریم سرویس‌دهنده (سازگار با OpenAI)"""
+    async for line in response.aiter_lines():
+        line = line.strip()
+        if not line.startswith("data:"):
+            continue
+        data = line[5:].strip()
+        if data == "[DONE]":
+            return
+        try:
+            yield json.loads(data)
+        except json.JSONDecodeError:
+            continue
+
+
+_ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+
+class JsonFieldStreamer:
+    """
+    استخراج تدریجی مقدار یک فیلد رشته‌ای از JSON ناقص
+
+    با هر تکه از پاسخ مدل فراخوانی می‌شود و فقط متن جدیدِ فیلد هدف را
+    برمی‌گرداند؛ بنابراین سوال بعدی قبل از کامل شدن JSON قابل نمایش است.
+    """
+
+    def __init__(self, field: str):
+        self.field = field
+        self.buffer = ""
+        self.value = ""
+        self.done = False
+        self._key_pattern = re.compile(r'"%s"\s*:\s*"' % re.escape(field))
+        self._pos: Optional[int] = None  # موقعیت شروع مقدار در buffer
+
+    def feed(self, chunk: str) -> str:
+        self.buffer += chunk
+        if self.done:
+            return ""
+
+        if self._pos is None:
+            match = self._key_pattern.search(self.buffer)
+            if not match:
+                return ""
+            self._pos = match.end()
+
+        out = []
+        i = self._pos
+        while i < len(self.buffer):
+            char = self.buffer[i]
+            if char == '"':
+                self.done = True
+                i += 1
+                break
+            if char == '\\':
+                # escapeهای ناقص را تا رسیدن تکه بعدی نگه می‌داریم
+                if i + 1 >= len(self.buffer):
+                    break
+                code = self.buffer[i + 1]
+                if code == 'u':
+                    if i + 6 > len(self.buffer):
+                        break
+                    try:
+                        out.append(chr(int(self.buffer[i + 2:i + 6], 16)))
+                    except ValueError:
+                        pass
+                    i += 6
+                    continue
+                out.append(_ESCAPES.get(code, code))
+                i += 2
+                continue
+            out.append(char)
+            i += 1
+
+        self._pos = i
+        text = "".join(out)
+        self.value += text
+        return text
+
+    def flag(self, name: str) -> Optional[bool]:
+        """مقدار یک فیلد بولی که تا این لحظه در buffer دیده شده"""
+        match = re.search(r'"%s"\s*:\s*(true|false)' % re.escape(name), self.buffer)
+        if not match:
+            return None
+        return match.group(1) == "true"
@@ -0,0 +1,177 @@
+import os
+import logging
+from typing import Any, Dict, List, Optional
+
+from app.models.schemas import AnalysisSession, TokenBudget
+
+logger = logging.getLogger(__name__)
+
+# بودجه توکن هر جلسه (ورودی + خروجی همه فراخوانی‌ها)؛ اختیاری، 0 = بدون سقف
+SESSION_TOKEN_BUDGET = int(os.getenv("SESSION_TOKEN_BUDGET", "0"))
+# وقتی لاگ گفتگو از این اندازه بزرگ‌تر شود، مراحل قبلی در یک خلاصه فشرده می‌شوند
+CONTEXT_COMPACT_TOKENS = int(os.getenv("CONTEXT_COMPACT_TOKENS", "6000"))
+# حداکثر طول پاسخ هر مرحله در خلاصه فشرده (کاراکتر)
+DIGEST_ANSWER_CHARS = int(os.getenv("DIGEST_ANSWER_CHARS", "400"))
+# encoding مورد استفاده tiktoken (در صورت نصب)
+AI_TOKEN_ENCODING = os.getenv("AI_TOKEN_ENCODING", "cl100k_base")
+
+# سقف خروجی هر فراخوانی (همان max_tokens درخواست‌ها)
+COMPLETION_TOKENS = 1000
+MESSAGE_OVERHEAD_TOKENS = 4
+
+_encoding: Any = None
+_encoding_loaded = False
+
+
+def _get_encoding():
+    """encoding مربوط به tiktoken؛ اگر نصب نباشد None (شمارش تقریبی)"""
+    global _encoding, _encoding_loaded
+    if _encoding_loaded:
+        return _encoding
+    _encoding_loaded = True
+    try:
+        import tiktoken
+        _encoding = tiktoken.get_encoding(AI_TOKEN_ENCODING)
+    except ImportError:
+        _encoding = None
+    except Exception as e:
+        # دانلود فایل BPE ممکن است در محیط بدون اینترنت شکست بخورد
+        logger.warning("Could not load tiktoken encoding %s, using estimates: %s", AI_TOKEN_ENCODING, e)
+        _encoding = None
+    return _encoding
+
+
+def count_text_tokens(text: str) -> int:
+    """
+    تعداد توکن‌های یک متن
+
+    بدون tiktoken: هر ۴ کاراکتر لاتین و هر ۲ کاراکتر غیرلاتین (فارسی) یک توکن
+    حساب می‌شود که برای tokenizerهای BPE رایج کمی بیشتر از مقدار واقعی است.
+    """
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    ascii_chars = sum(1 for char in text if ord(char) < 128)
+    return (ascii_chars + 3) // 4 + (len(text) - ascii_chars + 1) // 2
+
+
+def count_message_tokens(messages: List[dict]) -> int:
+    """تعداد توکن‌های ورودی یک درخواست chat/completions"""
+    total = 0
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, list):
+            content = "".join(part.get("text", "") for part in content if isinstance(part, dict))
+        total += count_text_tokens(content or "") + MESSAGE_OVERHEAD_TOKENS
+    return total
+
+
+def usage_or_estimate(usage: Dict[str, int], messages: List[dict], completion: str) -> Dict[str, int]:
+    """
+    مصرف گزارش‌شده سرویس‌دهنده؛ اگر usage نفرستاده باشد (مثلاً stream بدون
+    stream_options) تخمین محلی تا بودجه جلسه و سقف TPM بدون آن هم کار کنند
+    """
+    if usage.get("prompt_tokens") or usage.get("completion_tokens"):
+        return usage
+    _stats["estimated_calls"] += 1
+    return {
+        "prompt_tokens": count_message_tokens(messages),
+        "completion_tokens": count_text_tokens(completion),
+        "cached_tokens": 0,
+    }
+
+
+class TokenBudgetExceeded(Exception):
+    """بودجه توکن جلسه تمام شده است"""
+
+
+class TokenBudgetManager:
+    """
+    کنترل مصرف توکن و اندازه context هر جلسه
+
+    پیش از هر مرحله: اگر بودجه تمام شده خطا می‌دهد، اگر لاگ گفتگو از آستانه
+    بزرگ‌تر شده آن را با compact_conversation سرویس AI فشرده می‌کند و اگر
+    بودجه باقی‌مانده برای ادامه کافی نیست، مرحله را نهایی اعلام می‌کند.
+    """
+
+    def __init__(
+        self,
+        service: Any,
+        limit: int = SESSION_TOKEN_BUDGET,
+        compact_threshold: int = CONTEXT_COMPACT_TOKENS
+    ):
+        self.service = service
+        self.limit = limit
+        self.compact_threshold = compact_threshold
+
+    def new_budget(self) -> TokenBudget:
+        return TokenBudget(limit=self.limit)
+
+    def record(self, session: AnalysisSession, calls: Any) -> None:
+        """افزودن مصرف یک مرحله (CallStats، گزارش‌شده یا تخمینی) به بودجه جلسه"""
+        budget = session.token_budget
+        budget.prompt_tokens += calls.prompt_tokens
+        budget.completion_tokens += calls.completion_tokens
+        if session.messages:
+            budget.context_tokens = count_message_tokens(session.messages)
+
+    def prepare(self, session: AnalysisSession) -> bool:
+        """
+        آماده‌سازی جلسه برای مرحله بعد
+
+        خروجی True یعنی بودجه فقط برای یک مرحله نهایی (همراه با خلاصه) کافی است.
+        """
+        budget = session.token_budget
+        if budget.limit and budget.used >= budget.limit:
+            _stats["exhausted"] += 1
+            raise TokenBudgetExceeded(
+                "بودجه توکن این جلسه به پایان رسیده است. لطفاً تحلیل جدیدی شروع کنید."
+            )
+
+        context = count_message_tokens(session.messages) if session.messages else 0
+        if session.messages and self.compact_threshold and context > self.compact_threshold:
+            session.messages = self.service.compact_conversation(
+                session.original_problem,
+                session.steps[:session.current_step - 1],
+                session.steps[session.current_step - 1].question
+            )
+            budget.compactions += 1
+            _stats["compactions"] += 1
+            _stats["compacted_tokens"] += context - count_message_tokens(session.messages)
+            context = count_message_tokens(session.messages)
+        budget.context_tokens = context
+
+        # هزینه تقریبی یک مرحله دیگر و خلاصه احتمالی پس از آن
+        next_step_cost = context + COMPLETION_TOKENS
+        if budget.limit and budget.remaining < 2 * next_step_cost:
+            _stats["forced_final"] += 1
+            return True
+        return False
+
+
+_stats = {"compactions": 0, "compacted_tokens": 0, "forced_final": 0, "exhausted": 0, "estimated_calls": 0}
+
+
+def get_budget_stats() -> dict:
+    return {
+        "session_limit": SESSION_TOKEN_BUDGET,
+        "compact_threshold": CONTEXT_COMPACT_TOKENS,
+        "tokenizer": AI_TOKEN_ENCODING if _get_encoding() is not None else "estimate",
+        **_stats,
+    }
+
+
+def digest_steps(steps: List[Any], max_chars: int = DIGEST_ANSWER_CHARS) -> Optional[str]:
+    """خلاصه متنی مراحل پاسخ‌داده‌شده برای جایگزینی بخش قدیمی گفتگو"""
+    def clip(text: str) -> str:
+        text = " ".join(text.split())
+        return text if len(text) <= max_chars else text[:max_chars].rstrip() + "…"
+
+    lines = []
+    for step in steps:
+        if not step.answer:
+            continue
+        lines.append(f"چرا {step.step_number}: {clip(step.question)}\nپاسخ: {clip(step.answer)}")
+    return "\n".join(lines) or None
@@ -0,0 +1,304 @@
+import os
+import sys
+import json
+import time
+import atexit
+import random
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterator, List, Optional
+
+from app.services.log_pipeline import QueueLogHandler
+
+logger = logging.getLogger(__name__)
+
+# ردیابی مسیر هر درخواست (span) به سبک OpenTelemetry
+# خروجی: none (فقط شناسه trace در هدر و لاگ) | stdout | jsonl
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "none").lower()
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+# نسبت درخواست‌هایی که spanهای آن‌ها ثبت می‌شود
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.1"))
+# درخواست‌های کندتر از این مقدار (میلی‌ثانیه) حتی بدون نمونه‌برداری ثبت می‌شوند (0 = غیرفعال)
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "0"))
+
+
+def _new_id(bits: int) -> str:
+    return f"{random.getrandbits(bits):0{bits // 4}x}"
+
+
+class Trace:
+    """spanهای یک درخواست؛ پس از پایان span ریشه یکجا صادر می‌شوند"""
+
+    __slots__ = ("trace_id", "sampled", "recording", "spans")
+
+    def __init__(self, trace_id: str, sampled: bool):
+        self.trace_id = trace_id
+        self.sampled = sampled
+        # درخواست نمونه‌برداری‌نشده هم در صورت فعال بودن TRACE_SLOW_MS ثبت می‌شود
+        self.recording = exporter is not None and (sampled or TRACE_SLOW_MS > 0)
+        self.spans: List["Span"] = []
+
+
+class Span:
+    __slots__ = ("trace", "name", "span_id", "parent_id", "start", "end", "attributes", "status", "error")
+
+    def __init__(self, trace: Trace, name: str, parent_id: Optional[str], attributes: dict):
+        self.trace = trace
+        self.name = name
+        self.span_id = _new_id(64)
+        self.parent_id = parent_id
+        self.start = time.time()
+        self.end: Optional[float] = None
+        self.attributes = attributes
+        self.status = "ok"
+        self.error: Optional[str] = None
+
+    @property
+    def trace_id(self) -> str:
+        return self.trace.trace_id
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end or time.time()) - self.start) * 1000
+
+    def set(self, **attributes) -> None:
+        if self.trace.recording:
+            self.attributes.update(attributes)
+
+    def fail(self, error: BaseException) -> None:
+        self.status = "error"
+        self.error = f"{type(error).__name__}: {error}"
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": round(self.start, 6),
+            "duration_ms": round(self.duration_ms, 3),
+            "status": self.status,
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+
+_current: ContextVar[Optional[Span]] = ContextVar("trace_span", default=None)
+
+
+# --- صادرکننده‌ها ---
+
+class SpanFormatter(logging.Formatter):
+    """هر span یک سطر JSON (رکوردهای دیگر صف، مثل هشدار دور ریختن، هم JSON)"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        spans = getattr(record, "spans", None)
+        if spans is None:
+            return json.dumps({"level": record.levelname, "msg": record.getMessage()}, ensure_ascii=False)
+        return "\n".join(json.dumps(span, ensure_ascii=False) for span in spans)
+
+
+class QueuedSpanExporter:
+    """
+    صادرکننده پایه: spanها در صف محدود handler لاگ قرار می‌گیرند
+
+    تبدیل به JSON و نوشتن در thread نویسنده انجام می‌شود تا خروجی کند
+    event loop را متوقف نکند؛ با پر بودن صف، trace دور ریخته و شمرده می‌شود.
+    """
+
+    def __init__(self, path: str = "", stream=None):
+        self.stats = {"enqueued": 0, "written": 0, "dropped": {}, "errors": 0}
+        self.handler = QueueLogHandler(SpanFormatter(), path=path, stream=stream, stats=self.stats)
+        self.handler.start()
+        atexit.register(self.handler.stop)
+
+    def export(self, spans: List[dict]) -> None:
+        self.handler.emit(logging.makeLogRecord({
+            "name": __name__,
+            "levelno": logging.INFO,
+            "levelname": "INFO",
+            "msg": "spans",
+            "spans": spans,
+        }))
+
+
+class StdoutExporter(QueuedSpanExporter):
+    def __init__(self):
+        super().__init__(stream=sys.stdout)
+
+
+class JsonlExporter(QueuedSpanExporter):
+    """افزودن هر span به‌صورت یک سطر JSON به فایل (برای تحلیل آفلاین)"""
+
+    def __init__(self, path: str):
+        super().__init__(path=path)
+
+
+EXPORTERS: Dict[str, Callable[[], object]] = {
+    "stdout": StdoutExporter,
+    "jsonl": lambda: JsonlExporter(TRACE_FILE),
+}
+
+
+def _create_exporter(name: str):
+    if name in ("", "none", "off"):
+        return None
+    factory = EXPORTERS.get(name)
+    if factory is None:
+        logger.error("Unknown TRACE_EXPORTER %r, tracing export disabled", name)
+        return None
+    return factory()
+
+
+exporter = _create_exporter(TRACE_EXPORTER)
+
+_stats = {"traces": 0, "exported_traces": 0, "slow_traces": 0, "exported_spans": 0, "export_errors": 0}
+
+
+def set_exporter(new_exporter) -> None:
+    """جایگزینی صادرکننده (هر شیء با متد export(list[dict]))؛ None یعنی بدون خروجی"""
+    global exporter
+    exporter = new_exporter
+
+
+def _export(trace: Trace, slow: bool) -> None:
+    if exporter is None or not trace.spans:
+        return
+    try:
+        exporter.export([span.to_dict() for span in trace.spans])
+    except Exception as e:
+        _stats["export_errors"] += 1
+        logger.warning("Trace export failed: %s", e)
+        return
+    _stats["exported_traces"] += 1
+    _stats["exported_spans"] += len(trace.spans)
+    if slow:
+        _stats["slow_traces"] += 1
+
+
+def parse_traceparent(header: Optional[str]):
+    """خواندن هدر W3C traceparent؛ خروجی: (trace_id، parent_id، sampled) یا None"""
+    if not header:
+        return None
+    parts = header.strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        int(parts[1], 16)
+        int(parts[2], 16)
+        flags = int(parts[3], 16)
+    except ValueError:
+        return None
+    if parts[1] == "0" * 32:
+        return None
+    return parts[1], parts[2], bool(flags & 1)
+
+
+@contextmanager
+def span(name: str, traceparent: Optional[str] = None, **attributes) -> Iterator[Span]:
+    """
+    اجرای یک بخش از کار در یک span
+
+    بدون span والد، trace جدیدی شروع می‌شود (با ادامه traceparent در صورت وجود)
+    و تصمیم نمونه‌برداری همان‌جا گرفته می‌شود. خطاها ثبت و دوباره پرتاب می‌شوند.
+    """
+    parent = _current.get()
+    if parent is not None:
+        trace = parent.trace
+        current = Span(trace, name, parent.span_id, attributes if trace.recording else {})
+    else:
+        incoming = parse_traceparent(traceparent)
+        if incoming is not None:
+            trace_id, parent_id, sampled = incoming
+        else:
+            trace_id, parent_id, sampled = _new_id(128), None, random.random() < TRACE_SAMPLE_RATE
+        trace = Trace(trace_id, sampled)
+        current = Span(trace, name, parent_id, attributes if trace.recording else {})
+        _stats["traces"] += 1
+
+    token = _current.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.fail(e)
+        raise
+    finally:
+        current.end = time.time()
+        try:
+            _current.reset(token)
+        except ValueError:
+            # generator در context دیگری ادامه یافته است
+            _current.set(parent)
+        if trace.recording:
+            trace.spans.append(current)
+            if parent is None or parent.end is not None:
+                slow = TRACE_SLOW_MS > 0 and current.duration_ms >= TRACE_SLOW_MS
+                if trace.sampled or slow:
+                    _export(trace, slow and not trace.sampled)
+                trace.spans = []
+
+
+def current_span() -> Optional[Span]:
+    return _current.get()
+
+
+def current_trace_id() -> Optional[str]:
+    current = _current.get()
+    return current.trace_id if current is not None else None
+
+
+def traceparent_header(current: Span) -> str:
+    return f"00-{current.trace_id}-{current.span_id}-{'01' if current.trace.sampled else '00'}"
+
+
+class TraceIdFilter(logging.Filter):
+    """افزودن trace_id درخواست جاری به رکوردهای لاگ"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.trace_id = current_trace_id() or "-"
+        return True
+
+
+class TracingMiddleware:
+    """
+    span ریشه هر درخواست HTTP تا ارسال آخرین بخش بدنه (شامل stream)
+
+    شناسه trace در هدرهای X-Trace-Id و traceparent پاسخ برگردانده می‌شود.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope.get("headers") or [])
+        traceparent = headers.get(b"traceparent", b"").decode("latin-1") or None
+        name = f"{scope['method']} {scope['path']}"
+
+        with span(name, traceparent=traceparent, method=scope["method"], path=scope["path"]) as root:
+            async def send_with_trace(message):
+                if message["type"] == "http.response.start":
+                    root.set(status_code=message["status"])
+                    if message["status"] >= 500:
+                        root.status = "error"
+                    message["headers"] = list(message.get("headers", [])) + [
+                        (b"x-trace-id", root.trace_id.encode("latin-1")),
+                        (b"traceparent", traceparent_header(root).encode("latin-1")),
+                    ]
+                await send(message)
+
+            await self.app(scope, receive, send_with_trace)
+
+
+def get_tracing_stats() -> dict:
+    return {
+        "exporter": TRACE_EXPORTER if exporter is not None else "none",
+        "sample_rate": TRACE_SAMPLE_RATE,
+        "slow_ms": TRACE_SLOW_MS,
+        **_stats,
+        "writer": getattr(exporter, "stats", None),
+    }
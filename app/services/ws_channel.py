@@ -0,0 +1,202 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Awaitable, Callable, Deque, Optional
+from starlette.websockets import WebSocket, WebSocketDisconnect
+
+logger = logging.getLogger(__name__)
+
+# فاصله ارسال ping از سمت سرور (ثانیه)
+WS_PING_INTERVAL = float(os.getenv("WS_PING_INTERVAL", "20"))
+# اگر در این مدت هیچ پیامی (حتی pong) از کلاینت نرسد اتصال بسته می‌شود
+WS_IDLE_TIMEOUT = float(os.getenv("WS_IDLE_TIMEOUT", "60"))
+# تعداد پیام‌های در صف ارسال؛ پس از پر شدن، تکه‌های متن (delta) با هم ادغام می‌شوند
+WS_SEND_QUEUE = int(os.getenv("WS_SEND_QUEUE", "32"))
+# کلاینتی که یک پیام را در این مدت دریافت نکند کند فرض شده و قطع می‌شود
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", "10"))
+WS_MAX_MESSAGE_CHARS = 8192
+
+# کدهای بستن اتصال (بازه 4000-4999 مخصوص برنامه است)
+CLOSE_IDLE = 4408
+CLOSE_SLOW_CONSUMER = 4429
+
+_stats = {
+    "open": 0,
+    "connections": 0,
+    "answers": 0,
+    "busy_rejections": 0,
+    "coalesced_deltas": 0,
+    "idle_closes": 0,
+    "slow_consumer_closes": 0,
+}
+
+
+class SessionChannel:
+    """
+    اتصال WebSocket یک جلسه تحلیل
+
+    ارسال از طریق صف محدود و یک task نویسنده انجام می‌شود تا stream مدل منتظر
+    کلاینت کند نماند: با پر شدن صف، deltaهای پشت‌سرهم یکی می‌شوند و پیام‌های
+    دیگر تا خالی شدن جا منتظر می‌مانند. در هر لحظه فقط یک پاسخ پردازش می‌شود.
+    """
+
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        self.closed = False
+        self.last_received = time.monotonic()
+        self._outbox: Deque[dict] = deque()
+        self._sending = False
+        self._changed = asyncio.Condition()
+        self._busy: Optional[asyncio.Task] = None
+
+    async def send(self, message: dict) -> None:
+        """قرار دادن یک پیام در صف ارسال"""
+        async with self._changed:
+            if message.get("type") == "delta" and len(self._outbox) >= WS_SEND_QUEUE:
+                last = self._outbox[-1]
+                if last.get("type") == "delta" and last.get("field") == message.get("field"):
+                    last["text"] += message["text"]
+                    _stats["coalesced_deltas"] += 1
+                    return
+            await self._changed.wait_for(lambda: self.closed or len(self._outbox) < WS_SEND_QUEUE)
+            if self.closed:
+                return
+            self._outbox.append(message)
+            self._changed.notify_all()
+
+    async def close(self, code: int = 1000, reason: str = "") -> None:
+        """بستن اتصال پس از ارسال پیام‌های باقی‌مانده در صف"""
+        async with self._changed:
+            await self._changed.wait_for(lambda: self.closed or not (self._outbox or self._sending))
+            if self.closed:
+                return
+            self.closed = True
+            self._changed.notify_all()
+        try:
+            await self.websocket.close(code=code, reason=reason)
+        except Exception:
+            pass
+
+    async def reject(self, code: int, detail: str) -> None:
+        """ارسال خطا و بستن اتصال پیش از شروع serve (مثلاً جلسه یافت نشد)"""
+        self.closed = True
+        try:
+            await self.websocket.send_json({"type": "error", "detail": detail})
+            await self.websocket.close(code=code, reason="rejected")
+        except Exception:
+            pass
+
+    async def _abort(self, code: int, reason: str) -> None:
+        async with self._changed:
+            self.closed = True
+            self._outbox.clear()
+            self._changed.notify_all()
+        try:
+            await self.websocket.close(code=code, reason=reason)
+        except Exception:
+            pass
+
+    async def _writer(self) -> None:
+        while True:
+            async with self._changed:
+                await self._changed.wait_for(lambda: self.closed or self._outbox)
+                if self.closed:
+                    return
+                # پیام در حال ارسال از صف خارج می‌شود تا deltaهای بعدی با آن ادغام نشوند
+                message = self._outbox.popleft()
+                self._sending = True
+            try:
+                await asyncio.wait_for(self.websocket.send_json(message), WS_SEND_TIMEOUT)
+            except asyncio.TimeoutError:
+                _stats["slow_consumer_closes"] += 1
+                await self._abort(CLOSE_SLOW_CONSUMER, "slow consumer")
+                return
+            except Exception:
+                await self._abort(1011, "send failed")
+                return
+            async with self._changed:
+                self._sending = False
+                self._changed.notify_all()
+
+    async def _heartbeat(self) -> None:
+        while not self.closed:
+            await asyncio.sleep(WS_PING_INTERVAL)
+            if time.monotonic() - self.last_received > WS_IDLE_TIMEOUT:
+                _stats["idle_closes"] += 1
+                await self._abort(CLOSE_IDLE, "idle timeout")
+                return
+            await self.send({"type": "ping", "time": time.time()})
+
+    async def _run_handler(self, handler: Callable[[dict], Awaitable[None]], message: dict) -> None:
+        try:
+            await handler(message)
+        except Exception as e:
+            logger.warning("WebSocket handler failed: %s", e)
+            await self.send({"type": "error", "detail": f"خطا: {str(e)}"})
+
+    async def serve(self, handler: Callable[[dict], Awaitable[None]], hello: Optional[dict] = None) -> None:
+        """
+        دریافت پیام‌ها تا قطع اتصال
+
+        پیام‌های answer در task جداگانه به handler داده می‌شوند تا در طول
+        فراخوانی AI هم ping/pong پاسخ داده شود.
+        """
+        _stats["open"] += 1
+        _stats["connections"] += 1
+        writer = asyncio.create_task(self._writer())
+        heartbeat = asyncio.create_task(self._heartbeat())
+        try:
+            if hello is not None:
+                await self.send(hello)
+            while not self.closed:
+                try:
+                    text = await self.websocket.receive_text()
+                except (WebSocketDisconnect, RuntimeError):
+                    break
+                self.last_received = time.monotonic()
+                try:
+                    if len(text) > WS_MAX_MESSAGE_CHARS:
+                        raise ValueError("message too large")
+                    message = json.loads(text)
+                    if not isinstance(message, dict):
+                        raise ValueError("message must be an object")
+                except ValueError as e:
+                    await self.send({"type": "error", "detail": f"پیام نامعتبر: {e}"})
+                    continue
+
+                kind = message.get("type")
+                if kind == "ping":
+                    await self.send({"type": "pong"})
+                elif kind == "pong":
+                    continue
+                elif kind == "answer":
+                    if self._busy is not None and not self._busy.done():
+                        _stats["busy_rejections"] += 1
+                        await self.send({"type": "error", "detail": "پاسخ قبلی هنوز در حال پردازش است"})
+                        continue
+                    _stats["answers"] += 1
+                    self._busy = asyncio.create_task(self._run_handler(handler, message))
+                else:
+                    await self.send({"type": "error", "detail": f"نوع پیام ناشناخته: {kind}"})
+        finally:
+            _stats["open"] -= 1
+            if self._busy is not None and not self._busy.done():
+                # کلاینت رفته است؛ پردازش پاسخ تا ذخیره جلسه ادامه پیدا می‌کند
+                await asyncio.gather(self._busy, return_exceptions=True)
+            async with self._changed:
+                self.closed = True
+                self._changed.notify_all()
+            heartbeat.cancel()
+            await asyncio.gather(writer, heartbeat, return_exceptions=True)
+
+
+def get_websocket_stats() -> dict:
+    return {
+        "ping_interval": WS_PING_INTERVAL,
+        "idle_timeout": WS_IDLE_TIMEOUT,
+        "send_queue": WS_SEND_QUEUE,
+        **_stats,
+    }
@@ -0,0 +1,226 @@
+"""
+سرویس‌دهنده AI ساختگی سازگار با OpenAI برای بنچمارک و اجرای محلی
+
+    python -m bench.mock_provider --port 8901 --latency lognormal --latency-mean 0.8 --error-rate 0.02
+
+پاسخ‌ها بر اساس response_format درخواست (یا متن prompt) انتخاب می‌شوند:
+سوال اول متنی، ارزیابی مرحله و خلاصه به‌صورت JSON. پس از --steps-to-root پاسخ
+علت ریشه‌ای برگردانده می‌شود.
+"""
+import json
+import math
+import random
+import asyncio
+import argparse
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+@dataclass
+class MockConfig:
+    latency: str = "fixed"  # fixed | uniform | lognormal
+    latency_mean: float = 0.2  # ثانیه تا اولین بایت
+    latency_spread: float = 0.5  # برای uniform نیمه بازه (نسبی) و برای lognormal انحراف معیار لگاریتمی
+    chunk_size: int = 8  # کاراکتر در هر تکه stream
+    chunk_delay: float = 0.01
+    error_rate: float = 0.0
+    error_statuses: List[int] = field(default_factory=lambda: [429, 503])
+    retry_after: Optional[float] = 0.2
+    steps_to_root: int = 4
+    # درصد پاسخ‌هایی که داخل code fence و با متن اضافه برگردانده می‌شوند
+    fenced_rate: float = 0.0
+    # درصد پاسخ‌های علت ریشه‌ای بدون root_cause (مسیر فراخوانی جداگانه خلاصه)
+    missing_summary_rate: float = 0.0
+    seed: Optional[int] = None
+
+
+def _sample_latency(config: MockConfig, rng: random.Random) -> float:
+    if config.latency == "uniform":
+        spread = config.latency_mean * config.latency_spread
+        return max(0.0, rng.uniform(config.latency_mean - spread, config.latency_mean + spread))
+    if config.latency == "lognormal":
+        # میانگین توزیع برابر latency_mean می‌ماند
+        sigma = config.latency_spread
+        mu = math.log(max(config.latency_mean, 1e-6)) - sigma ** 2 / 2
+        return rng.lognormvariate(mu, sigma)
+    return config.latency_mean
+
+
+def _text(content) -> str:
+    if isinstance(content, list):
+        return "".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return content or ""
+
+
+def _request_kind(body: dict) -> str:
+    schema_name = ((body.get("response_format") or {}).get("json_schema") or {}).get("name")
+    messages = body.get("messages") or []
+    system = _text(messages[0].get("content")) if messages else ""
+    last = _text(messages[-1].get("content")) if messages else ""
+    if "JSON اصلاح‌شده" in system:
+        return "repair"
+    if schema_name == "why_summary" or "تحلیل به پایان رسیده است" in last or (
+        "root_cause" in system and "is_valid" not in system
+    ):
+        return "summary"
+    if schema_name == "why_step_evaluation" or "is_valid" in system:
+        return "step"
+    return "first_why"
+
+
+def _step_number(body: dict) -> int:
+    """تعداد پاسخ‌های مدل در گفتگو (در حالت تاریخچه متنی: تعداد سوال‌های پاسخ‌داده‌شده)"""
+    messages = body.get("messages") or []
+    assistants = sum(1 for message in messages if message.get("role") == "assistant")
+    if assistants:
+        return assistants
+    return _text(messages[-1].get("content")).count("\nپاسخ ") if messages else 1
+
+
+def _content(body: dict, config: MockConfig, rng: random.Random) -> str:
+    kind = _request_kind(body)
+    if kind == "first_why":
+        return "چرا این مشکل در سرویس شما رخ داده است؟"
+    if kind == "summary":
+        data = {
+            "root_cause": "نبود پایش ظرفیت و هشدار پیش از رسیدن به سقف منابع",
+            "recommendations": ["افزودن هشدار ظرفیت", "بازبینی فرایند استقرار", "تمرین دوره‌ای بازیابی"],
+        }
+    else:
+        step = _step_number(body)
+        final = "آخرین مرحله" in _text((body.get("messages") or [{}])[-1].get("content"))
+        root = kind == "step" and (step >= config.steps_to_root or final)
+        summarized = root and not (config.missing_summary_rate and rng.random() < config.missing_summary_rate)
+        data = {
+            "is_valid": True,
+            "needs_clarification": False,
+            "clarification_message": None,
+            "is_root_found": root,
+            "next_question": None if root else f"چرا مرحله {step} اتفاق افتاد؟",
+            "root_cause": "نبود پایش ظرفیت" if summarized else None,
+            "recommendations": ["افزودن هشدار ظرفیت", "بازبینی فرایند استقرار"] if summarized else None,
+        }
+    content = json.dumps(data, ensure_ascii=False)
+    if config.fenced_rate and rng.random() < config.fenced_rate:
+        content = f"پاسخ:\n```json\n{content}\n```\nامیدوارم مفید باشد."
+    return content
+
+
+def _usage(body: dict, content: str) -> dict:
+    prompt_tokens = len(json.dumps(body.get("messages") or [], ensure_ascii=False)) // 4
+    completion_tokens = max(1, len(content) // 4)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+
+
+def create_app(config: Optional[MockConfig] = None) -> FastAPI:
+    config = config or MockConfig()
+    rng = random.Random(config.seed)
+    app = FastAPI(title="Mock AI provider")
+    app.state.stats = {"requests": 0, "streams": 0, "errors_injected": 0, "by_kind": {}}
+
+    @app.get("/v1/models")
+    async def models():
+        return {"object": "list", "data": [{"id": "mock-model", "object": "model"}]}
+
+    @app.get("/stats")
+    async def stats():
+        return app.state.stats
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        stats = app.state.stats
+        stats["requests"] += 1
+        kind = _request_kind(body)
+        stats["by_kind"][kind] = stats["by_kind"].get(kind, 0) + 1
+
+        await asyncio.sleep(_sample_latency(config, rng))
+
+        if config.error_rate and rng.random() < config.error_rate:
+            stats["errors_injected"] += 1
+            status = rng.choice(config.error_statuses)
+            headers = {"Retry-After": str(config.retry_after)} if config.retry_after is not None else {}
+            return JSONResponse({"error": {"message": "injected error"}}, status_code=status, headers=headers)
+
+        content = _content(body, config, rng)
+        usage = _usage(body, content)
+        model = body.get("model", "mock-model")
+
+        if not body.get("stream"):
+            return {
+                "id": "chatcmpl-mock",
+                "object": "chat.completion",
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": usage,
+            }
+
+        stats["streams"] += 1
+
+        async def events():
+            for start in range(0, len(content), config.chunk_size):
+                chunk = {"choices": [{"index": 0, "delta": {"content": content[start:start + config.chunk_size]}}]}
+                yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+                if config.chunk_delay:
+                    await asyncio.sleep(config.chunk_delay)
+            if (body.get("stream_options") or {}).get("include_usage"):
+                yield f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return app
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """گزینه‌های خط فرمان سرویس‌دهنده ساختگی (در bench.run هم استفاده می‌شود)"""
+    defaults = MockConfig()
+    parser.add_argument("--latency", choices=["fixed", "uniform", "lognormal"], default=defaults.latency)
+    parser.add_argument("--latency-mean", type=float, default=defaults.latency_mean, help="میانگین تاخیر (ثانیه)")
+    parser.add_argument("--latency-spread", type=float, default=defaults.latency_spread)
+    parser.add_argument("--chunk-size", type=int, default=defaults.chunk_size)
+    parser.add_argument("--chunk-delay", type=float, default=defaults.chunk_delay)
+    parser.add_argument("--error-rate", type=float, default=defaults.error_rate, help="نسبت خطاهای تزریقی")
+    parser.add_argument("--error-statuses", default="429,503", help="کدهای وضعیت خطای تزریقی")
+    parser.add_argument("--steps-to-root", type=int, default=defaults.steps_to_root)
+    parser.add_argument("--fenced-rate", type=float, default=defaults.fenced_rate)
+    parser.add_argument("--missing-summary-rate", type=float, default=defaults.missing_summary_rate)
+    parser.add_argument("--seed", type=int, default=None)
+
+
+def config_from_args(args: argparse.Namespace) -> MockConfig:
+    return MockConfig(
+        latency=args.latency,
+        latency_mean=args.latency_mean,
+        latency_spread=args.latency_spread,
+        chunk_size=args.chunk_size,
+        chunk_delay=args.chunk_delay,
+        error_rate=args.error_rate,
+        error_statuses=[int(status) for status in args.error_statuses.split(",") if status.strip()],
+        steps_to_root=args.steps_to_root,
+        fenced_rate=args.fenced_rate,
+        missing_summary_rate=args.missing_summary_rate,
+        seed=args.seed,
+    )
+
+
+def main() -> None:
+    import uvicorn
+
+    parser = argparse.ArgumentParser(prog="python -m bench.mock_provider", description="سرویس‌دهنده AI ساختگی")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8901)
+    add_arguments(parser)
+    args = parser.parse_args()
+    uvicorn.run(create_app(config_from_args(args)), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
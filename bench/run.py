@@ -0,0 +1,318 @@
+"""
+بنچمارک بار جلسات کامل تحلیل (شروع ← پاسخ‌ها ← خلاصه)
+
+    python -m bench.run --sessions 200 --concurrency 20 --output results.json
+    python -m bench.run --stream --latency lognormal --latency-mean 0.5
+    python -m bench.run --target http://localhost:8000 --sessions 100
+    python -m bench.run --compare baseline.json results.json
+
+بدون --target، سرویس‌دهنده ساختگی و app.main:app با uvicorn روی پورت‌های آزاد
+داخل همین فرایند اجرا می‌شوند. خروجی JSON شامل commit جاری است تا نتایج commitها مقایسه شوند.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import resource
+import platform
+import threading
+import subprocess
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+import httpx
+
+from bench.mock_provider import add_arguments, config_from_args, create_app
+
+ANSWERS = [
+    "چون سرور پایگاه داده زیر بار زیاد کند شد",
+    "چون تعداد اتصال‌ها از سقف pool بیشتر شد",
+    "چون یک کوئری بدون ایندکس در هر درخواست اجرا می‌شد",
+    "چون تغییر اخیر بدون بررسی کارایی منتشر شد",
+    "چون فرایند بازبینی شامل تست بار نیست",
+    "چون تیم زمان کافی برای تست بار نداشت",
+    "چون اولویت‌بندی پروژه‌ها بدون در نظر گرفتن ریسک انجام می‌شود",
+]
+PROBLEM = "سرویس پرداخت ما در ساعات شلوغ هر روز چند دقیقه از دسترس خارج می‌شود"
+
+# معیارهایی که در --compare کمتر بودنشان بهتر است
+LOWER_IS_BETTER = ("p50", "p95", "p99", "mean", "tokens_per_session", "memory_bytes_per_session", "rss_bytes_per_session")
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def summarize(values: List[float]) -> dict:
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values), 4),
+        "p50": round(percentile(values, 50), 4),
+        "p95": round(percentile(values, 95), 4),
+        "p99": round(percentile(values, 99), 4),
+        "max": round(max(values), 4),
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def rss_bytes() -> int:
+    # ru_maxrss در لینوکس کیلوبایت و در macOS بایت است
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = {}
+        self.first_delta: List[float] = []
+        self.sessions: List[float] = []
+        self.steps: List[int] = []
+        self.requests = 0
+        self.errors: Dict[str, int] = {}
+
+    def request(self, name: str, seconds: float) -> None:
+        self.requests += 1
+        self.latencies.setdefault(name, []).append(seconds)
+
+    def error(self, kind: str) -> None:
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+
+async def read_sse_result(response: httpx.Response, recorder: Recorder, started: float) -> dict:
+    """خواندن رویدادهای SSE تا رویداد result (زمان اولین delta ثبت می‌شود)"""
+    event = None
+    first = True
+    async for line in response.aiter_lines():
+        if line.startswith("event:"):
+            event = line[6:].strip()
+            if event == "delta" and first:
+                recorder.first_delta.append(time.perf_counter() - started)
+                first = False
+        elif line.startswith("data:") and event in ("result", "error"):
+            data = json.loads(line[5:])
+            if event == "error":
+                raise RuntimeError(data.get("detail"))
+            return data
+    raise RuntimeError("stream ended without result")
+
+
+async def call(client: httpx.AsyncClient, recorder: Recorder, name: str, path: str, body: dict, stream: bool) -> dict:
+    started = time.perf_counter()
+    if stream:
+        async with client.stream("POST", f"{path}/stream", json=body) as response:
+            if response.status_code != 200:
+                await response.aread()
+                raise RuntimeError(f"HTTP {response.status_code}")
+            data = await read_sse_result(response, recorder, started)
+    else:
+        response = await client.post(path, json=body)
+        if response.status_code != 200:
+            raise RuntimeError(f"HTTP {response.status_code}")
+        data = response.json()
+    recorder.request(name, time.perf_counter() - started)
+    return data
+
+
+async def run_session(client: httpx.AsyncClient, recorder: Recorder, index: int, stream: bool) -> None:
+    started = time.perf_counter()
+    try:
+        data = await call(client, recorder, "start", "/api/start", {"problem": f"{PROBLEM} (#{index})"}, stream)
+        session_id = data["session_id"]
+        steps = 0
+        for answer in ANSWERS:
+            data = await call(
+                client, recorder, "answer", "/api/answer",
+                {"session_id": session_id, "answer": answer}, stream
+            )
+            steps += 1
+            if data.get("root_cause") or data.get("needs_clarification"):
+                break
+        recorder.steps.append(steps)
+        recorder.sessions.append(time.perf_counter() - started)
+    except Exception as e:
+        recorder.error(type(e).__name__ if not isinstance(e, RuntimeError) else str(e))
+
+
+async def drive(client: httpx.AsyncClient, args: argparse.Namespace) -> dict:
+    recorder = Recorder()
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def limited(index: int):
+        async with semaphore:
+            await run_session(client, recorder, index, args.stream)
+
+    # گرم کردن اتصال‌ها و کش‌ها خارج از اندازه‌گیری
+    for index in range(args.warmup):
+        await run_session(client, Recorder(), -index - 1, args.stream)
+
+    before = (await client.get("/health")).json()
+    rss_before = rss_bytes()
+    started = time.perf_counter()
+    await asyncio.gather(*(limited(index) for index in range(args.sessions)))
+    elapsed = time.perf_counter() - started
+    after = (await client.get("/health")).json()
+
+    completed = len(recorder.sessions)
+    tokens_before = sum(
+        usage.get("prompt_tokens", 0) + usage.get("completion_tokens", 0)
+        for usage in before.get("ai_calls", {}).get("tokens", {}).values()
+    )
+    tokens_after = sum(
+        usage.get("prompt_tokens", 0) + usage.get("completion_tokens", 0)
+        for usage in after.get("ai_calls", {}).get("tokens", {}).values()
+    )
+    calls_before = sum(before.get("ai_calls", {}).get("calls", {}).values())
+    calls_after = sum(after.get("ai_calls", {}).get("calls", {}).values())
+    sessions_count = after.get("sessions_count") or 0
+    memory_bytes = (after.get("session_store") or {}).get("memory_bytes")
+
+    results = {
+        "elapsed_seconds": round(elapsed, 3),
+        "sessions": {"requested": args.sessions, "completed": completed, **summarize(recorder.sessions)},
+        "requests": recorder.requests,
+        "rps": round(recorder.requests / elapsed, 2) if elapsed else None,
+        "sessions_per_second": round(completed / elapsed, 3) if elapsed else None,
+        "latency": {name: summarize(values) for name, values in recorder.latencies.items()},
+        "steps_per_session": summarize(recorder.steps),
+        "llm_calls_per_session": round((calls_after - calls_before) / completed, 3) if completed else None,
+        "tokens_per_session": round((tokens_after - tokens_before) / completed, 1) if completed else None,
+        "memory_bytes_per_session": round(memory_bytes / sessions_count) if memory_bytes and sessions_count else None,
+        "errors": recorder.errors,
+    }
+    if args.stream:
+        results["latency"]["first_delta"] = summarize(recorder.first_delta)
+    if not args.target:
+        results["rss_bytes_per_session"] = round((rss_bytes() - rss_before) / completed) if completed else None
+    return results
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def serve(app, lifespan: str = "on") -> str:
+    """اجرای یک برنامه ASGI با uvicorn در thread جداگانه روی پورت آزاد"""
+    import uvicorn
+
+    port = free_port()
+    config = uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", lifespan=lifespan)
+    server = uvicorn.Server(config)
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    deadline = time.monotonic() + 10
+    while not server.started:
+        if time.monotonic() > deadline:
+            raise RuntimeError("server did not start")
+        time.sleep(0.05)
+    return f"http://127.0.0.1:{port}"
+
+
+async def run(args: argparse.Namespace) -> dict:
+    target = args.target
+    if not target:
+        # تنظیمات app پیش از import خوانده می‌شوند
+        os.environ["AI_BASE_URL"] = args.provider_url or serve(create_app(config_from_args(args)), lifespan="off") + "/v1"
+        os.environ.setdefault("AI_API_KEY", "sk-bench-" + "0" * 24)
+        os.environ.setdefault("AI_MODEL_ID", "mock-model")
+        os.environ.setdefault("SESSION_BACKEND", "memory")
+        os.environ["AI_PROVIDERS"] = ""
+
+        from app.main import app
+
+        # HTTP واقعی (نه ASGITransport) تا زمان اولین تکه stream درست اندازه‌گیری شود
+        target = serve(app)
+
+    limits = httpx.Limits(max_connections=args.concurrency + 4)
+    async with httpx.AsyncClient(base_url=target, timeout=httpx.Timeout(args.timeout), limits=limits) as client:
+        return await drive(client, args)
+
+
+def compare(baseline_path: str, current_path: str) -> None:
+    """مقایسه دو فایل نتیجه؛ تغییر بیش از 10٪ در جهت بد علامت‌گذاری می‌شود"""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    with open(current_path, encoding="utf-8") as f:
+        current = json.load(f)
+
+    def flatten(data: dict, prefix: str = "") -> Dict[str, float]:
+        flat = {}
+        for key, value in data.items():
+            name = f"{prefix}{key}"
+            if isinstance(value, dict):
+                flat.update(flatten(value, f"{name}."))
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                flat[name] = value
+        return flat
+
+    old, new = flatten(baseline["results"]), flatten(current["results"])
+    print(f"{baseline.get('commit')} -> {current.get('commit')}")
+    for name in sorted(old.keys() & new.keys()):
+        before, after = old[name], new[name]
+        if not before:
+            continue
+        change = (after - before) / before * 100
+        worse = change > 10 if name.endswith(LOWER_IS_BETTER) else (change < -10 and name.endswith(("rps", "per_second")))
+        marker = "  <-- regression" if worse else ""
+        print(f"{name:45} {before:>12} {after:>12} {change:+7.1f}%{marker}")
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="python -m bench.run", description="بنچمارک بار 5 Whys")
+    parser.add_argument("--sessions", type=int, default=100, help="تعداد جلسات کامل")
+    parser.add_argument("--concurrency", type=int, default=10, help="جلسات هم‌زمان")
+    parser.add_argument("--warmup", type=int, default=2, help="جلسات گرم‌کردن (خارج از اندازه‌گیری)")
+    parser.add_argument("--stream", action="store_true", help="استفاده از endpointهای SSE")
+    parser.add_argument("--target", help="آدرس سرور در حال اجرا (بدون آن app داخل همین فرایند اجرا می‌شود)")
+    parser.add_argument("--provider-url", help="سرویس‌دهنده AI به جای سرویس‌دهنده ساختگی داخلی")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("-o", "--output", help="فایل JSON نتایج")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"), help="مقایسه دو فایل نتیجه")
+    add_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    args = parse_args(argv)
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    results = asyncio.run(run(args))
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "config": {
+            key: value for key, value in vars(args).items()
+            if key not in ("output", "compare")
+        },
+        "results": results,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from app.models.schemas import AIConfig
+from app.services import ai_service
+from app.services.ai_service import AIService
+
+MESSAGES = [{"role": "user", "content": "چرا سرور هر شب از کار می‌افتد؟"}]
+SCHEMA = {"name": "step", "schema": {"type": "object"}}
+BASE_URL = "http://stub.test/v1"
+
+
+def completion(content: str) -> httpx.Response:
+    return httpx.Response(200, json={"choices": [{"message": {"content": content}}]})
+
+
+def bad_request(message: str) -> httpx.Response:
+    return httpx.Response(400, json={"error": {"message": message}})
+
+
+def run_post(monkeypatch, replies):
+    """اجرای یک فراخوانی با پاسخ‌های ترتیبی؛ بدنه درخواست‌های فرستاده‌شده برمی‌گردد"""
+    sent = []
+    monkeypatch.setattr(ai_service, "_optional_params_unsupported", set())
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        sent.append(json.loads(request.content))
+        return replies[len(sent) - 1]
+
+    async def scenario():
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        monkeypatch.setattr(ai_service, "get_http_client", lambda: client)
+        service = AIService(AIConfig(base_url=BASE_URL, api_key="sk-test-key-1234567890"))
+        try:
+            return await service._call_provider(MESSAGES, "question", SCHEMA, False)
+        finally:
+            await client.aclose()
+
+    return sent, scenario
+
+
+def test_rejected_response_format_is_retried_then_disabled(monkeypatch):
+    sent, scenario = run_post(monkeypatch, [
+        bad_request("Unsupported parameter: 'response_format'"),
+        completion("ok"),
+    ])
+
+    assert asyncio.run(scenario()) == "ok"
+    assert "response_format" in sent[0]
+    assert "response_format" not in sent[1]
+    assert BASE_URL in ai_service._optional_params_unsupported
+
+
+def test_unrelated_400_keeps_optional_params(monkeypatch):
+    sent, scenario = run_post(monkeypatch, [bad_request("maximum context length exceeded")])
+
+    with pytest.raises(Exception, match="maximum context length"):
+        asyncio.run(scenario())
+    assert len(sent) == 1
+    assert BASE_URL not in ai_service._optional_params_unsupported
+
+
+def test_failed_retry_does_not_disable(monkeypatch):
+    sent, scenario = run_post(monkeypatch, [
+        bad_request("response_format is not supported with this model"),
+        bad_request("invalid messages"),
+    ])
+
+    with pytest.raises(Exception, match="invalid messages"):
+        asyncio.run(scenario())
+    assert len(sent) == 2
+    assert BASE_URL not in ai_service._optional_params_unsupported
@@ -0,0 +1,99 @@
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app.models.schemas import AnalysisSession, AnalysisStatus
+from app.services import archive
+
+
+def completed_session(session_id: str, problem: str, root_cause: str) -> AnalysisSession:
+    return AnalysisSession(
+        session_id=session_id,
+        original_problem=problem,
+        status=AnalysisStatus.ROOT_FOUND,
+        root_cause=root_cause,
+        recommendations=["افزایش حافظه"],
+        current_step=3,
+    )
+
+
+@pytest.fixture
+def archive_path(monkeypatch):
+    def use(path: str) -> None:
+        monkeypatch.setattr(archive, "ARCHIVE_ENABLED", True)
+        monkeypatch.setattr(archive, "ARCHIVE_PATH", path)
+
+    yield use
+    asyncio.run(archive.close_archive())
+
+
+def test_unopenable_archive_is_disabled(archive_path, tmp_path):
+    archive_path(str(tmp_path / "missing" / "archive.db"))
+
+    async def scenario():
+        await archive.open_archive()
+        assert archive.get_archive() is None
+        assert await archive.find_similar("سرور کند است") is None
+        # پایان تحلیل نباید با خطای بایگانی شکست بخورد
+        archive.archive_session(completed_session("s1", "سرور کند است", "حافظه کم"))
+
+    asyncio.run(scenario())
+    stats = archive.get_archive_stats()
+    assert stats["enabled"] is True
+    assert "OperationalError" in stats["error"]
+
+
+def test_archive_and_find_similar(archive_path, tmp_path):
+    archive_path(str(tmp_path / "archive.db"))
+
+    async def scenario():
+        await archive.open_archive()
+        store = archive.get_archive()
+        assert store is not None
+        await store.add(completed_session("s1", "سرور پایگاه داده هر شب کند می‌شود", "پشتیبان‌گیری هم‌زمان"))
+        await store.add(completed_session("s2", "صفحه ورود خطا می‌دهد", "گواهی منقضی"))
+        similar = await archive.find_similar("پایگاه داده کند شده است")
+        assert [item.root_cause for item in similar] == ["پشتیبان‌گیری هم‌زمان"]
+        assert not hasattr(similar[0], "session_id")
+
+    asyncio.run(scenario())
+
+
+@pytest.fixture
+def client(archive_path, tmp_path):
+    from app.main import app
+
+    archive_path(str(tmp_path / "archive.db"))
+
+    async def seed():
+        await archive.get_archive().add(
+            completed_session("s1", "سرور پایگاه داده هر شب کند می‌شود", "پشتیبان‌گیری هم‌زمان")
+        )
+
+    asyncio.run(seed())
+    return TestClient(app)
+
+
+def test_archive_routes_disabled_without_admin_token(client, monkeypatch):
+    monkeypatch.setattr(archive, "ARCHIVE_ADMIN_TOKEN", "")
+    assert client.get("/api/archive").status_code == 404
+    assert client.get("/api/archive/s1", headers={"X-Admin-Token": ""}).status_code == 404
+
+
+def test_archive_routes_require_admin_token(client, monkeypatch):
+    monkeypatch.setattr(archive, "ARCHIVE_ADMIN_TOKEN", "secret")
+    assert client.get("/api/archive").status_code == 401
+    assert client.get("/api/archive/search?q=سرور", headers={"X-Admin-Token": "wrong"}).status_code == 401
+
+    response = client.get("/api/archive", headers={"X-Admin-Token": "secret"})
+    assert response.status_code == 200
+    assert [item["session_id"] for item in response.json()["items"]] == ["s1"]
+    assert client.get("/api/archive/s1", headers={"X-Admin-Token": "secret"}).json()["session_id"] == "s1"
+
+
+def test_similar_items_have_no_session_id(client):
+    response = client.post("/api/similar", json={"problem": "پایگاه داده کند شده است"})
+    items = response.json()["items"]
+    assert [item["root_cause"] for item in items] == ["پشتیبان‌گیری هم‌زمان"]
+    assert "session_id" not in items[0]
@@ -0,0 +1,25 @@
+import pytest
+
+from app.services.config import env_bool
+
+
+@pytest.mark.parametrize("value", ["1", "true", "TRUE", "yes", "On", " true "])
+def test_true_values(monkeypatch, value):
+    monkeypatch.setenv("WHYS_TEST_FLAG", value)
+    assert env_bool("WHYS_TEST_FLAG", False) is True
+
+
+@pytest.mark.parametrize("value", ["0", "false", "no", "off", "enabled"])
+def test_other_values_are_false(monkeypatch, value):
+    monkeypatch.setenv("WHYS_TEST_FLAG", value)
+    assert env_bool("WHYS_TEST_FLAG", True) is False
+
+
+@pytest.mark.parametrize("value", [None, "", "  "])
+def test_missing_or_empty_uses_default(monkeypatch, value):
+    if value is None:
+        monkeypatch.delenv("WHYS_TEST_FLAG", raising=False)
+    else:
+        monkeypatch.setenv("WHYS_TEST_FLAG", value)
+    assert env_bool("WHYS_TEST_FLAG", True) is True
+    assert env_bool("WHYS_TEST_FLAG", False) is False
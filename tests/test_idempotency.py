@@ -0,0 +1,94 @@
+import asyncio
+
+import pytest
+
+from app.services.idempotency import IdempotencyCache, IdempotencyConflict
+
+
+def test_same_key_and_body_replays_result():
+    async def scenario():
+        cache = IdempotencyCache(ttl=60)
+        calls = []
+
+        async def factory():
+            calls.append(1)
+            return "first"
+
+        assert await cache.run("s1:k", factory, "body-a") == "first"
+        assert await cache.run("s1:k", factory, "body-a") == "first"
+        assert len(calls) == 1
+        assert cache.replayed == 1
+
+    asyncio.run(scenario())
+
+
+def test_same_key_with_different_body_conflicts():
+    async def scenario():
+        cache = IdempotencyCache(ttl=60)
+
+        async def factory():
+            return "first"
+
+        await cache.run("s1:k", factory, "body-a")
+        with pytest.raises(IdempotencyConflict):
+            await cache.run("s1:k", factory, "body-b")
+        assert cache.conflicts == 1
+        # نتیجه اول برای همان بدنه همچنان تکرار می‌شود
+        assert await cache.run("s1:k", factory, "body-a") == "first"
+
+    asyncio.run(scenario())
+
+
+def test_in_flight_conflict_and_coalescing():
+    async def scenario():
+        cache = IdempotencyCache(ttl=60)
+        release = asyncio.Event()
+
+        async def factory():
+            await release.wait()
+            return "done"
+
+        first = asyncio.create_task(cache.run("s1:k", factory, "body-a"))
+        await asyncio.sleep(0)
+        duplicate = asyncio.create_task(cache.run("s1:k", factory, "body-a"))
+        await asyncio.sleep(0)
+        with pytest.raises(IdempotencyConflict):
+            cache.begin("s1:k", "body-b")
+
+        release.set()
+        assert await asyncio.gather(first, duplicate) == ["done", "done"]
+        assert cache.executed == 1
+        assert cache.coalesced == 1
+
+    asyncio.run(scenario())
+
+
+def test_expired_key_can_be_reused_with_new_body():
+    async def scenario():
+        cache = IdempotencyCache(ttl=0)
+
+        async def factory():
+            return "value"
+
+        await cache.run("s1:k", factory, "body-a")
+        await asyncio.sleep(0.01)
+        assert cache.begin("s1:k", "body-b") is None
+
+    asyncio.run(scenario())
+
+
+def test_failure_is_not_cached():
+    async def scenario():
+        cache = IdempotencyCache(ttl=60)
+
+        async def failing():
+            raise RuntimeError("boom")
+
+        async def succeeding():
+            return "ok"
+
+        with pytest.raises(RuntimeError):
+            await cache.run("s1:k", failing, "body-a")
+        assert await cache.run("s1:k", succeeding, "body-b") == "ok"
+
+    asyncio.run(scenario())
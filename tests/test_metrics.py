@@ -0,0 +1,88 @@
+import os
+import json
+import time
+import asyncio
+import subprocess
+import sys
+
+import pytest
+
+from app.services import metrics
+
+
+def dead_pid() -> int:
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    return process.pid
+
+
+def worker_snapshot(requests: int, in_flight: int) -> dict:
+    return {
+        "whys_errors_total": {
+            "kind": "counter", "help": "errors", "labels": ["source"],
+            "values": [[["app"], requests]],
+        },
+        "whys_llm_in_flight": {
+            "kind": "gauge", "help": "in flight", "labels": ["provider"],
+            "values": [[["p"], in_flight]],
+        },
+        "whys_session_steps": {
+            "kind": "histogram", "help": "steps", "labels": [], "buckets": [1, 5],
+            "values": [[[], [[requests, 0], float(requests), requests]]],
+        },
+    }
+
+
+def write(directory, pid: int, snapshot: dict, age: float = 0) -> str:
+    path = os.path.join(directory, f"metrics-{pid}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(snapshot, f)
+    if age:
+        os.utime(path, (time.time() - age, time.time() - age))
+    return path
+
+
+@pytest.fixture
+def metrics_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS_DIR", str(tmp_path))
+    return tmp_path
+
+
+def merged_values(name: str) -> dict:
+    return metrics._merge(metrics._load_snapshots()).get(name, {}).get("values", {})
+
+
+def test_dead_worker_counters_are_kept(metrics_dir):
+    dead = write(metrics_dir, dead_pid(), worker_snapshot(requests=3, in_flight=2))
+    write(metrics_dir, os.getpid(), worker_snapshot(requests=4, in_flight=1))
+
+    for _ in range(2):
+        # بار دوم از فایل بایگانی خوانده می‌شود و دو بار جمع زده نمی‌شود
+        assert merged_values("whys_errors_total") == {("app",): 7}
+        assert merged_values("whys_session_steps")[()] == [[7, 0], 7.0, 7]
+        assert merged_values("whys_llm_in_flight") == {("p",): 1}
+        assert not os.path.exists(dead)
+        assert os.path.exists(metrics_dir / metrics.METRICS_ARCHIVE_FILE)
+
+
+def test_stale_live_worker_keeps_counters_but_not_gauges(metrics_dir):
+    # فرایند والد pytest زنده است ولی فایلش به‌روز نشده
+    path = write(metrics_dir, os.getppid(), worker_snapshot(requests=5, in_flight=3),
+                 age=metrics.METRICS_STALE_AFTER + 10)
+
+    assert merged_values("whys_errors_total") == {("app",): 5}
+    assert merged_values("whys_llm_in_flight") == {}
+    assert os.path.exists(path)
+
+
+def test_stopping_writer_archives_own_counters(metrics_dir, monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS_ENABLED", True)
+    metrics.errors.inc(source="app", error="Boom")
+
+    async def scenario():
+        await metrics.write_snapshot()
+        await metrics.stop_metrics_writer()
+
+    asyncio.run(scenario())
+    assert not os.path.exists(metrics._snapshot_path(os.getpid()))
+    assert merged_values("whys_errors_total")[("app", "Boom")] == 1
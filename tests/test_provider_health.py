@@ -0,0 +1,50 @@
+import time
+
+import pytest
+
+from app.models.schemas import AIConfig
+from app.services import provider_health
+from app.services.provider_health import CIRCUIT_HALF_OPEN, CIRCUIT_OPEN, ProviderHealthMonitor
+
+
+@pytest.fixture
+def monitor(monkeypatch):
+    monkeypatch.setattr(provider_health, "BREAKER_FAILURE_THRESHOLD", 1)
+    return ProviderHealthMonitor(AIConfig(base_url="http://provider.test/v1", api_key="sk-test", model_id="m"))
+
+
+def expire_open_circuit(monitor):
+    monitor.record_failure("HTTP 503")
+    assert monitor.circuit == CIRCUIT_OPEN
+    monitor.opened_at = time.monotonic() - provider_health.BREAKER_RESET_TIMEOUT - 1
+
+
+def test_snapshot_does_not_change_circuit_state(monitor):
+    expire_open_circuit(monitor)
+    for _ in range(3):
+        assert monitor.snapshot()["available"] is True
+    assert monitor.circuit == CIRCUIT_OPEN
+    assert monitor.is_available(peek=True) is True
+    assert monitor.circuit == CIRCUIT_OPEN
+
+
+def test_single_trial_after_health_polling(monitor):
+    expire_open_circuit(monitor)
+    monitor.snapshot()
+
+    assert monitor.acquire() is True
+    assert monitor.circuit == CIRCUIT_HALF_OPEN
+    assert monitor.acquire() is False
+    snapshot = monitor.snapshot()
+    assert snapshot["available"] is False
+    assert snapshot["trial_in_flight"] is True
+
+    monitor.record_success()
+    assert monitor.acquire() is True
+    assert monitor.acquire() is True
+
+
+def test_open_circuit_is_unavailable_until_reset_timeout(monitor):
+    monitor.record_failure("HTTP 503")
+    assert monitor.snapshot()["available"] is False
+    assert monitor.acquire() is False
@@ -0,0 +1,42 @@
+import asyncio
+
+from app.services.provider_health import stop_health_monitors
+from app.services.provider_registry import ProviderRegistry
+
+
+def test_signal_reload_task_is_tracked(tmp_path):
+    config = tmp_path / "providers.env"
+    config.write_text("AI_BASE_URL=http://first.test/v1\nAI_API_KEY=sk-test\nAI_MODEL_ID=m\n")
+
+    async def scenario():
+        registry = ProviderRegistry(str(config))
+        registry.load()
+        config.write_text("AI_BASE_URL=http://second.test/v1\nAI_API_KEY=sk-test\nAI_MODEL_ID=m\n")
+
+        registry._on_signal()
+        assert len(registry._pending) == 1
+        await asyncio.gather(*registry._pending)
+        assert registry._pending == set()
+        assert registry.current.configs[0].base_url == "http://second.test/v1"
+        await registry.stop()
+        await stop_health_monitors()
+
+    asyncio.run(scenario())
+
+
+def test_failed_signal_reload_is_logged(tmp_path, monkeypatch, caplog):
+    async def scenario():
+        registry = ProviderRegistry("")
+        registry.load()
+
+        async def broken():
+            raise RuntimeError("boom")
+
+        monkeypatch.setattr(registry, "reload", broken)
+        registry._on_signal()
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        assert registry._pending == set()
+
+    asyncio.run(scenario())
+    assert "Provider config reload failed: boom" in caplog.text
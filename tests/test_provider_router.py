@@ -0,0 +1,165 @@
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+import pytest
+
+from app.services import provider_router
+from app.services.provider_router import ProviderRouter
+
+
+def make_peer(name: str):
+    return SimpleNamespace(base_url=f"http://{name}.test/v1", model_id="stub")
+
+
+def server_error(peer) -> httpx.HTTPStatusError:
+    request = httpx.Request("POST", f"{peer.base_url}/chat/completions")
+    response = httpx.Response(503, request=request)
+    return httpx.HTTPStatusError("503 Service Unavailable", request=request, response=response)
+
+
+class StubProviders:
+    """سرویس‌دهنده‌های ساختگی: برای هر peer تاخیر و نتیجه (یا خطا) مشخص"""
+
+    def __init__(self, behaviour):
+        self.behaviour = behaviour
+        self.started = []
+        self.cancelled = []
+
+    async def start(self, peer, last):
+        self.started.append((peer, last))
+        delay, outcome = self.behaviour[peer.base_url]
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            self.cancelled.append(peer)
+            raise
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+@pytest.fixture
+def hedging(monkeypatch):
+    monkeypatch.setattr(provider_router, "AI_HEDGE", True)
+    monkeypatch.setattr(provider_router, "AI_HEDGE_DEFAULT_DELAY", 0.05)
+
+
+def test_primary_5xx_fails_over_to_secondary():
+    primary, secondary = make_peer("primary"), make_peer("secondary")
+    stubs = StubProviders({
+        primary.base_url: (0, server_error(primary)),
+        secondary.base_url: (0, "from secondary"),
+    })
+    router = ProviderRouter()
+
+    result = asyncio.run(router._race([primary, secondary], stubs.start, "call"))
+
+    assert result == "from secondary"
+    assert stubs.started == [(primary, False), (secondary, True)]
+    assert router.failovers == 1
+    assert router.stats_for(primary).failures == 1
+    assert "HTTPStatusError" in router.stats_for(primary).last_error
+    assert router.stats_for(secondary).successes == 1
+
+
+def test_last_error_is_raised_when_all_fail():
+    primary, secondary = make_peer("primary"), make_peer("secondary")
+    stubs = StubProviders({
+        primary.base_url: (0, server_error(primary)),
+        secondary.base_url: (0, server_error(secondary)),
+    })
+
+    with pytest.raises(httpx.HTTPStatusError) as info:
+        asyncio.run(ProviderRouter()._race([primary, secondary], stubs.start, "call"))
+    assert info.value.request.url.host == "secondary.test"
+
+
+def test_no_hedge_when_disabled(monkeypatch):
+    monkeypatch.setattr(provider_router, "AI_HEDGE", False)
+    primary, secondary = make_peer("primary"), make_peer("secondary")
+    stubs = StubProviders({
+        primary.base_url: (0.1, "from primary"),
+        secondary.base_url: (0, "from secondary"),
+    })
+    router = ProviderRouter()
+
+    assert asyncio.run(router._race([primary, secondary], stubs.start, "call")) == "from primary"
+    assert stubs.started == [(primary, False)]
+    assert router.hedges == 0
+
+
+def test_hedge_fires_after_delay_and_cancels_loser(hedging):
+    primary, secondary = make_peer("primary"), make_peer("secondary")
+    stubs = StubProviders({
+        primary.base_url: (5, "from primary"),
+        secondary.base_url: (0, "from secondary"),
+    })
+    router = ProviderRouter()
+
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        result = await router._race([primary, secondary], stubs.start, "call")
+        return result, loop.time() - started
+
+    result, elapsed = asyncio.run(scenario())
+
+    assert result == "from secondary"
+    # hedge پس از تاخیر پیش‌فرض، نه بلافاصله و نه پس از پایان کار اولی
+    assert 0.05 <= elapsed < 1
+    assert stubs.started == [(primary, False), (secondary, True)]
+    assert stubs.cancelled == [primary]
+    assert router.hedges == 1
+    assert router.hedge_wins == 1
+
+
+def test_hedge_uses_observed_latency(hedging, monkeypatch):
+    monkeypatch.setattr(provider_router, "AI_HEDGE_MIN_DELAY", 0.01)
+    primary = make_peer("primary")
+    router = ProviderRouter()
+    assert router.hedge_delay(primary, "call") == 0.05
+
+    for _ in range(provider_router.ROUTER_MIN_SAMPLES):
+        router.stats_for(primary).record_success("call", 0.2)
+    assert router.hedge_delay(primary, "call") == 0.2
+
+
+def test_primary_wins_before_hedge_delay(hedging):
+    primary, secondary = make_peer("primary"), make_peer("secondary")
+    stubs = StubProviders({
+        primary.base_url: (0, "from primary"),
+        secondary.base_url: (0, "from secondary"),
+    })
+    router = ProviderRouter()
+
+    assert asyncio.run(router._race([primary, secondary], stubs.start, "call")) == "from primary"
+    assert stubs.started == [(primary, False)]
+    assert router.hedges == 0
+
+
+def test_finished_loser_is_passed_to_on_loser(hedging):
+    primary, secondary = make_peer("primary"), make_peer("secondary")
+    closed = []
+
+    class Stream:
+        def __init__(self, name):
+            self.name = name
+
+    async def start(peer, last):
+        if peer is primary:
+            # پاسخ اولی درست هم‌زمان با hedge می‌رسد و لغو را نادیده می‌گیرد
+            try:
+                await asyncio.sleep(0.1)
+            except asyncio.CancelledError:
+                pass
+            return Stream("primary")
+        return Stream("secondary")
+
+    async def on_loser(result):
+        closed.append(result.name)
+
+    result = asyncio.run(ProviderRouter()._race([primary, secondary], start, "first_chunk", on_loser))
+
+    assert result.name == "secondary"
+    assert closed == ["primary"]
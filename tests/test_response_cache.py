@@ -0,0 +1,46 @@
+import asyncio
+
+from app.services.response_cache import ResponseCache
+
+PROBLEM = "سرور پایگاه داده هر شب ساعت دو از کار می‌افتد"
+NEAR_DUPLICATE = "سرور پایگاه داده هر شب ساعت دو از کار می افتد!"
+
+
+def make_cache() -> ResponseCache:
+    return ResponseCache("test", ttl=60, max_entries=100, near_duplicates=True)
+
+
+def test_near_duplicate_hit_within_same_model_and_prompt():
+    async def scenario():
+        cache = make_cache()
+        await cache.set(cache.make_key(PROBLEM, "1", "model-a"), "question-a", PROBLEM)
+        key = cache.make_key(NEAR_DUPLICATE + " واقعا", "1", "model-a")
+        assert await cache.get(key, NEAR_DUPLICATE + " واقعا") == "question-a"
+        assert cache.near_hits == 1
+
+    asyncio.run(scenario())
+
+
+def test_near_duplicates_are_partitioned_by_model_and_prompt_version():
+    async def scenario():
+        cache = make_cache()
+        await cache.set(cache.make_key(PROBLEM, "1", "model-a"), "question-a", PROBLEM)
+        for parts in (("1", "model-b"), ("2", "model-a")):
+            key = cache.make_key(NEAR_DUPLICATE + " واقعا", *parts)
+            assert await cache.get(key, NEAR_DUPLICATE + " واقعا") is None
+        assert cache.near_hits == 0
+
+    asyncio.run(scenario())
+
+
+def test_eviction_clears_buckets():
+    async def scenario():
+        cache = ResponseCache("test", ttl=60, max_entries=1, near_duplicates=True)
+        await cache.set(cache.make_key(PROBLEM, "1", "m"), "first", PROBLEM)
+        await cache.set(cache.make_key("مشکل کاملا متفاوت دیگری در شبکه", "1", "m"), "second",
+                        "مشکل کاملا متفاوت دیگری در شبکه")
+        assert cache.evictions == 1
+        assert all(len(keys) == 1 for keys in cache._buckets.values())
+        assert await cache.get(cache.make_key(NEAR_DUPLICATE, "1", "m"), NEAR_DUPLICATE) is None
+
+    asyncio.run(scenario())
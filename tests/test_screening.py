@@ -0,0 +1,39 @@
+import pytest
+
+from app.models.schemas import WhyStep
+from app.services.screening import check_answer
+
+PROBLEM = "سرور پایگاه داده هر شب از کار می‌افتد"
+QUESTION = "چرا سرور پایگاه داده از کار می‌افتد؟"
+
+
+def reason(answer: str, previous=()):
+    result = check_answer(PROBLEM, QUESTION, list(previous), answer)
+    return result[0] if result else None
+
+
+@pytest.mark.parametrize("answer", ["OOM", "2FA", "Misconfiguration", "حافظه", "پشتیبان‌گیری هم‌زمان با بار اصلی"])
+def test_plausible_answers_reach_the_model(answer):
+    assert reason(answer) is None
+
+
+@pytest.mark.parametrize("answer, expected", [
+    ("نمی‌دونم", "non_answer"),
+    ("idk", "non_answer"),
+    ("12345 !!!", "unreadable"),
+    ("هههههههه", "unreadable"),
+    ("Память сервера заканчивается", "wrong_script"),
+    ("内存不足", "wrong_script"),
+    (QUESTION, "echo"),
+])
+def test_clear_failures_are_rejected(answer, expected):
+    assert reason(answer) == expected
+
+
+def test_latin_terms_in_persian_answer_are_allowed():
+    assert reason("چون cron job بکاپ هم‌زمان با peak اجرا می‌شود") is None
+
+
+def test_repeated_answer_is_duplicate():
+    previous = [WhyStep(step_number=1, question=QUESTION, answer="حافظه سرور پر می‌شود")]
+    assert reason("حافظه سرور پر می‌شود!", previous) == "duplicate"
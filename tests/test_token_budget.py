@@ -0,0 +1,51 @@
+import asyncio
+import json
+
+import httpx
+
+from app.models.schemas import AIConfig
+from app.services import ai_service, token_budget
+from app.services.ai_service import AIService
+from app.services.call_stats import track_calls
+from app.services.token_budget import count_message_tokens, count_text_tokens, usage_or_estimate
+
+MESSAGES = [{"role": "user", "content": "چرا سرور هر شب از کار می‌افتد؟"}]
+
+
+def test_reported_usage_is_kept():
+    usage = {"prompt_tokens": 12, "completion_tokens": 3, "cached_tokens": 0}
+    assert usage_or_estimate(usage, MESSAGES, "پاسخ") is usage
+
+
+def test_missing_usage_is_estimated():
+    before = token_budget._stats["estimated_calls"]
+    usage = usage_or_estimate({}, MESSAGES, "چون حافظه پر می‌شود")
+    assert usage["prompt_tokens"] == count_message_tokens(MESSAGES)
+    assert usage["completion_tokens"] == count_text_tokens("چون حافظه پر می‌شود")
+    assert token_budget._stats["estimated_calls"] == before + 1
+
+
+def test_stream_without_usage_counts_towards_budget(monkeypatch):
+    chunks = ["چون ", "حافظه ", "پر می‌شود"]
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        # سرویس‌دهنده‌ای که رویداد usage نمی‌فرستد
+        body = "".join(
+            "data: " + json.dumps({"choices": [{"delta": {"content": chunk}}]}) + "\n\n"
+            for chunk in chunks
+        ) + "data: [DONE]\n\n"
+        return httpx.Response(200, text=body, headers={"content-type": "text/event-stream"})
+
+    async def scenario():
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        monkeypatch.setattr(ai_service, "get_http_client", lambda: client)
+        service = AIService(AIConfig(base_url="http://stub.test/v1", api_key="sk-test-key-1234567890"))
+        with track_calls() as calls:
+            text = "".join([part async for part in service._stream_provider(MESSAGES, "question", None, False)])
+        await client.aclose()
+        return text, calls
+
+    text, calls = asyncio.run(scenario())
+    assert text == "".join(chunks)
+    assert calls.prompt_tokens == count_message_tokens(MESSAGES)
+    assert calls.completion_tokens == count_text_tokens(text)